@@ -8,20 +8,22 @@ Created on Sat Nov 25 01:26:16 2023
 
 # Standard imports
 import os
+from collections import OrderedDict
 
 # Local imports
 from modules import logging
-from modules.analysis_funcs.extract_activations_funcs import probe_network_with_stimuli
+from modules.analysis_funcs.activation_cache import ActivationCache, model_fingerprint, probe_models_with_stimuli_cached
+from modules.analysis_funcs.activation_store import ActivationStore, precision_report
+from modules.analysis_funcs.extract_activations_funcs import probe_models_with_stimuli
 from modules import device
-from modules.net_funcs.dataset_funcs import get_dataloader_from_csv
-from modules.net_funcs.net_utils import get_last_level_layer_names, load_alphazero_models
-from modules.utils.helper_funcs import (
+from modules.models.alphazero.alphazero_utils import load_alphazero_models
+from modules.net_funcs.dataset_funcs import get_fmri_dataloader_from_csv
+from modules.net_funcs.net_utils import env_check, get_last_level_layer_names
+from modules.helper_funcs.utils import (
     OutputLogger,
     create_output_directory,
     create_run_id,
-    env_check,
     print_dict,
-    save_ordered_dict,
     save_script_to_file,
     set_random_seeds
 )
@@ -39,6 +41,9 @@ params = {
     "selected_layers": ["conv", "fc", "relu", "tanh"], # List of strings for activations extraction and plotting
     "reduction_methods": ["random_forest"],  # Dimensionality reduction method ('PCA', 't-SNE', 'MDS')
     "distance_metric": ["pearson"],  # Distance metric for RDM calculation ('pearson', 'mahalanobis', 'euclidean')
+    "cache_dir": "./results/activation_cache",  # Cache of activations keyed by weights, layers and stimuli (None to always recompute)
+    "store_precision": "float32",  # Precision of the saved activations ('float32', 'float16', 'bfloat16', 'int8')
+    "precision_report": True,  # Save the RDM deviation of each layer at reduced precisions (needs float32 activations: cached, or stored as float32)
     
     # Loading untrained and trained AlphaZeroNet models
     "load_models": {
@@ -47,7 +52,7 @@ params = {
     },  
     
     # Creating a DataLoader for fMRI dataset from a CSV file
-    "get_dataloader_from_csv": {
+    "get_fmri_dataloader_from_csv": {
         "csv_file_path": "datasets/fmri_dataset/dataset.csv",  # Path to dataset CSV file
         "batch_size": 40,  # Number of samples per batch
         "shuffle": False,  # Whether to shuffle the dataset
@@ -55,9 +60,10 @@ params = {
         "pin_memory": True,  # Copy Tensors into CUDA pinned memory for CUDA GPUs
     },  
     
-    # Probing a neural network model with controlled stimuli
-    "probe_network_with_stimuli": {
-        "device": device,  # Computational device for running the model
+    # Probing all neural network models with controlled stimuli in a single pass
+    "probe_models_with_stimuli": {
+        "device": device,  # Computational device for running the models
+        "n_workers": 0,  # Worker processes sharing the models (0 runs all models in the main process; workers are spawned, so > 0 needs the main code under an if __name__ == "__main__" guard)
     },  
     
     # Visualizing dimensionality reduction of neural network activations
@@ -107,56 +113,77 @@ with OutputLogger(params["save_logs"], out_text_file):
     logging.info(f"Starting processing with {params['seeds_num']} seeds.")
     # Set a number of seeds for initialization
     seeds = range(params["seeds_num"])
-    
-    # Loop through seeds
-    for seed in seeds:
-        
-        logging.debug(f"Processing seed number: {seed}")
+
+    logging.info("Loading models...")
+    # Load the trained model (and the untrained model of the first seed) once, using specified weight paths and device
+    set_random_seeds(seeds[0])
+    untrained_model, trained_model = load_alphazero_models(**params["load_models"])
+    models = OrderedDict([
+        (f'model-trained_seed-{seeds[0]}', trained_model),
+        (f'model-untrained_seed-{seeds[0]}', untrained_model),
+        ])  # Models to analyze, keyed by model and seed
+
+    # Every further seed only adds a freshly initialized untrained model
+    for seed in seeds[1:]:
+        logging.debug(f"Initializing untrained model for seed number: {seed}")
         # Set random seeds for reproducibility, ensuring consistent results across runs
-        logging.debug("Setting random seeds for reproducibility.")
         set_random_seeds(seed)
-    
-        logging.info("Loading models...")
-        # Load models, both untrained and trained, using specified weight paths and device
-        untrained_model, trained_model = load_alphazero_models(**params["load_models"])
-        logging.debug("Models loaded successfully.")
-    
-        logging.debug("Loading data loader from CSV.")
-        # Load a data loader from a CSV file, specifying the path to the dataset and the batch size
-        data_loader = get_dataloader_from_csv(**params["get_dataloader_from_csv"])
-        logging.info("Data loader loaded successfully.")
-    
-        logging.info("Starting analysis on models.")
-        # Analysis parameters
-        models = [
-            (trained_model, 'trained'),
-            (untrained_model, 'untrained')
-            ]  # List of models to analyze
-    
-        # Iterating over the models 
-        for model, model_id in models:
-            
-            # Retrieve names of the last layers in the model
-            layers_names_all = get_last_level_layer_names(model)
-    
-            # Filter the layer names based on the selected layers
-            layers_names = [
-                layer_name
-                for layer_name in layers_names_all
-                if any(sel_layer in layer_name for sel_layer in params["selected_layers"])
-            ]
-    
-            logging.debug(f"Probing network for model '{model_id}' with stimuli.")
-            # Probe the network with stimuli and get activations for the specified layers
-            activations_all_layers = probe_network_with_stimuli(
-                model, layers_names, data_loader, **params["probe_network_with_stimuli"]
+        models[f'model-untrained_seed-{seed}'] = load_alphazero_models(**{**params["load_models"], "weights_path": None})
+    logging.debug("Models loaded successfully.")
+
+    logging.debug("Loading data loader from CSV.")
+    # Load a data loader from a CSV file, specifying the path to the dataset and the batch size
+    data_loader = get_fmri_dataloader_from_csv(**params["get_fmri_dataloader_from_csv"])
+    logging.info("Data loader loaded successfully.")
+
+    # Retrieve names of the last layers in the model (all models share the same architecture)
+    layers_names_all = get_last_level_layer_names(trained_model)
+
+    # Filter the layer names based on the selected layers
+    layers_names = [
+        layer_name
+        for layer_name in layers_names_all
+        if any(sel_layer in layer_name for sel_layer in params["selected_layers"])
+    ]
+
+    store_path = os.path.join(out_dir, 'activations')
+
+    logging.info(f"Probing {len(models)} models with stimuli.")
+    if params["cache_dir"] is not None:
+        # Only compute the activations (models, layers and stimuli) that are not cached yet.
+        # The trained model is identified by its weights file, untrained models by their initialized weights.
+        fingerprints = {f'model-trained_seed-{seeds[0]}': model_fingerprint(weights_path=params["load_models"]["weights_path"])}
+        activations_all_models = probe_models_with_stimuli_cached(
+            models, layers_names, data_loader, cache=ActivationCache(params["cache_dir"]), fingerprints=fingerprints,
+            **params["probe_models_with_stimuli"]
+        )
+        if params["save_logs"]:
+            logging.debug(f"Saving activations to store: {store_path}")
+            ActivationStore.from_table(store_path, activations_all_models, precision=params["store_precision"])
+    else:
+        # Stream the activations of all models into one on-disk store (one memory-mapped .npy file per model and layer)
+        store = None
+        if params["save_logs"]:
+            logging.debug(f"Saving activations to store: {store_path}")
+            store = ActivationStore.create(store_path, n_stimuli=len(data_loader.dataset), precision=params["store_precision"])
+
+        # Load and encode every batch once and run it through all models
+        activations_all_models = probe_models_with_stimuli(
+            models, layers_names, data_loader, store=store, **params["probe_models_with_stimuli"]
+        )
+    logging.info("Completed probing for all models.")
+
+    if params["save_logs"]:
+        logging.info(f"Activations saved successfully for models {list(models)}.")
+
+        # Without the cache, the activations are read back from the store and are only float32 if stored as such
+        if params["precision_report"] and params["cache_dir"] is None and params["store_precision"] != "float32":
+            logging.warning(
+                f"Skipping the precision report: the activations were stored as {params['store_precision']}, "
+                "so there is no float32 reference to compare against."
             )
-            logging.info(f"Completed probing for model '{model_id}'.")
-
-            if params["save_logs"]:
-                # Save dictionary to file
-                pkl_path = os.path.join(out_dir, f'activations_model-{model_id}_seed-{seed}.pkl')
-                logging.debug(f"Saving activations to file: {pkl_path}")
-                save_ordered_dict(activations_all_layers, pkl_path)
-                logging.info(f"Activations saved successfully for model '{model_id}', seed {seed}.")
-                    
\ No newline at end of file
+        elif params["precision_report"]:
+            # Maximum RDM deviation per layer when storing activations at reduced precision
+            report = precision_report(activations_all_models, distance_metric=params["distance_metric"][0])
+            report.to_csv(os.path.join(out_dir, 'precision_report.csv'), index=False)
+            logging.info(f"Precision report:\n{report.to_string(index=False)}")
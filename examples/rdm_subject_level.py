@@ -11,16 +11,16 @@ import os
 
 # Local imports
 from modules import logging
-from modules.analysis.MDS_funcs import apply_dimensionality_reduction_to_activations, MDS_plot
-from modules.analysis.rdm_funcs import compute_rdm
-from modules.utils.helper_funcs import (
-    env_check,
+from modules.analysis_funcs.activation_store import ActivationStore
+from modules.analysis_funcs.extract_activations_funcs import MODEL_LAYER_SEP, split_model_layer_name
+from modules.analysis_funcs.MDS_funcs import apply_dimensionality_reduction_to_activations, MDS_plot
+from modules.analysis_funcs.rdm_funcs import compute_rdm
+from modules.net_funcs.net_utils import env_check, extract_model_seed_from_filename
+from modules.helper_funcs.utils import (
     print_dict,
     OutputLogger,
     create_run_id,
     save_numpy_array,
-    extract_model_seed_from_filename,
-    load_ordered_dict,
     create_output_directory,
     save_script_to_file,
 )
@@ -79,31 +79,39 @@ if params["save_logs"]:
 
 with OutputLogger(params["save_logs"], out_text_file):
     print_dict(params)
-    # Loop through alll the files in the activations folder
-    for file_name in os.listdir(params["activations_dir"]):
+    # Loop through all the activation stores in the activations folder
+    for file_name in sorted(os.listdir(params["activations_dir"])):
         
-        # If the file is a pickle file
-        if file_name.endswith(".pkl"):
+        # If the folder is an activation store
+        full_path = os.path.join(params["activations_dir"], file_name)
+        if ActivationStore.is_store(full_path):
             
-            # Load activations data from saved files
-            full_path = os.path.join(params["activations_dir"], file_name)
-            activations_all_layers = load_ordered_dict(full_path)
-
-            # Extract model, seed info from file name
-            model_id, seed = extract_model_seed_from_filename(file_name)
+            # Open the store (layers are only read when they are accessed)
+            store = ActivationStore(full_path)
 
             # Iterating through each layer's activations
-            for layer_name, layer_items in activations_all_layers.items():
+            for store_layer_name in store.layers:
+
+                # Extract model, seed info from the layer name (multi-model stores) or from the store name
+                if MODEL_LAYER_SEP in store_layer_name:
+                    model_key, layer_name = split_model_layer_name(store_layer_name)
+                    model_id, seed = extract_model_seed_from_filename(f"activations_{model_key}")
+                else:
+                    layer_name = store_layer_name
+                    model_id, seed = extract_model_seed_from_filename(file_name)
+
+                # Memory-map the activations of the current layer only
+                layer_items = store.table(store_layer_name)
                 
                 # For each dimensionality reduction method
                 for method in params["run_params"]["reduction_methods"]:
                     
                     # # Perform and plot MDS on the activations
-                    # projections = MDS_plot(layer_items, method=method, **params["MDS_plot"])
+                    # projections = MDS_plot(layer_items, method=method, layer_name=layer_name, **params["MDS_plot"])
 
                     # Apply dimensionality reduction
                     activations_reduced = apply_dimensionality_reduction_to_activations(
-                        layer_items, method=method, **params["dimensionality_reduction"]
+                        layer_items, method=method, layer_name=store_layer_name, **params["dimensionality_reduction"]
                     )
 
                     # for each distance metric in params
@@ -111,13 +119,13 @@ with OutputLogger(params["save_logs"], out_text_file):
                         # Compute RDMs
                         rdms = compute_rdm(
                             activations_reduced,
-                            layer_name=layer_name,
+                            layer_name=store_layer_name,
                             distance_metric=distance,
                             **params["compute_rdm"],
                         )
 
                         if params["save_logs"]:
                             # Save RDM as a numpy array
-                            file_name = f"single-rdms_model-{model_id}_seed-{seed}_layer-{layer_name}_method-{method}_distance-{distance}.npy"
-                            save_path = os.path.join(out_dir, file_name)
+                            rdm_file_name = f"single-rdms_model-{model_id}_seed-{seed}_layer-{layer_name}_method-{method}_distance-{distance}.npy"
+                            save_path = os.path.join(out_dir, rdm_file_name)
                             save_numpy_array(rdms, save_path)
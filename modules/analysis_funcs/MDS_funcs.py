@@ -7,7 +7,6 @@ Created on Fri Nov 24 14:08:04 2023
 """
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.feature_selection import SelectFromModel
-from copy import deepcopy
 import matplotlib.pyplot as plt
 import numpy as np
 from sklearn.decomposition import PCA
@@ -15,22 +14,25 @@ from sklearn.manifold import MDS, TSNE
 from sklearn.preprocessing import StandardScaler
 
 from modules import logging
+from modules.analysis_funcs.activation_table import as_activation_table, resolve_layer
 
-def apply_dimensionality_reduction_to_activations(activations, n_components, method="PCA", preprocess=True):
+def apply_dimensionality_reduction_to_activations(activations, n_components, method="PCA", preprocess=True, layer_name=None):
     """
-    Applies dimensionality reduction to the activations in the given dictionary.
+    Applies dimensionality reduction to the activations of one layer.
 
-    :param activations: Dictionary with stim_id as keys and dictionaries containing 'activation' data.
-    :type activations: dict
+    :param activations: Activation table (or a legacy dictionary with stim_id as keys and dictionaries containing 'activation' data).
+    :type activations: ActivationTable or dict
     :param n_components: Number of components to retain after reduction.
     :type n_components: int
     :param method: Reduction method ('random_forest', 'PCA', 't-SNE', 'MDS'). Default is 'PCA'.
     :type method: str
     :param preprocess: Whether to standardize activations before reduction. Default is True.
     :type preprocess: bool
-    :returns: Dictionary with updated 'activation' data post reduction.
-    :rtype: dict
-    :raises ValueError: For invalid `n_components`, method, or input dictionary structure.
+    :param layer_name: Name of the layer to reduce. Can be omitted for tables with a single layer.
+    :type layer_name: str, optional
+    :returns: Table in which the activations of the layer are replaced by their reduced version (metadata and other layers are shared).
+    :rtype: ActivationTable
+    :raises ValueError: For invalid `n_components`, method, or input structure.
     """
     
     # Validate n_components and method inputs
@@ -40,19 +42,13 @@ def apply_dimensionality_reduction_to_activations(activations, n_components, met
         raise ValueError("Invalid method. Choose 'random_forest', 'PCA', 't-SNE', or 'MDS'.")
 
     # Ensure the input structure is correct
-    if not all('activation' in v for v in activations.values()):
+    if isinstance(activations, dict) and not all('activation' in v for v in activations.values()):
         raise ValueError("Each entry in activations must contain an 'activation' key.")
+    table = as_activation_table(activations)
+    layer_name = resolve_layer(table, layer_name)
 
-    # Prepare data for dimensionality reduction
-    try:
-        # Extract and flatten activations into a list
-        flattened_activations = [v['activation'].reshape(-1) for v in activations.values()]
-    except Exception as e:
-        logging.error(f"Error processing activations: {e}")
-        raise
-
-    # Stack flattened activations into a 2D NumPy array
-    activations_np = np.vstack(flattened_activations)
+    # The (n_stimuli, n_features) activations of the layer (a view, no copy)
+    activations_np = table[layer_name]
 
     # Optionally preprocess the data
     if preprocess and method in ["PCA", "t-SNE"]:
@@ -84,20 +80,16 @@ def apply_dimensionality_reduction_to_activations(activations, n_components, met
                 activations_reduced = reducer.fit_transform(activations_np)
             else:
                 logging.warning("Number of features is less than n_components. Returning original activations.")
-                return deepcopy(activations)
+                return table
 
     except Exception as e:
         logging.error(f"Error applying dimensionality reduction: {e}")
         raise
 
-    # Update the activations in the original dictionary
-    transformed_activations = deepcopy(activations)
-    for i, stim_id in enumerate(activations):
-        transformed_activations[stim_id]['activation'] = activations_reduced[i]
+    # Replace the activations of the layer by their reduced version
+    return table.with_layer(layer_name, activations_reduced)
 
-    return transformed_activations
-
-def MDS_plot(probe_output, method="MDS", n_components=2, alpha=0.5, preprocess=True):
+def MDS_plot(probe_output, method="MDS", n_components=2, alpha=0.5, preprocess=True, layer_name=None):
     """
     Visualize dimensionality reduction of neural network activations.
 
@@ -105,8 +97,8 @@ def MDS_plot(probe_output, method="MDS", n_components=2, alpha=0.5, preprocess=T
     and plots the results in 1D, 2D, or 3D. It is used to understand the distribution of
     neural activations across different labels or strategies.
 
-    :param probe_output: A dictionary with labels as keys and lists of numpy arrays (activations) as values.
-    :type probe_output: dict
+    :param probe_output: Activation table (or a legacy dictionary of a single layer keyed by stim_id).
+    :type probe_output: ActivationTable or dict
     :param method: The dimensionality reduction method ('PCA', 't-SNE', or 'MDS').
     :type method: str
     :param n_components: Number of dimensions for the projection (1, 2, or 3).
@@ -115,39 +107,44 @@ def MDS_plot(probe_output, method="MDS", n_components=2, alpha=0.5, preprocess=T
     :type alpha: float
     :param preprocess: Whether to apply preprocessing like standardization.
     :type preprocess: bool
-    :returns: A dictionary of projections with each key as a label and value as the reduced dimensionality data.
-    :rtype: dict
+    :param layer_name: Name of the layer to plot. Can be omitted for tables with a single layer.
+    :type layer_name: str, optional
+    :returns: Table in which the activations of the layer are replaced by the projected data.
+    :rtype: ActivationTable
     """
     # Check if n_components is either 2 or 3
     if n_components not in [2, 3]:
         raise ValueError("n_components must be either 2 or 3.")
 
+    table = as_activation_table(probe_output)
+    layer_name = resolve_layer(table, layer_name)
+
     # Check if only one feature is present in the activations
-    if len(probe_output[list(probe_output.keys())[0]]['activation'].shape) == 1:
+    if table[layer_name].shape[1] == 1:
         # Warn the user and adjust n_components to 1 if only one feature is detected
         logging.warning("Only one feature detected. Adjusting to 1D projection.")
-        proj = probe_output
+        proj = table
         n_components = 1
-
-    # Apply dimensionality reduction to the activations
-    proj = apply_dimensionality_reduction_to_activations(
-        probe_output, n_components, method=method, preprocess=preprocess
-    )
+    else:
+        # Apply dimensionality reduction to the activations
+        proj = apply_dimensionality_reduction_to_activations(
+            table, n_components, method=method, preprocess=preprocess, layer_name=layer_name
+        )
 
     # Create a figure for plotting
     fig = plt.figure(figsize=(8, 6))
 
-    # Extract the unique categories (strategies) from the data
-    categories = [int(stim_dict['strategy']) for _, stim_dict in proj.items()]
-    # unique_categories = set(categories)
+    # Extract the categories (strategies) from the data
+    categories = proj.metadata['strategy'].to_numpy().astype(int)
+    projected_points = proj[layer_name]
 
     # Select the appropriate plotting method based on the number of dimensions
     if n_components == 1:
-        plot_1d_data(proj, categories, alpha)
+        plot_1d_data(projected_points, categories, alpha)
     elif n_components == 2:
-        plot_2d_data(proj, categories, method, alpha)
+        plot_2d_data(projected_points, categories, method, alpha)
     elif n_components == 3:
-        plot_3d_data(proj, categories, method, alpha, fig)
+        plot_3d_data(projected_points, categories, method, alpha, fig)
 
     # Display the legend and show the plot
     plt.legend()
@@ -159,16 +156,16 @@ def plot_1d_data(proj, categories, alpha):
     """
     Plot 1D data with random y-axis offsets for visualization.
 
-    :param proj: Projected data points.
-    :type proj: dict
+    :param proj: Projected data points of shape (n_stimuli, 1).
+    :type proj: numpy.ndarray
     :param categories: Categories or labels for the data points.
-    :type categories: list or similar iterable
+    :type categories: numpy.ndarray
     :param alpha: Transparency level for the plot points.
     :type alpha: float
     """
-    for strategy in set(categories):
+    for strategy in np.unique(categories):
         # Get the projected points for the current strategy
-        projected_points = np.array([proj[stim_id]['activation'] for stim_id in proj if proj[stim_id]['strategy'] == strategy])
+        projected_points = proj[categories == strategy]
         # Create random offsets along the y-axis for better visualization
         y_offsets = np.random.uniform(-0.01, 0.01, size=projected_points.shape[0])
         # Plot the points with the specified alpha (transparency)
@@ -181,10 +178,10 @@ def plot_2d_data(proj, categories, method, alpha):
     """
     Plot 2D data with appropriate labels and titles.
 
-    :param proj: Projected data points.
-    :type proj: dict
+    :param proj: Projected data points of shape (n_stimuli, 2).
+    :type proj: numpy.ndarray
     :param categories: Categories or labels for the data points.
-    :type categories: list or similar iterable
+    :type categories: numpy.ndarray
     :param method: The dimensionality reduction method used.
     :type method: str
     :param alpha: Transparency level for the plot points.
@@ -193,9 +190,9 @@ def plot_2d_data(proj, categories, method, alpha):
     plt.xlabel(f"{method} Dim 1")
     plt.ylabel(f"{method} Dim 2")
     plt.title(f"Dimensionality Reduction Analysis using {method}")
-    for strategy in set(categories):
+    for strategy in np.unique(categories):
         # Get the projected points for the current strategy
-        projected_points = np.array([proj[stim_id]['activation'] for stim_id in proj if proj[stim_id]['strategy'] == strategy])
+        projected_points = proj[categories == strategy]
         # Plot the points in 2D space
         plt.scatter(projected_points[:, 0], projected_points[:, 1], alpha=alpha, label=f"Strategy {strategy}")
 
@@ -203,10 +200,10 @@ def plot_3d_data(proj, categories, method, alpha, fig):
     """
     Plot 3D data with appropriate axis labels and titles.
 
-    :param proj: Projected data points.
-    :type proj: dict
+    :param proj: Projected data points of shape (n_stimuli, 3).
+    :type proj: numpy.ndarray
     :param categories: Categories or labels for the data points.
-    :type categories: list or similar iterable
+    :type categories: numpy.ndarray
     :param method: The dimensionality reduction method used.
     :type method: str
     :param alpha: Transparency level for the plot points.
@@ -219,8 +216,8 @@ def plot_3d_data(proj, categories, method, alpha, fig):
     ax.set_ylabel(f"{method} Dim 2")
     ax.set_zlabel(f"{method} Dim 3")
     plt.title(f"Dimensionality Reduction Analysis using {method}")
-    for strategy in set(categories):
+    for strategy in np.unique(categories):
         # Get the projected points for the current strategy
-        projected_points = np.array([proj[stim_id]['activation'] for stim_id in proj if proj[stim_id]['strategy'] == strategy])
+        projected_points = proj[categories == strategy]
         # Plot the points in 3D space
         ax.scatter(projected_points[:, 0], projected_points[:, 1], projected_points[:, 2], alpha=alpha, label=f"Strategy {strategy}")
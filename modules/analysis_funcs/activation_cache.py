@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of network activations.
+
+Activations are cached per model fingerprint (a hash of the state_dict, or of a weights file plus a seed) and
+per stimulus (a hash of its row in the stimulus CSV). Each extraction adds a segment, i.e., a complete
+activation store for a set of stimuli and layers, to the directory of the model:
+
+    <cache_dir>/<model fingerprint>/<segment>/{manifest.json, stimuli.csv, 000_<layer>.npy, ...}
+
+A request is answered from all segments of the model together, so that only the layers and stimuli that are
+not cached yet are computed.
+"""
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from modules import logging
+from modules.analysis_funcs.activation_store import ActivationStore, dequantize
+from modules.analysis_funcs.activation_table import ActivationTable
+from modules.analysis_funcs.extract_activations_funcs import model_layer_name, probe_models_with_stimuli
+
+ROW_KEY = 'row_key'
+
+
+def model_fingerprint(model=None, weights_path=None, seed=None):
+    """
+    Returns a hash that identifies the weights of a model.
+
+    :param model: Model whose state_dict (names, dtypes, shapes and values of all tensors) is hashed.
+    :type model: torch.nn.Module, optional
+    :param weights_path: Weights file that is hashed instead of the state_dict (e.g., for trained models).
+    :type weights_path: str, optional
+    :param seed: Seed of the initialization, hashed as well (e.g., for untrained models).
+    :type seed: int, optional
+    :returns: Hex digest of the hash.
+    :rtype: str
+    :raises ValueError: If neither a model nor a weights file is given.
+    """
+    digest = hashlib.sha1()
+    if weights_path is not None:
+        with open(weights_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                digest.update(chunk)
+    elif model is not None:
+        digest.update(type(model).__name__.encode())
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu().contiguous()
+            digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+            digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    else:
+        raise ValueError("Either a model or a weights file is needed to compute a fingerprint.")
+    if seed is not None:
+        digest.update(f"seed:{seed}".encode())
+    return digest.hexdigest()
+
+
+def stimulus_keys(stimuli):
+    """
+    Returns one hash per stimulus, computed from all columns of its row in the stimulus table.
+
+    :param stimuli: The stimulus table (e.g., FMRIDataset.fmri_data, read from dataset.csv).
+    :type stimuli: pd.DataFrame
+    :returns: int64 keys, one per row.
+    :rtype: numpy.ndarray
+    """
+    return pd.util.hash_pandas_object(stimuli, index=False).to_numpy().view(np.int64)
+
+
+class KeyedSubset(Dataset):
+    """
+    A subset of a dataset whose items additionally carry the key of their stimulus (as 'row_key').
+    """
+    def __init__(self, dataset, indices, keys):
+        """
+        :param dataset: The dataset (yielding dictionaries).
+        :type dataset: torch.utils.data.Dataset
+        :param indices: Indices of the items of the subset.
+        :type indices: numpy.ndarray
+        :param keys: Stimulus keys of the items of the subset.
+        :type keys: numpy.ndarray
+        """
+        self.dataset = dataset
+        self.indices = np.asarray(indices)
+        self.keys = np.asarray(keys)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        item = dict(self.dataset[int(self.indices[idx])])
+        item[ROW_KEY] = int(self.keys[idx])
+        return item
+
+
+class ActivationCache:
+    """
+    A directory of cached activations, addressed by model fingerprint, stimulus key and layer name.
+
+    :ivar root: Directory of the cache.
+    :vartype root: str
+    :ivar precision: Precision at which new segments are stored (see ActivationStore).
+    :vartype precision: str
+
+    :Example:
+
+    >>> cache = ActivationCache('./results/activation_cache')
+    >>> table = probe_network_with_stimuli_cached(model, layer_names, loader, device, cache)  # slow the first time
+    >>> table = probe_network_with_stimuli_cached(model, layer_names, loader, device, cache)  # read from the cache
+    """
+    def __init__(self, root, precision='float32'):
+        """
+        :param root: Directory of the cache (created if needed).
+        :type root: str
+        :param precision: Precision at which new segments are stored ('float32', 'float16', 'bfloat16' or 'int8').
+        :type precision: str
+        """
+        self.root = root
+        self.precision = precision
+        os.makedirs(root, exist_ok=True)
+
+    def segments(self, fingerprint):
+        """
+        Returns the complete segments of a model.
+
+        :param fingerprint: Fingerprint of the model.
+        :type fingerprint: str
+        :rtype: list
+        """
+        model_dir = os.path.join(self.root, fingerprint)
+        if not os.path.isdir(model_dir):
+            return []
+        segments = []
+        for name in sorted(os.listdir(model_dir)):
+            path = os.path.join(model_dir, name)
+            if not name.startswith('.') and ActivationStore.is_store(path):
+                store = ActivationStore(path)
+                if store.complete:
+                    segments.append(store)
+        return segments
+
+    @staticmethod
+    def _positions(store, keys):
+        """
+        Returns, for every key, its (first) row in a segment, or -1.
+        """
+        segment_keys, first_rows = np.unique(store.metadata[ROW_KEY].to_numpy(dtype=np.int64), return_index=True)
+        idx = np.clip(np.searchsorted(segment_keys, keys), 0, len(segment_keys) - 1)
+        return np.where(segment_keys[idx] == keys, first_rows[idx], -1)
+
+    def coverage(self, fingerprint, keys, layers):
+        """
+        Returns which of the requested activations are cached.
+
+        :param fingerprint: Fingerprint of the model.
+        :type fingerprint: str
+        :param keys: Stimulus keys.
+        :type keys: numpy.ndarray
+        :param layers: Names of the layers.
+        :type layers: list
+        :returns: Per layer, a boolean array marking the cached stimuli.
+        :rtype: collections.OrderedDict
+        """
+        covered = OrderedDict((layer, np.zeros(len(keys), dtype=bool)) for layer in layers)
+        for store in self.segments(fingerprint):
+            positions = None
+            for layer in layers:
+                if layer in store:
+                    positions = self._positions(store, keys) if positions is None else positions
+                    covered[layer] |= positions >= 0
+        return covered
+
+    def add_segment(self, fingerprint, keys, layers):
+        """
+        Creates an (incomplete, hidden) activation store for a new segment, to be passed to commit once it is filled.
+
+        :param fingerprint: Fingerprint of the model.
+        :type fingerprint: str
+        :param keys: Stimulus keys of the rows of the segment.
+        :type keys: numpy.ndarray
+        :param layers: Names of the layers of the segment.
+        :type layers: list
+        :rtype: ActivationStore
+        """
+        digest = hashlib.sha1(np.ascontiguousarray(keys, dtype=np.int64).tobytes())
+        digest.update('\n'.join(layers).encode())
+        tmp_dir = os.path.join(self.root, fingerprint, f".{digest.hexdigest()[:16]}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return ActivationStore.create(tmp_dir, n_stimuli=len(keys), precision=self.precision)
+
+    def commit(self, store):
+        """
+        Makes a filled segment visible to lookups.
+
+        :param store: Store returned by add_segment.
+        :type store: ActivationStore
+        """
+        model_dir, tmp_name = os.path.split(store.root)
+        segment_dir = os.path.join(model_dir, tmp_name[1:-len('.tmp')])
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        os.replace(store.root, segment_dir)
+        store.root = segment_dir
+
+    def gather(self, fingerprint, keys, layers):
+        """
+        Assembles cached activations from all segments of a model.
+
+        :param fingerprint: Fingerprint of the model.
+        :type fingerprint: str
+        :param keys: Stimulus keys, in the order of the rows of the returned table.
+        :type keys: numpy.ndarray
+        :param layers: Names of the layers.
+        :type layers: list
+        :rtype: ActivationTable
+        :raises KeyError: If any of the requested activations is not cached.
+        """
+        activations, shapes, frames = OrderedDict(), {}, []
+        filled = {layer: np.zeros(len(keys), dtype=bool) for layer in layers}
+        has_metadata = np.zeros(len(keys), dtype=bool)
+        for store in self.segments(fingerprint):
+            if not any(layer in store for layer in layers):
+                continue
+            positions = self._positions(store, keys)
+            found = positions >= 0
+            rows = np.flatnonzero(found & ~has_metadata)
+            if len(rows) > 0:
+                frames.append(store.metadata.iloc[positions[rows]].set_axis(rows))
+                has_metadata[rows] = True
+            for layer in layers:
+                if layer not in store:
+                    continue
+                rows = np.flatnonzero(found & ~filled[layer])
+                if len(rows) == 0:
+                    continue
+                # Only the requested rows of the memory-mapped layer file (and int8 scales) are read and decoded
+                data, *scales = [np.load(path, mmap_mode='r') for path in store._paths(layer)]
+                if layer not in activations:
+                    activations[layer] = np.empty((len(keys), data.shape[1]), dtype=np.float32)
+                    shapes[layer] = store.shape(layer)
+                selected = positions[rows]
+                activations[layer][rows] = dequantize(
+                    data[selected], scales[0][selected] if scales else None, store.layer_precision(layer), store.shape(layer)
+                )
+                filled[layer][rows] = True
+        missing = [layer for layer in layers if not filled[layer].all()]
+        if missing:
+            raise KeyError(f"Activations of layers {missing} are not cached for all stimuli.")
+        metadata = pd.concat(frames).sort_index().reset_index(drop=True).drop(columns=[ROW_KEY])
+        return ActivationTable(metadata, OrderedDict((layer, activations[layer]) for layer in layers), shapes)
+
+
+def probe_models_with_stimuli_cached(models, layer_names, stimuli_loader, device, cache, fingerprints=None, n_workers=0):
+    """
+    Cached version of probe_models_with_stimuli: only activations that are not in the cache are computed.
+
+    Missing activations are grouped by the stimuli they lack, so that e.g. a new layer is computed for all stimuli
+    and new stimuli are computed for all layers, each in a single pass over the (subset of the) stimuli with all
+    models that need it. The results of every pass are added to the cache as new segments.
+
+    :param models: Models to probe keyed by model identifier.
+    :type models: collections.OrderedDict
+    :param layer_names: Names of the layers to probe, either for all models or as a dictionary keyed by model identifier.
+    :type layer_names: list or dict
+    :param stimuli_loader: A DataLoader of a dataset with the stimulus table in its 'fmri_data' attribute.
+    :type stimuli_loader: torch.utils.data.DataLoader
+    :param device: The computational device on which to run the models.
+    :type device: torch.device
+    :param cache: The activation cache.
+    :type cache: ActivationCache
+    :param fingerprints: Fingerprints keyed by model identifier (e.g., model_fingerprint(weights_path=..., seed=...)).
+                         Defaults to hashing the state_dict of each model.
+    :type fingerprints: dict, optional
+    :param n_workers: Number of worker processes used by probe_models_with_stimuli.
+    :type n_workers: int
+    :returns: A table with the activations of each layer of each model (named model_layer_name(model_id, layer_name))
+              and the stimuli metadata, sorted by 'stim_id'.
+    :rtype: ActivationTable
+    """
+    layer_names = layer_names if isinstance(layer_names, dict) else {model_id: layer_names for model_id in models}
+    fingerprints = dict(fingerprints or {})
+    for model_id, model in models.items():
+        if model_id not in fingerprints:
+            fingerprints[model_id] = model_fingerprint(model)
+
+    dataset = stimuli_loader.dataset
+    keys = stimulus_keys(dataset.fmri_data)
+    _, first_rows = np.unique(keys, return_index=True)
+    first_rows = np.sort(first_rows)
+
+    # Group the missing activations by the stimuli they lack: {rows: {model_id: [layers]}}
+    work = OrderedDict()
+    for model_id in models:
+        coverage = cache.coverage(fingerprints[model_id], keys[first_rows], layer_names[model_id])
+        for layer, covered in coverage.items():
+            if not covered.all():
+                rows = first_rows[~covered]
+                work.setdefault(rows.tobytes(), OrderedDict()).setdefault(model_id, []).append(layer)
+
+    if not work:
+        logging.info("All activations were found in the cache.")
+    for rows, model_layers in work.items():
+        rows = np.frombuffer(rows, dtype=first_rows.dtype)
+        logging.info(f"Computing {sum(len(layers) for layers in model_layers.values())} missing layer(s) of "
+                     f"{len(model_layers)} model(s) for {len(rows)} of {len(keys)} stimuli.")
+        loader = DataLoader(
+            KeyedSubset(dataset, rows, keys[rows]),
+            batch_size=stimuli_loader.batch_size,
+            shuffle=False,
+            num_workers=stimuli_loader.num_workers,
+            pin_memory=stimuli_loader.pin_memory,
+        )
+        stores = OrderedDict(
+            (model_id, cache.add_segment(fingerprints[model_id], keys[rows], layers)) for model_id, layers in model_layers.items()
+        )
+        probe_models_with_stimuli(
+            OrderedDict((model_id, models[model_id]) for model_id in model_layers), model_layers, loader, device,
+            store=stores, n_workers=n_workers,
+        )
+        for store in stores.values():
+            cache.commit(store)
+
+    # Assemble the requested activations of all models from the cache
+    table = None
+    for model_id in models:
+        model_table = cache.gather(fingerprints[model_id], keys, layer_names[model_id])
+        if table is None:
+            table = ActivationTable(model_table.metadata, OrderedDict())
+        for layer in model_table.layers:
+            table.add_layer(model_layer_name(model_id, layer), model_table[layer], model_table.shapes[layer])
+    return table.sort_by('stim_id')
+
+
+def probe_network_with_stimuli_cached(model, layer_names, stimuli_loader, device, cache, fingerprint=None):
+    """
+    Cached version of probe_network_with_stimuli: only activations that are not in the cache are computed.
+
+    :param model: The neural network model to probe.
+    :type model: torch.nn.Module
+    :param layer_names: A list of string names representing the layers to probe in the model.
+    :type layer_names: list
+    :param stimuli_loader: A DataLoader of a dataset with the stimulus table in its 'fmri_data' attribute.
+    :type stimuli_loader: torch.utils.data.DataLoader
+    :param device: The computational device (e.g., CPU or CUDA) on which to run the model.
+    :type device: torch.device
+    :param cache: The activation cache.
+    :type cache: ActivationCache
+    :param fingerprint: Fingerprint of the model. Defaults to a hash of its state_dict.
+    :type fingerprint: str, optional
+    :returns: A table with the (n_stimuli, n_features) activations of each layer and the stimuli metadata, sorted by 'stim_id'.
+    :rtype: ActivationTable
+    """
+    model_id = 'model'
+    table = probe_models_with_stimuli_cached(
+        OrderedDict([(model_id, model)]), layer_names, stimuli_loader, device, cache,
+        fingerprints={model_id: fingerprint} if fingerprint is not None else None,
+    )
+    return ActivationTable(
+        table.metadata,
+        OrderedDict((layer, table[model_layer_name(model_id, layer)]) for layer in layer_names),
+        {layer: table.shapes[model_layer_name(model_id, layer)] for layer in layer_names},
+    )
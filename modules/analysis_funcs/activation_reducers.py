@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Online reductions of network activations.
+
+Reducers consume the (batch_size, n_features) activations of every layer as they come off the forward hooks
+of probe_network_with_stimuli, so that summaries of a layer (moments, PCA bases, Gram matrices, RDMs, random
+projections) are computed as the stimuli are probed. Moments and PCA bases never hold the full (n_stimuli,
+n_features) activations. Gram matrices and RDMs are exact by default and therefore keep all (float32) rows of a
+layer; with n_components set, they keep a random-projection sketch of n_stimuli * n_components floats instead and
+become approximations (see RandomProjectionReducer).
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from scipy.spatial.distance import pdist, squareform
+from sklearn.decomposition import PCA, IncrementalPCA
+
+from modules.analysis_funcs.rdm_funcs import safe_normalize_rdm
+
+
+class ActivationReducer(ABC):
+    """
+    Base class of all reducers. Subclasses keep one state per layer.
+
+    :ivar name: Key of the results of the reducer in the output of probe_network_with_stimuli.
+    :vartype name: str
+    """
+    name = 'reducer'
+
+    def __init__(self, name=None):
+        """
+        Initializes the reducer.
+
+        :param name: Key of the results of the reducer. Defaults to the name of the class.
+        :type name: str, optional
+        """
+        if name is not None:
+            self.name = name
+        self.states = OrderedDict()
+
+    @abstractmethod
+    def update(self, layer, X):
+        """
+        Consumes the activations of a batch.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :param X: Flattened activations of shape (batch_size, n_features), on the device of the model.
+        :type X: torch.Tensor
+        """
+
+    @abstractmethod
+    def result(self, order=None):
+        """
+        Returns the results of all layers.
+
+        :param order: Permutation that sorts the stimuli (in the order in which they were consumed) by stim_id.
+                      Only used by reducers with per-stimulus results.
+        :type order: numpy.ndarray, optional
+        :rtype: collections.OrderedDict
+        """
+
+
+class WelfordReducer(ActivationReducer):
+    """
+    Running per-feature mean and variance (Welford's algorithm, merged batch-wise as in Chan et al.).
+    """
+    name = 'moments'
+
+    def __init__(self, ddof=1, name=None):
+        """
+        :param ddof: Delta degrees of freedom of the variance.
+        :type ddof: int
+        :param name: Key of the results of the reducer.
+        :type name: str, optional
+        """
+        super().__init__(name)
+        self.ddof = ddof
+
+    def update(self, layer, X):
+        X = X.double()
+        n_b = X.shape[0]
+        mean_b = X.mean(dim=0)
+        m2_b = ((X - mean_b) ** 2).sum(dim=0)
+        if layer not in self.states:
+            self.states[layer] = [n_b, mean_b, m2_b]
+            return
+        n_a, mean_a, m2_a = self.states[layer]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        self.states[layer] = [n, mean_a + delta * (n_b / n), m2_a + m2_b + delta ** 2 * (n_a * n_b / n)]
+
+    def result(self, order=None):
+        """
+        :returns: Per layer, a dictionary with the number of stimuli 'n' and the per-feature 'mean' and 'var'.
+        :rtype: collections.OrderedDict
+        """
+        return OrderedDict(
+            (layer, {'n': n, 'mean': mean.cpu().numpy(), 'var': (m2 / max(n - self.ddof, 1)).cpu().numpy()})
+            for layer, (n, mean, m2) in self.states.items()
+        )
+
+
+class IncrementalPCAReducer(ActivationReducer):
+    """
+    Fits a PCA basis per layer with sklearn's IncrementalPCA.
+
+    Batches are buffered until at least fit_batch_size + n_components rows are available (IncrementalPCA needs
+    at least n_components rows per partial fit), so that the rows left over at the end can always be fitted.
+    Layers whose stimuli never fill a first partial fit (e.g., the 40 stimuli of the fMRI dataset) are fitted with
+    an exact PCA of the buffered rows instead. The number of components is capped at the number of features and,
+    for the exact PCA, at the number of stimuli.
+    """
+    name = 'pca'
+
+    def __init__(self, n_components=20, fit_batch_size=None, name=None, **kwargs):
+        """
+        :param n_components: Number of principal components to keep.
+        :type n_components: int
+        :param fit_batch_size: Number of rows per partial fit. Defaults to 5 * n_components.
+        :type fit_batch_size: int, optional
+        :param name: Key of the results of the reducer.
+        :type name: str, optional
+        :param kwargs: Further arguments of sklearn.decomposition.IncrementalPCA (e.g., whiten).
+        """
+        super().__init__(name)
+        self.n_components = n_components
+        self.fit_batch_size = fit_batch_size or 5 * n_components
+        self.kwargs = kwargs
+
+    def update(self, layer, X):
+        if layer not in self.states:
+            n_components = min(self.n_components, X.shape[1])
+            self.states[layer] = [IncrementalPCA(n_components=n_components, **self.kwargs), []]
+        pca, buffer = self.states[layer]
+        buffer.append(X.float().cpu().numpy())
+        if sum(len(rows) for rows in buffer) >= self.fit_batch_size + pca.n_components:
+            rows = np.concatenate(buffer)
+            pca.partial_fit(rows[:self.fit_batch_size])
+            self.states[layer][1] = [rows[self.fit_batch_size:]]
+
+    def result(self, order=None):
+        """
+        :returns: Per layer, the fitted IncrementalPCA (or, for few stimuli, PCA) object (components_,
+                  explained_variance_ratio_, transform, ...).
+        :rtype: collections.OrderedDict
+        """
+        results = OrderedDict()
+        for layer, (pca, buffer) in self.states.items():
+            if buffer:
+                rows = np.concatenate(buffer)
+                if hasattr(pca, 'components_'):
+                    pca.partial_fit(rows)
+                else:
+                    # Too few rows for a first partial fit: exact PCA of all rows
+                    pca = PCA(n_components=min(pca.n_components, *rows.shape), whiten=self.kwargs.get('whiten', False))
+                    pca.fit(rows)
+                    self.states[layer][0] = pca
+                self.states[layer][1] = []
+            results[layer] = pca
+        return results
+
+
+class RandomProjectionReducer(ActivationReducer):
+    """
+    Gaussian random projection (Johnson-Lindenstrauss sketch) of the activations of every stimulus.
+
+    Each batch is multiplied on the device of the model with a fixed (n_features, n_components) matrix whose
+    entries are drawn from N(0, 1 / n_components), which preserves inner products and distances in expectation.
+    Layers with at most n_components features are kept as they are.
+
+    Memory: n_stimuli * min(n_components, n_features) float32 values per layer, plus one (n_features, n_components)
+    projection matrix. Error: the squared norm (or squared distance) of a projected vector is its true value times
+    chi2(n_components) / n_components, i.e. it has a relative standard deviation of sqrt(2 / n_components) (4.4% for
+    1024 components); for n stimuli, all pairwise squared distances are within a factor 1 +- eps with high probability
+    once n_components is of the order of 8 * log(n) / eps ** 2.
+    """
+    name = 'projection'
+
+    def __init__(self, n_components=1024, seed=0, name=None):
+        """
+        :param n_components: Dimensionality of the sketch, or None to keep all features (exact, but memory then
+                             scales with n_stimuli * n_features).
+        :type n_components: int, optional
+        :param seed: Seed of the projection matrices (one per layer, all drawn from the same seed).
+        :type seed: int
+        :param name: Key of the results of the reducer.
+        :type name: str, optional
+        """
+        super().__init__(name)
+        self.n_components = n_components
+        self.seed = seed
+        self.projections = {}
+
+    def _projection(self, layer, X):
+        if layer not in self.projections:
+            n_features = X.shape[1]
+            if self.n_components is None or n_features <= self.n_components:
+                self.projections[layer] = None
+            else:
+                generator = torch.Generator().manual_seed(self.seed)
+                R = torch.randn(n_features, self.n_components, generator=generator) / np.sqrt(self.n_components)
+                self.projections[layer] = R.to(X.device)
+        return self.projections[layer]
+
+    def _preprocess(self, X):
+        return X.float()
+
+    def update(self, layer, X):
+        X = self._preprocess(X)
+        R = self._projection(layer, X)
+        self.states.setdefault(layer, []).append((X if R is None else X @ R).cpu().numpy())
+
+    def sketch(self, layer, order=None):
+        """
+        Returns the (n_stimuli, n_components) sketch of a layer.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :param order: Permutation of the rows.
+        :type order: numpy.ndarray, optional
+        :rtype: numpy.ndarray
+        """
+        P = np.concatenate(self.states[layer])
+        return P if order is None else P[order]
+
+    def result(self, order=None):
+        """
+        :returns: Per layer, the (n_stimuli, n_components) projected activations sorted by stim_id.
+        :rtype: collections.OrderedDict
+        """
+        return OrderedDict((layer, self.sketch(layer, order)) for layer in self.states)
+
+
+class GramReducer(RandomProjectionReducer):
+    """
+    (n_stimuli, n_stimuli) Gram matrix of inner products between the activations of all stimuli.
+
+    By default the Gram matrix is exact, and all rows of a layer (n_stimuli * n_features float32 values, the size
+    of the activations themselves) are kept until the result is computed. With n_components set, it is computed
+    from the random-projection sketch instead (memory n_stimuli * n_components), and every inner product <x, y> is
+    an unbiased estimate with standard deviation sqrt((|x|^2 |y|^2 + <x, y>^2) / n_components).
+    """
+    name = 'gram'
+
+    def __init__(self, n_components=None, seed=0, name=None):
+        """
+        :param n_components: Dimensionality of the random-projection sketch, or None for the exact Gram matrix.
+        :type n_components: int, optional
+        :param seed: Seed of the projection matrices.
+        :type seed: int
+        :param name: Key of the results of the reducer.
+        :type name: str, optional
+        """
+        super().__init__(n_components, seed, name)
+
+    def result(self, order=None):
+        """
+        :returns: Per layer, the Gram matrix (approximate if n_components is set) sorted by stim_id.
+        :rtype: collections.OrderedDict
+        """
+        results = OrderedDict()
+        for layer in self.states:
+            P = self.sketch(layer, order).astype(np.float64)
+            results[layer] = P @ P.T
+        return results
+
+
+class RDMReducer(RandomProjectionReducer):
+    """
+    Representational dissimilarity matrix of every layer.
+
+    By default the RDM is exact and matches compute_rdm, and all rows of a layer (n_stimuli * n_features float32
+    values) are kept until the result is computed. With n_components set, it is computed from the random-projection
+    sketch instead (memory n_stimuli * n_components), and every squared distance deviates from the exact one by a
+    relative standard deviation of about sqrt(2 / n_components) (see RandomProjectionReducer), which changes RSA
+    results accordingly. For 'pearson', every activation vector is centred before it is (optionally) projected, so
+    that the correlation distance 1 - r equals the cosine distance between the (sketched) vectors.
+    """
+    name = 'rdm'
+
+    def __init__(self, distance_metric='euclidean', rescale=True, n_components=None, seed=0, name=None):
+        """
+        :param distance_metric: Distance metric ('euclidean' or 'pearson').
+        :type distance_metric: str
+        :param rescale: Rescale RDMs to 0-1 range (excluding the diagonal), as in compute_rdm.
+        :type rescale: bool
+        :param n_components: Dimensionality of the random-projection sketch, or None to compute exact RDMs.
+        :type n_components: int, optional
+        :param seed: Seed of the projection matrices.
+        :type seed: int
+        :param name: Key of the results of the reducer.
+        :type name: str, optional
+        """
+        if distance_metric not in ('euclidean', 'pearson'):
+            raise ValueError("Invalid distance metric specified.")
+        super().__init__(n_components, seed, name)
+        self.distance_metric = distance_metric
+        self.rescale = rescale
+
+    def _preprocess(self, X):
+        X = X.float()
+        if self.distance_metric == 'pearson':
+            X = X - X.mean(dim=1, keepdim=True)
+        return X
+
+    def result(self, order=None):
+        """
+        :returns: Per layer, the RDM (approximate if n_components is set) sorted by stim_id.
+        :rtype: collections.OrderedDict
+        """
+        results = OrderedDict()
+        for layer in self.states:
+            P = self.sketch(layer, order).astype(np.float64)
+            rdm = squareform(pdist(P, metric='euclidean' if self.distance_metric == 'euclidean' else 'cosine'))
+            if self.rescale:
+                rdm = safe_normalize_rdm(rdm)
+            np.fill_diagonal(rdm, 0)
+            results[layer] = rdm
+        return results
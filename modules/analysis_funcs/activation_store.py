@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk storage of network activations.
+
+An activation store is a directory with one memory-mappable .npy file of shape (n_stimuli, n_features)
+per layer, a 'stimuli.csv' file with the metadata of all stimuli, and a 'manifest.json' file that lists
+the layers, their files and their per-stimulus shapes. Activations are streamed into the layer files while
+they are extracted, and any layer can later be read without loading the others.
+
+Layers can be stored at reduced precision to save disk space and memory: 'float16', 'bfloat16' (kept as the
+upper 16 bits of float32 in a uint16 file, as numpy has no bfloat16 type) or 'int8' (symmetric quantization
+with one float32 scale per stimulus and channel, kept in a separate '.scales.npy' file). Activations are
+quantized on write and dequantized to float32 on read. precision_report measures how much the RDMs of each
+layer deviate from float32 at every precision.
+"""
+import json
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from modules.analysis_funcs.activation_table import ActivationTable
+from modules.analysis_funcs.rdm_funcs import compute_rdm
+
+MANIFEST = 'manifest.json'
+STIMULI = 'stimuli.csv'
+PRECISIONS = ('float32', 'float16', 'bfloat16', 'int8')
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16, 'int8': np.int8}
+
+
+def n_channels_(shape):
+    """
+    Number of channels (first per-stimulus dimension) that get their own int8 scale; 1 for vectors.
+    """
+    return int(shape[0]) if len(shape) > 1 else 1
+
+def quantize(X, precision, shape):
+    """
+    Encodes flattened float32 activations at the given precision.
+
+    :param X: Activations of shape (n_stimuli, n_features).
+    :type X: numpy.ndarray
+    :param precision: One of 'float32', 'float16', 'bfloat16' or 'int8'.
+    :type precision: str
+    :param shape: Per-stimulus shape of the activations before flattening (channels first).
+    :type shape: tuple
+    :returns: The encoded activations and, for 'int8', the (n_stimuli, n_channels) scales (else None).
+    :rtype: tuple
+    """
+    X = np.asarray(X, dtype=np.float32)
+    if precision == 'float32':
+        return X, None
+    if precision == 'float16':
+        return X.astype(np.float16), None
+    if precision == 'bfloat16':
+        # Round to nearest even on the upper 16 bits of the float32 bit pattern
+        bits = X.view(np.uint32)
+        return ((bits + np.uint32(0x7FFF) + ((bits >> 16) & 1)) >> 16).astype(np.uint16), None
+    if precision == 'int8':
+        X = X.reshape(len(X), n_channels_(shape), -1)
+        scales = np.abs(X).max(axis=2) / 127
+        inv_scales = np.divide(1, scales, out=np.zeros_like(scales), where=scales > 0)
+        Q = np.clip(np.rint(X * inv_scales[:, :, None]), -127, 127).astype(np.int8)
+        return Q.reshape(len(X), -1), scales.astype(np.float32)
+    raise ValueError(f"Unknown precision '{precision}'. Choose one of {PRECISIONS}.")
+
+def dequantize(data, scales, precision, shape):
+    """
+    Decodes activations encoded by quantize into float32.
+
+    :param data: Encoded activations of shape (n_stimuli, n_features).
+    :type data: numpy.ndarray
+    :param scales: The (n_stimuli, n_channels) scales for 'int8', else None.
+    :type scales: numpy.ndarray
+    :param precision: One of 'float32', 'float16', 'bfloat16' or 'int8'.
+    :type precision: str
+    :param shape: Per-stimulus shape of the activations before flattening.
+    :type shape: tuple
+    :rtype: numpy.ndarray
+    """
+    if precision == 'float32':
+        return data
+    if precision == 'float16':
+        return np.asarray(data, dtype=np.float32)
+    if precision == 'bfloat16':
+        return (np.asarray(data).astype(np.uint32) << 16).view(np.float32)
+    if precision == 'int8':
+        X = np.asarray(data, dtype=np.float32).reshape(len(data), n_channels_(shape), -1) * np.asarray(scales)[:, :, None]
+        return X.reshape(len(data), -1)
+    raise ValueError(f"Unknown precision '{precision}'. Choose one of {PRECISIONS}.")
+
+
+class QuantizedWriter:
+    """
+    Writable view of a reduced-precision layer file that quantizes float32 rows as they are assigned.
+
+    :Example:
+
+    >>> writer = store.allocate('conv1', (256, 8, 8), precision='int8')
+    >>> writer[0:40] = X  # (40, 16384) float32 activations
+    """
+    def __init__(self, data, scales, precision, shape):
+        """
+        :param data: Memory map of the encoded activations.
+        :type data: numpy.memmap
+        :param scales: Memory map of the int8 scales, or None.
+        :type scales: numpy.memmap
+        :param precision: Precision of the layer.
+        :type precision: str
+        :param shape: Per-stimulus shape of the activations before flattening.
+        :type shape: tuple
+        """
+        self.data = data
+        self.scales = scales
+        self.precision = precision
+        self.shape = data.shape
+        self.item_shape = tuple(shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, rows, X):
+        data, scales = quantize(np.asarray(X).reshape(-1, self.shape[1]), self.precision, self.item_shape)
+        self.data[rows] = data
+        if scales is not None:
+            self.scales[rows] = scales
+
+    def __getitem__(self, rows):
+        scales = self.scales[rows] if self.scales is not None else None
+        return dequantize(self.data[rows], scales, self.precision, self.item_shape)
+
+    def flush(self):
+        self.data.flush()
+        if self.scales is not None:
+            self.scales.flush()
+
+
+class ActivationStore:
+    """
+    A directory of per-layer activation files with a shared stimuli table.
+
+    :ivar root: Directory of the store.
+    :vartype root: str
+    :ivar manifest: Number of stimuli, default precision and file, shape, dtype and precision of every layer.
+    :vartype manifest: dict
+
+    :Example:
+
+    >>> store = ActivationStore.create('./results/activations_model-trained_seed-0', n_stimuli=len(dataset))
+    >>> table = probe_network_with_stimuli(model, layer_names, loader, device, store=store)
+    >>> X = ActivationStore('./results/activations_model-trained_seed-0').load('conv1')  # memory-mapped
+    """
+    def __init__(self, root):
+        """
+        Opens an existing activation store.
+
+        :param root: Directory of the store.
+        :type root: str
+        :raises FileNotFoundError: If the directory does not contain a manifest.
+        """
+        self.root = root
+        with open(os.path.join(root, MANIFEST), 'r') as f:
+            self.manifest = json.load(f, object_pairs_hook=OrderedDict)
+        self._metadata = None
+        self._buffers = {}
+
+    @classmethod
+    def create(cls, root, n_stimuli, precision='float32'):
+        """
+        Creates an empty activation store (replacing the manifest of an existing one).
+
+        :param root: Directory of the store.
+        :type root: str
+        :param n_stimuli: Number of stimuli that will be written.
+        :type n_stimuli: int
+        :param precision: Default precision of the layers ('float32', 'float16', 'bfloat16' or 'int8').
+        :type precision: str
+        :rtype: ActivationStore
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}'. Choose one of {PRECISIONS}.")
+        os.makedirs(root, exist_ok=True)
+        manifest = OrderedDict([
+            ('n_stimuli', int(n_stimuli)), ('complete', False), ('precision', precision), ('layers', OrderedDict())
+        ])
+        with open(os.path.join(root, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return cls(root)
+
+    @staticmethod
+    def is_store(path):
+        """
+        Returns whether a directory is an activation store.
+
+        :param path: Path to check.
+        :type path: str
+        :rtype: bool
+        """
+        return os.path.isfile(os.path.join(path, MANIFEST))
+
+    def __contains__(self, layer):
+        return layer in self.manifest['layers']
+
+    def __len__(self):
+        return self.manifest['n_stimuli']
+
+    @property
+    def layers(self):
+        return list(self.manifest['layers'].keys())
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    @property
+    def precision(self):
+        return self.manifest.get('precision', 'float32')
+
+    @property
+    def metadata(self):
+        """
+        The stimuli table (read once on first access).
+
+        :rtype: pd.DataFrame
+        """
+        if self._metadata is None:
+            self._metadata = pd.read_csv(os.path.join(self.root, STIMULI))
+        return self._metadata
+
+    def shape(self, layer):
+        """
+        Per-stimulus shape of the activations of a layer before flattening.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :rtype: tuple
+        """
+        return tuple(self.manifest['layers'][layer]['shape'])
+
+    def layer_precision(self, layer):
+        """
+        Precision at which a layer is stored.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :rtype: str
+        """
+        return self.manifest['layers'][layer].get('precision', 'float32')
+
+    def nbytes(self, layer):
+        """
+        Size of the files of a layer on disk.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :rtype: int
+        """
+        return sum(os.path.getsize(path) for path in self._paths(layer))
+
+    def _paths(self, layer):
+        info = self.manifest['layers'][layer]
+        return [os.path.join(self.root, info[key]) for key in ('file', 'scales_file') if info.get(key)]
+
+    def _save_manifest(self):
+        tmp_path = os.path.join(self.root, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.root, MANIFEST))
+
+    def _file_name(self, layer):
+        return f"{len(self.manifest['layers']):03d}_{re.sub(r'[^A-Za-z0-9_.-]', '_', layer)}.npy"
+
+    def allocate(self, layer, shape, dtype=np.float32, precision=None):
+        """
+        Creates the memory-mapped (n_stimuli, n_features) file of a layer, to be filled while extracting.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :param shape: Per-stimulus shape of the activations. Activations are stored flattened.
+        :type shape: tuple
+        :param dtype: Dtype of the stored activations at full precision.
+        :type dtype: numpy.dtype
+        :param precision: Precision of the layer. Defaults to the precision of the store.
+        :type precision: str, optional
+        :returns: The writable memory map, or a QuantizedWriter for reduced precisions.
+        :rtype: numpy.memmap or QuantizedWriter
+        """
+        precision = precision or self.precision
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}'. Choose one of {PRECISIONS}.")
+        file_name = self.manifest['layers'][layer]['file'] if layer in self else self._file_name(layer)
+        storage_dtype = dtype if precision == 'float32' else STORAGE_DTYPES[precision]
+        n_features = int(np.prod(shape))
+        info = OrderedDict([
+            ('file', file_name),
+            ('shape', [int(s) for s in shape]),
+            ('dtype', np.dtype(storage_dtype).name),
+            ('precision', precision),
+        ])
+        data = np.lib.format.open_memmap(
+            os.path.join(self.root, file_name), mode='w+', dtype=storage_dtype, shape=(len(self), n_features)
+        )
+        scales = None
+        if precision == 'int8':
+            info['scales_file'] = file_name[:-len('.npy')] + '.scales.npy'
+            scales = np.lib.format.open_memmap(
+                os.path.join(self.root, info['scales_file']), mode='w+', dtype=np.float32, shape=(len(self), n_channels_(shape))
+            )
+        self.manifest['layers'][layer] = info
+        self.manifest['complete'] = False
+        self._save_manifest()
+        buffer = data if precision == 'float32' else QuantizedWriter(data, scales, precision, shape)
+        self._buffers[layer] = buffer
+        return buffer
+
+    def writer(self, layer):
+        """
+        Opens the file(s) of an allocated layer for writing, e.g., from another process.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :returns: The writable memory map, or a QuantizedWriter for reduced precisions.
+        :rtype: numpy.memmap or QuantizedWriter
+        """
+        precision = self.layer_precision(layer)
+        maps = [np.load(path, mmap_mode='r+') for path in self._paths(layer)]
+        if precision == 'float32':
+            return maps[0]
+        return QuantizedWriter(maps[0], maps[1] if len(maps) > 1 else None, precision, self.shape(layer))
+
+    def write_metadata(self, metadata):
+        """
+        Writes the stimuli table.
+
+        :param metadata: One row per stimulus, in the order of the rows of the layer files.
+        :type metadata: pd.DataFrame
+        """
+        metadata.to_csv(os.path.join(self.root, STIMULI), index=False)
+        self._metadata = metadata.reset_index(drop=True)
+
+    def finalize(self, sort_by='stim_id'):
+        """
+        Flushes all layer files, sorts rows by a metadata column (one layer at a time) and marks the store
+        as complete.
+
+        :param sort_by: Metadata column to sort rows by, or None to keep the order of extraction.
+        :type sort_by: str, optional
+        """
+        metadata = self.metadata
+        order = None
+        if sort_by is not None and sort_by in metadata:
+            order = np.argsort(metadata[sort_by].to_numpy(), kind='stable')
+            if np.all(order == np.arange(len(order))):
+                order = None
+        for layer in self.layers:
+            buffer = self._buffers.pop(layer, None)
+            if buffer is not None:
+                buffer.flush()
+                del buffer
+            if order is None:
+                continue
+            # Sort the encoded rows (and int8 scales) as they are stored
+            for path in self._paths(layer):
+                stored = np.load(path, mmap_mode='r+')
+                stored[:] = stored[order]
+                stored.flush()
+                del stored
+        if order is not None:
+            self.write_metadata(metadata.iloc[order])
+        self.manifest['complete'] = True
+        self._save_manifest()
+
+    def load(self, layer, mmap=True, decode=True):
+        """
+        Loads the (n_stimuli, n_features) activations of a single layer.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :param mmap: Whether to memory-map the file (read-only) instead of reading it into memory. Layers stored at
+                     reduced precision are memory-mapped, but dequantizing them creates a float32 copy in memory.
+        :type mmap: bool
+        :param decode: Whether to dequantize layers stored at reduced precision into float32.
+        :type decode: bool
+        :rtype: numpy.ndarray
+        """
+        maps = [np.load(path, mmap_mode='r' if mmap else None) for path in self._paths(layer)]
+        precision = self.layer_precision(layer)
+        if not decode or precision == 'float32':
+            return maps[0]
+        return dequantize(maps[0], maps[1] if len(maps) > 1 else None, precision, self.shape(layer))
+
+    def table(self, layers=None, mmap=True):
+        """
+        Returns (a subset of) the layers as an ActivationTable backed by the layer files.
+
+        :param layers: Name or list of names of layers. Defaults to all layers.
+        :type layers: str or list, optional
+        :param mmap: Whether to memory-map the layer files.
+        :type mmap: bool
+        :rtype: ActivationTable
+        """
+        layers = self.layers if layers is None else (layers if isinstance(layers, list) else [layers])
+        activations = OrderedDict((layer, self.load(layer, mmap)) for layer in layers)
+        return ActivationTable(self.metadata, activations, {layer: self.shape(layer) for layer in layers})
+
+    @classmethod
+    def from_table(cls, root, table, precision='float32'):
+        """
+        Writes an ActivationTable to a new activation store.
+
+        :param root: Directory of the store.
+        :type root: str
+        :param table: The activations to store.
+        :type table: ActivationTable
+        :param precision: Precision of all layers, or a dictionary of precisions keyed by layer name
+                          (e.g., the cheapest precisions within tolerance from select_precision).
+        :type precision: str or dict
+        :rtype: ActivationStore
+        """
+        store = cls.create(root, len(table), precision if isinstance(precision, str) else 'float32')
+        for layer, X in table.items():
+            layer_precision = precision.get(layer, 'float32') if isinstance(precision, dict) else precision
+            store.allocate(layer, table.shapes[layer], X.dtype, layer_precision)[:] = X
+        store.write_metadata(table.metadata)
+        store.finalize(sort_by=None)
+        return store
+
+
+def precision_report(activations, precisions=('float16', 'bfloat16', 'int8'), layers=None, distance_metric='pearson', rescale=True):
+    """
+    Measures, per layer, how much storing the activations at reduced precision changes their RDMs.
+
+    Every layer is quantized and dequantized in memory at each precision, and its RDM (computed with compute_rdm)
+    is compared with the RDM of the float32 activations.
+
+    :param activations: The float32 activations.
+    :type activations: ActivationTable or ActivationStore
+    :param precisions: Reduced precisions to evaluate.
+    :type precisions: tuple
+    :param layers: Layers to evaluate. Defaults to all layers.
+    :type layers: list, optional
+    :param distance_metric: Distance metric of the RDMs ('euclidean', 'mahalanobis', or 'pearson').
+    :type distance_metric: str
+    :param rescale: Whether RDMs are rescaled to 0-1 range, as in compute_rdm.
+    :type rescale: bool
+    :returns: One row per layer and precision with the bytes per stimulus, the compression relative to float32,
+              the maximum absolute activation error, the maximum absolute RDM deviation and the correlation of the
+              RDMs (lower triangles).
+    :rtype: pd.DataFrame
+    """
+    rows = []
+    layers = layers or activations.layers
+    for layer in layers:
+        table = activations.table(layer) if isinstance(activations, ActivationStore) else activations.select(layer)
+        X, shape = table[layer], table.shapes[layer]
+        rdm = compute_rdm(table, distance_metric=distance_metric, rescale=rescale, layer_name=layer)
+        tril = np.tril_indices(len(rdm), k=-1)
+        for precision in precisions:
+            data, scales = quantize(X, precision, shape)
+            X_q = dequantize(data, scales, precision, shape)
+            rdm_q = compute_rdm(table.with_layer(layer, X_q), distance_metric=distance_metric, rescale=rescale, layer_name=layer)
+            n_bytes = data.nbytes + (scales.nbytes if scales is not None else 0)
+            rows.append(OrderedDict([
+                ('layer', layer),
+                ('precision', precision),
+                ('bytes_per_stimulus', n_bytes / len(X)),
+                ('compression', X.shape[1] * 4 * len(X) / n_bytes),
+                ('max_activation_error', float(np.max(np.abs(X_q - X))) if X.size else 0.),
+                ('max_rdm_deviation', float(np.max(np.abs(rdm_q - rdm)))),
+                ('rdm_correlation', float(np.corrcoef(rdm[tril], rdm_q[tril])[0, 1])),
+            ]))
+    return pd.DataFrame(rows)
+
+def select_precision(report, tolerance):
+    """
+    Returns the cheapest precision of each layer whose maximum RDM deviation stays within a tolerance.
+
+    :param report: Output of precision_report.
+    :type report: pd.DataFrame
+    :param tolerance: Maximum absolute RDM deviation.
+    :type tolerance: float
+    :returns: Precisions keyed by layer name ('float32' if no reduced precision is within tolerance), which can be
+              passed to ActivationStore.from_table.
+    :rtype: collections.OrderedDict
+    """
+    precisions = OrderedDict()
+    for layer, rows in report.groupby('layer', sort=False):
+        rows = rows[rows['max_rdm_deviation'] <= tolerance].sort_values('bytes_per_stimulus', kind='stable')
+        precisions[layer] = rows['precision'].iloc[0] if len(rows) else 'float32'
+    return precisions
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar storage of network activations.
+
+Activations of every layer are held in one contiguous float32 array of shape (n_stimuli, n_features),
+and all stimulus information (stim_id, strategy, filename, ...) lives in a single metadata frame that
+is shared by all layers. Analyses take views of these arrays instead of re-stacking per-stimulus arrays.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+
+
+class ActivationTable:
+    """
+    Per-layer activation matrices that share one metadata frame.
+
+    Row i of every layer belongs to row i of the metadata frame. Tables are sorted by 'stim_id' when they
+    are built by probe_network_with_stimuli.
+
+    :ivar metadata: One row per stimulus with all (scalar) stimulus fields.
+    :vartype metadata: pd.DataFrame
+    :ivar activations: Flattened float32 activations of shape (n_stimuli, n_features), keyed by layer name.
+    :vartype activations: collections.OrderedDict
+    :ivar shapes: Per-stimulus shape of the activations of each layer before flattening.
+    :vartype shapes: dict
+
+    :Example:
+
+    >>> table = probe_network_with_stimuli(model, layer_names, loader, device)
+    >>> X = table['conv1']  # (n_stimuli, n_features) view
+    >>> strategies = table.metadata['strategy'].to_numpy()
+    """
+    def __init__(self, metadata, activations, shapes=None):
+        """
+        Initializes the ActivationTable object.
+
+        :param metadata: One row per stimulus.
+        :type metadata: pd.DataFrame
+        :param activations: Activations of shape (n_stimuli, ...) keyed by layer name. Arrays are flattened
+                            to (n_stimuli, n_features) without copying whenever they are already contiguous.
+        :type activations: dict
+        :param shapes: Per-stimulus shape of the activations before flattening, keyed by layer name.
+        :type shapes: dict, optional
+        """
+        self.metadata = metadata.reset_index(drop=True)
+        self.activations = OrderedDict()
+        self.shapes = dict(shapes or {})
+        for layer, X in activations.items():
+            self.add_layer(layer, X, self.shapes.get(layer))
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __contains__(self, layer):
+        return layer in self.activations
+
+    def __getitem__(self, layer):
+        return self.activations[layer]
+
+    def __iter__(self):
+        return iter(self.activations)
+
+    @property
+    def layers(self):
+        return list(self.activations.keys())
+
+    @property
+    def stim_ids(self):
+        return self.metadata['stim_id'].to_numpy()
+
+    def items(self):
+        return self.activations.items()
+
+    def add_layer(self, layer, X, shape=None):
+        """
+        Adds (or replaces) the activations of a layer.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :param X: Activations of shape (n_stimuli, ...).
+        :type X: numpy.ndarray
+        :param shape: Per-stimulus shape before flattening. Defaults to X.shape[1:].
+        :type shape: tuple, optional
+        """
+        if len(X) != len(self.metadata):
+            raise ValueError(f"Layer '{layer}' has {len(X)} rows, but the table has {len(self.metadata)} stimuli.")
+        self.shapes[layer] = tuple(shape) if shape is not None else tuple(X.shape[1:])
+        self.activations[layer] = np.ascontiguousarray(X, dtype=np.float32).reshape(len(X), -1)
+
+    def reshaped(self, layer):
+        """
+        Returns a view of the activations of a layer in their original (n_stimuli, ...) shape.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :rtype: numpy.ndarray
+        """
+        return self.activations[layer].reshape(len(self), *self.shapes[layer])
+
+    def with_layer(self, layer, X):
+        """
+        Returns a new table in which the activations of one layer are replaced (e.g., by a reduced version).
+
+        The metadata frame and all other layers are shared with this table and not copied.
+
+        :param layer: Name of the layer.
+        :type layer: str
+        :param X: New activations of shape (n_stimuli, ...).
+        :type X: numpy.ndarray
+        :rtype: ActivationTable
+        """
+        table = ActivationTable.__new__(ActivationTable)
+        table.metadata = self.metadata
+        table.activations = OrderedDict(self.activations)
+        table.shapes = dict(self.shapes)
+        table.add_layer(layer, X)
+        return table
+
+    def select(self, layers):
+        """
+        Returns a table that only contains the given layers (sharing all arrays with this table).
+
+        :param layers: Name or list of names of layers.
+        :type layers: str or list
+        :rtype: ActivationTable
+        """
+        layers = layers if isinstance(layers, list) else [layers]
+        return ActivationTable(self.metadata, OrderedDict((layer, self.activations[layer]) for layer in layers), self.shapes)
+
+    def sort_by(self, column='stim_id'):
+        """
+        Sorts all rows by a metadata column. Returns the table itself when it is already sorted.
+
+        :param column: Metadata column to sort by.
+        :type column: str
+        :rtype: ActivationTable
+        """
+        order = np.argsort(self.metadata[column].to_numpy(), kind='stable')
+        if np.all(order == np.arange(len(order))):
+            return self
+        return ActivationTable(
+            self.metadata.iloc[order],
+            OrderedDict((layer, X[order]) for layer, X in self.activations.items()),
+            self.shapes,
+        )
+
+    @classmethod
+    def from_layer_dict(cls, layer_dict, layer_name='activation'):
+        """
+        Builds a single-layer table from the legacy {stim_id: {field: value, 'activation': array}} format.
+
+        :param layer_dict: Stimuli of one layer keyed by stim_id.
+        :type layer_dict: dict
+        :param layer_name: Name under which the activations are stored.
+        :type layer_name: str
+        :rtype: ActivationTable
+        """
+        rows, activations = [], []
+        for stim_id, stimulus in layer_dict.items():
+            row = {'stim_id': stim_id}
+            for key, value in stimulus.items():
+                if key == 'activation':
+                    continue
+                value = value.item() if isinstance(value, (torch.Tensor, np.ndarray)) and np.ndim(value) == 0 else value
+                if np.ndim(value) == 0:
+                    row[key] = value
+            rows.append(row)
+            activations.append(np.asarray(stimulus['activation']))
+        return cls(pd.DataFrame(rows), OrderedDict([(layer_name, np.stack(activations))]))
+
+    @classmethod
+    def from_ordered_dict(cls, odict):
+        """
+        Builds a table from the legacy {layer: {stim_id: {field: value, 'activation': array}}} format.
+
+        :param odict: Output of the former probe_network_with_stimuli.
+        :type odict: collections.OrderedDict
+        :rtype: ActivationTable
+        """
+        table = None
+        for layer, layer_dict in odict.items():
+            layer_table = cls.from_layer_dict(layer_dict, layer)
+            if table is None:
+                table = layer_table
+            else:
+                table.add_layer(layer, layer_table.reshaped(layer))
+        return table
+
+
+def as_activation_table(activations, layer_name='activation'):
+    """
+    Returns activations as an ActivationTable, converting legacy per-layer dictionaries if needed.
+
+    :param activations: An ActivationTable or a legacy {stim_id: {..., 'activation': array}} dictionary.
+    :type activations: ActivationTable or dict
+    :param layer_name: Layer name used for converted dictionaries.
+    :type layer_name: str
+    :rtype: ActivationTable
+    """
+    if isinstance(activations, ActivationTable):
+        return activations
+    return ActivationTable.from_layer_dict(activations, layer_name)
+
+
+def resolve_layer(table, layer_name=None):
+    """
+    Returns the layer to analyse: the given name, or the only layer of a single-layer table.
+
+    :param table: The activation table.
+    :type table: ActivationTable
+    :param layer_name: Name of the layer, or None.
+    :type layer_name: str, optional
+    :rtype: str
+    :raises ValueError: If no layer is given and the table does not contain exactly one layer.
+    """
+    if layer_name in table:
+        return layer_name
+    if len(table.layers) == 1:
+        return table.layers[0]
+    raise ValueError(f"Layer '{layer_name}' not found. Choose one of {table.layers}.")
+
+
+def collate_metadata(stimuli_dict, exclude=('position', 'mask')):
+    """
+    Converts the scalar fields of a batch (as yielded by a DataLoader) into a metadata frame.
+
+    :param stimuli_dict: A batch of stimuli.
+    :type stimuli_dict: dict
+    :param exclude: Fields that are network inputs rather than stimulus information.
+    :type exclude: tuple
+    :rtype: pd.DataFrame
+    """
+    columns = OrderedDict()
+    for key, values in stimuli_dict.items():
+        if key in exclude:
+            continue
+        if isinstance(values, torch.Tensor):
+            if values.ndim != 1:
+                continue
+            values = values.cpu().numpy()
+        columns[key] = list(values)
+    return pd.DataFrame(columns)
@@ -8,12 +8,154 @@ Created on Fri Nov 24 14:06:31 2023
 import math
 import os
 from collections import OrderedDict
+from contextlib import ExitStack
+from itertools import chain
+from queue import Full
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import torch
 from PIL import Image
 from modules import logging
+from modules.analysis_funcs.activation_store import ActivationStore
+from modules.analysis_funcs.activation_table import ActivationTable, as_activation_table, collate_metadata, resolve_layer
 from modules.net_funcs.net_utils import freeze_layers, print_model_summary, plot_layer_activations
-from modules.helper_funcs.utils import sort_ordered_dict_by_key
+
+class ActivationRecorder:
+    """
+    A context manager that records the activations of selected layers with persistent forward hooks.
+
+    Modules are resolved once and hooks are registered once when the context is entered, and removed again
+    when it is exited. Every forward pass through the recorder writes the (optionally channel-selected,
+    flattened and cast) activations of each layer directly into a preallocated per-layer buffer, so that
+    no per-batch copies of the full layer outputs are kept around.
+
+    :ivar activations: Per-layer numpy buffers of shape (n_samples, ...) holding all recorded activations.
+    :vartype activations: dict
+    :ivar batch_activations: Per-layer (detached) activations of the most recent forward pass.
+    :vartype batch_activations: dict
+    :ivar shapes: Per-sample shape of the (channel-selected) activations of each layer before flattening.
+    :vartype shapes: dict
+
+    :Example:
+
+    >>> with ActivationRecorder(model, layer_names, n_samples=len(dataset), flatten=True) as recorder:
+            for batch in loader:
+                recorder(batch['position'], policyMask=batch['mask'])
+        activations = recorder.activations
+    """
+    def __init__(self, model, layer_names, n_samples=None, flatten=False, dtype=None, channels=None, allocate=None):
+        """
+        Initializes the ActivationRecorder object.
+
+        :param model: The neural network model to probe.
+        :type model: torch.nn.Module
+        :param layer_names: Name or list of names of the layers to record.
+        :type layer_names: str or list
+        :param n_samples: Total number of samples that will be recorded. If None, only the activations of
+                          the most recent forward pass are kept (in batch_activations).
+        :type n_samples: int, optional
+        :param flatten: Whether to flatten the activations of each sample into a vector.
+        :type flatten: bool
+        :param dtype: Numpy dtype of the buffers (e.g., np.float16). Defaults to the dtype of the layer output.
+        :type dtype: numpy.dtype, optional
+        :param channels: Indices (or a slice) of the channels (dim 1) to keep, either for all layers or as a
+                         dictionary keyed by layer name.
+        :type channels: list, slice or dict, optional
+        :param allocate: Optional callable (layer_name, shape, dtype) -> buffer of shape (n_samples, ...) that provides
+                         the buffers, e.g., ActivationStore.allocate to stream activations to disk.
+        :type allocate: callable, optional
+        """
+        self.model = model
+        self.layer_names = layer_names if isinstance(layer_names, list) else [layer_names]
+        self.n_samples = n_samples
+        self.flatten = flatten
+        self.dtype = dtype
+        self.channels = channels
+        self.allocate = allocate
+        self.activations = OrderedDict()
+        self.batch_activations = OrderedDict()
+        self.shapes = {}
+        self.offset = 0
+        self._batch_size = 0
+        self._hooks = []
+
+        # Resolve all modules once
+        modules = dict(model.named_modules())
+        missing = [name for name in self.layer_names if name not in modules]
+        if missing:
+            raise ValueError(f"Layers not found in model: {missing}")
+        self.modules = OrderedDict((name, modules[name]) for name in self.layer_names)
+
+    def __enter__(self):
+        """
+        Registers one forward hook per layer.
+
+        :returns: The ActivationRecorder object.
+        :rtype: ActivationRecorder
+        """
+        for name, module in self.modules.items():
+            self._hooks.append(module.register_forward_hook(self._get_hook(name)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Removes all hooks registered by the recorder.
+        """
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def _select(self, name, output):
+        """
+        Applies channel selection and flattening to the output of a layer.
+        """
+        if isinstance(output, (tuple, list)):
+            output = output[0]
+        output = output.detach()
+        channels = self.channels.get(name) if isinstance(self.channels, dict) else self.channels
+        if channels is not None:
+            output = output[:, channels]
+        self.shapes[name] = tuple(output.shape[1:])
+        if self.flatten:
+            output = output.reshape(output.shape[0], -1)
+        return output
+
+    def _get_hook(self, name):
+        def hook(module, input, output):
+            output = self._select(name, output)
+            self.batch_activations[name] = output
+            if self.n_samples is None:
+                return
+            if name not in self.activations:
+                # Allocate the buffer once the shape of the layer output is known
+                dtype = self.dtype or output.cpu().numpy().dtype
+                if self.allocate is not None:
+                    self.activations[name] = self.allocate(name, self.shapes[name], dtype)
+                else:
+                    self.activations[name] = np.empty((self.n_samples, *output.shape[1:]), dtype=dtype)
+            buffer = self.activations[name]
+            buffer[self.offset:self.offset + output.shape[0]] = output.cpu().numpy().reshape(output.shape[0], *buffer.shape[1:])
+            self._batch_size = output.shape[0]
+        return hook
+
+    def __call__(self, *args, **kwargs):
+        """
+        Runs a forward pass and records the activations of all layers.
+
+        :returns: The output of the model.
+        """
+        self._batch_size = 0
+        output = self.model(*args, **kwargs)
+        self.offset += self._batch_size
+        return output
+
+    def reset(self):
+        """
+        Restarts recording at the first sample while keeping buffers and hooks.
+        """
+        self.offset = 0
+        self.batch_activations = OrderedDict()
 
 def get_layer_activation(model, layer_names, position, mask):
     """
@@ -30,43 +172,23 @@ def get_layer_activation(model, layer_names, position, mask):
     :returns: A dictionary where keys are layer names and values are corresponding activations.
     :rtype: dict
     """
-    # Ensure layer_names is a list
-    if not isinstance(layer_names, list):
-        layer_names = [layer_names]
+    with ActivationRecorder(model, layer_names) as recorder:
+        recorder(position, policyMask=mask)
+    return recorder.batch_activations
 
-    # Hook for extracting activations
-    activations = {name: None for name in layer_names}
-    hooks = []
-
-    def get_activation(name):
-        def hook(model, input, output):
-            activations[name] = output.detach()
-        return hook
-
-    # Register hooks for each layer
-    for name in layer_names:
-        layer = dict([*model.named_modules()])[name]
-        hook = layer.register_forward_hook(get_activation(name))
-        hooks.append(hook)
-
-    # Forward pass
-    model(position, policyMask=mask)
-
-    # Remove the hooks
-    for hook in hooks:
-        hook.remove()
-
-    # Return the activations for the specified layers
-    return activations
-
-def probe_network_with_stimuli(model, layer_names, stimuli_loader, device):
+def probe_network_with_stimuli(model, layer_names, stimuli_loader, device, store=None, reducers=None):
     """
     Probes a neural network model with controlled stimuli and extracts activations for specified layers.
 
     This function iterates through a DataLoader containing stimuli, applies these stimuli to a neural network model,
-    and extracts activations from specified layers. The activations along with the original stimuli information are
-    stored in an OrderedDict. Each key in this dictionary is a layer name, and each value is another OrderedDict,
-    keyed by 'stim_id', containing stimuli information and corresponding activations for that layer.
+    and records activations from specified layers directly into one contiguous float32 array per layer. The scalar
+    stimulus information (e.g., 'stim_id', 'strategy', 'filename') is collected once into a metadata frame that is
+    shared by all layers. Rows are sorted by 'stim_id'. If an activation store is given, activations are streamed
+    into its per-layer files during extraction and the returned table is memory-mapped from the store.
+
+    Reducers (see activation_reducers) consume the activations of every batch as they come off the hooks. If
+    reducers are given without a store, raw activations are not recorded at all and the returned table only
+    holds the stimuli metadata, so that peak memory is bounded by the batch size instead of the dataset size.
 
     :param model: The neural network model to probe. It should be in evaluation mode.
     :type model: torch.nn.Module
@@ -76,70 +198,337 @@ def probe_network_with_stimuli(model, layer_names, stimuli_loader, device):
     :type stimuli_loader: torch.utils.data.DataLoader
     :param device: The computational device (e.g., CPU or CUDA) on which to run the model.
     :type device: torch.device
-    :returns: A dictionary where each key is a layer name, and each value is an OrderedDict of stimuli (keyed by 'stim_id') and activations.
-    :rtype: collections.OrderedDict
+    :param store: Optional activation store (created for len(stimuli_loader.dataset) stimuli) to write to.
+    :type store: ActivationStore, optional
+    :param reducers: Optional list of reducers (e.g., WelfordReducer, IncrementalPCAReducer, RDMReducer) with unique names.
+    :type reducers: list, optional
+    :returns: A table with the (n_stimuli, n_features) activations of each layer and the stimuli metadata. If reducers
+              are given, a tuple of the table and a dictionary of the results of each reducer keyed by its name
+              (per-stimulus results are sorted by 'stim_id', like the table).
+    :rtype: ActivationTable or tuple
     """
     # Set the model to evaluation mode. This is crucial as it disables layers like dropout and batch normalization.
     model.eval()
     model = freeze_layers(model)
     print_model_summary(model, input_shape=[(1, 16, 8, 8), (1, 72, 8, 8)])
-    
-    # Initialize an empty OrderedDict to store activations by layer.
-    stimuli_dict_by_layer = OrderedDict()
 
-    # Iterate over each batch in the stimuli DataLoader.
-    for batch_index, stimuli_dict in enumerate(stimuli_loader):
-        logging.info(f"Processing batch {batch_index + 1}")
+    metadata = []
+
+    # Raw activations are only recorded if they are written to a store or if there is nothing to reduce them with.
+    reducers = reducers or []
+    record = store is not None or not reducers
+    n_samples = len(stimuli_loader.dataset) if record else None
+
+    # Register the hooks once and record all batches into preallocated per-layer buffers.
+    allocate = store.allocate if store is not None else None
+    with ActivationRecorder(model, layer_names, n_samples=n_samples, flatten=True, dtype=np.float32, allocate=allocate) as recorder:
+        # Iterate over each batch in the stimuli DataLoader.
+        for batch_index, stimuli_dict in enumerate(stimuli_loader):
+            logging.info(f"Processing batch {batch_index + 1}")
+
+            # Extract positions and masks, and move them to the specified device (CPU/GPU).
+            positions = stimuli_dict['position'].to(device)
+            masks = stimuli_dict['mask'].to(device)
+
+            # Record the layer activations for the given batch of stimuli.
+            recorder(positions, policyMask=masks)
+
+            # Feed the (batch_size, n_features) activations of every layer to the reducers while still on the device.
+            for reducer in reducers:
+                for layer, X in recorder.batch_activations.items():
+                    reducer.update(layer, X)
+
+            # Keep the stimulus information of the batch.
+            metadata.append(collate_metadata(stimuli_dict))
+
+    metadata = pd.concat(metadata, ignore_index=True)
+
+    if store is not None:
+        # Write the stimuli table, sort all layer files by stim_id and read them back lazily.
+        store.write_metadata(metadata)
+        store.finalize(sort_by='stim_id')
+        logging.info(f"Processing complete. Activations stored in {store.root}")
+        table = store.table(layer_names)
+    elif record:
+        # Build the table (trimmed to the number of recorded stimuli) and sort it by stim_id.
+        activations = OrderedDict((layer, X[:recorder.offset]) for layer, X in recorder.activations.items())
+        table = ActivationTable(metadata, activations, recorder.shapes).sort_by('stim_id')
+        logging.info("Processing complete.")
+    else:
+        table = ActivationTable(metadata, OrderedDict()).sort_by('stim_id')
+        logging.info("Processing complete.")
+
+    if not reducers:
+        return table
+
+    # Collect the results of all reducers, with per-stimulus results in the (stim_id) order of the table.
+    order = np.argsort(metadata['stim_id'].to_numpy(), kind='stable')
+    return table, OrderedDict((reducer.name, reducer.result(order)) for reducer in reducers)
 
-        # Extract positions and masks, and move them to the specified device (CPU/GPU).
-        positions = stimuli_dict['position'].to(device)
-        masks = stimuli_dict['mask'].to(device)
+MODEL_LAYER_SEP = '/'
 
-        # Extract the layer activations for the given batch of stimuli using the provided model.
-        layers_activations = get_layer_activation(model, layer_names, positions, masks)
+def model_layer_name(model_id, layer_name):
+    """
+    Returns the name under which the activations of a layer of one of several probed models are stored.
+
+    :param model_id: Identifier of the model (e.g., 'model-trained_seed-0').
+    :type model_id: str
+    :param layer_name: Name of the layer within the model.
+    :type layer_name: str
+    :rtype: str
+    """
+    return f"{model_id}{MODEL_LAYER_SEP}{layer_name}"
+
+def split_model_layer_name(name):
+    """
+    Splits a name created by model_layer_name into the model identifier and the layer name.
+
+    :param name: Name of a layer of a multi-model table or store.
+    :type name: str
+    :rtype: tuple
+    """
+    model_id, layer_name = name.split(MODEL_LAYER_SEP, 1)
+    return model_id, layer_name
 
-        # Process each layer's activations.
-        for layer, activations in layers_activations.items():
-            # For each layer, either get the existing OrderedDict or create a new one.
-            layer_data = stimuli_dict_by_layer.setdefault(layer, OrderedDict())
+WORKER_PUT_TIMEOUT = 1.0
 
-            # Iterate over each activation in the current layer.
-            for i, activation in enumerate(activations):
-                # Extract the stimulus ID for the current activation.
-                stim_id = stimuli_dict['stim_id'][i].item()
+def _put_to_worker(queue, worker, item):
+    """
+    Puts an item on the queue of a worker of probe_models_with_stimuli, waiting for a free slot only as long as
+    the worker is alive, so that a worker that died does not block the main process forever.
+    """
+    while True:
+        try:
+            queue.put(item, timeout=WORKER_PUT_TIMEOUT)
+            return
+        except Full:
+            if not worker.is_alive():
+                raise RuntimeError(f"Probing worker {worker.name} died with exit code {worker.exitcode}.")
 
-                # Create a dictionary for the current stimulus, copying all relevant information from the original stimuli_dict.
-                stimulus_info = {key: stimuli_dict[key][i] for key in stimuli_dict}
+def _probe_models_worker(models, layer_names, buffers, queue, n_samples, n_threads):
+    """
+    Worker process of probe_models_with_stimuli: runs each batch from the queue through its models and writes the
+    activations into the shared buffers (memory-mapped store files or shared-memory tensors).
+    """
+    torch.set_num_threads(n_threads)
 
-                # Add the activation data to the stimulus information.
-                stimulus_info['activation'] = activation.cpu().numpy()
+    def get_allocate(model_id):
+        def allocate(name, shape, dtype):
+            buffer = buffers[model_layer_name(model_id, name)]
+            if isinstance(buffer, tuple):
+                # (store root, layer name): open the allocated layer file(s) of the store
+                return ActivationStore(buffer[0]).writer(buffer[1])
+            return buffer.numpy()
+        return allocate
 
-                # Store the stimulus information in the layer data, keyed by stim_id.
-                layer_data[stim_id] = stimulus_info
+    with ExitStack() as stack:
+        recorders = [
+            stack.enter_context(ActivationRecorder(
+                model, layer_names[model_id], n_samples=n_samples, flatten=True, dtype=np.float32, allocate=get_allocate(model_id)
+            ))
+            for model_id, model in models.items()
+        ]
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            offset, positions, masks = item
+            with torch.no_grad():
+                for recorder in recorders:
+                    recorder.offset = offset
+                    recorder(positions, policyMask=masks)
+        for recorder in recorders:
+            for buffer in recorder.activations.values():
+                if hasattr(buffer, 'flush'):
+                    buffer.flush()
 
-    # Sort the data in each layer's dictionary by stim_id using the sort_ordered_dict_by_key function.
-    for layer in stimuli_dict_by_layer:
-        stimuli_dict_by_layer[layer] = sort_ordered_dict_by_key(stimuli_dict_by_layer[layer])
+def probe_models_with_stimuli(models, layer_names, stimuli_loader, device, store=None, n_workers=0):
+    """
+    Probes several models (e.g., a trained network and untrained networks of several seeds) in a single pass over the stimuli.
 
-    logging.info("Processing complete.")
-    return stimuli_dict_by_layer
+    Every batch is loaded and encoded once and then fed to all models, so that adding a model only costs its forward
+    passes. The activations of all models are collected in one table (or store), with layers named
+    model_layer_name(model_id, layer_name). Alternatively, every model can be given its own store, in which layers
+    keep their own names. With n_workers > 0, the models are distributed over worker processes:
+    their weights are moved to shared memory (instead of being copied into each worker), every batch is sent to all
+    workers through shared memory, and the workers write straight into the layer files of the store (or into
+    shared-memory buffers if no store is given).
 
-def plot_activations_from_probe_output(probe_output, stim_id, image_folder='datasets/fmri_dataset/images'):
+    :param models: Models to probe keyed by model identifier (e.g., 'model-untrained_seed-1').
+    :type models: collections.OrderedDict
+    :param layer_names: Names of the layers to probe, either for all models or as a dictionary keyed by model identifier.
+    :type layer_names: list or dict
+    :param stimuli_loader: A DataLoader containing the stimuli to be applied to the models.
+    :type stimuli_loader: torch.utils.data.DataLoader
+    :param device: The computational device on which to run the models (and the workers).
+    :type device: torch.device
+    :param store: Optional activation store (created for len(stimuli_loader.dataset) stimuli) to write to, or a
+                  dictionary of such stores keyed by model identifier.
+    :type store: ActivationStore or dict, optional
+    :param n_workers: Number of worker processes, or 0 to run all models in the current process.
+    :type n_workers: int
+    :returns: A table with the (n_stimuli, n_features) activations of each layer of each model and the stimuli metadata,
+              sorted by 'stim_id'.
+    :rtype: ActivationTable
+    """
+    layer_names = layer_names if isinstance(layer_names, dict) else {model_id: layer_names for model_id in models}
+    n_samples = len(stimuli_loader.dataset)
+    models = OrderedDict((model_id, freeze_layers(model.eval())) for model_id, model in models.items())
+
+    metadata = []
+    buffers = OrderedDict()
+    shapes = {}
+
+    # Store (and name within that store) of every layer of every model
+    if isinstance(store, dict):
+        get_target = lambda model_id, name: (store[model_id], name)
+        stores = list(OrderedDict((id(s), s) for s in store.values()).values())
+    else:
+        get_target = lambda model_id, name: (store, model_layer_name(model_id, name))
+        stores = [store] if store is not None else []
+
+    if n_workers <= 0:
+        with ExitStack() as stack:
+            recorders = OrderedDict()
+            for model_id, model in models.items():
+                allocate = None
+                if stores:
+                    def allocate(name, shape, dtype, model_id=model_id):
+                        target_store, target_name = get_target(model_id, name)
+                        return target_store.allocate(target_name, shape, dtype)
+                recorders[model_id] = stack.enter_context(ActivationRecorder(
+                    model, layer_names[model_id], n_samples=n_samples, flatten=True, dtype=np.float32, allocate=allocate
+                ))
+
+            for batch_index, stimuli_dict in enumerate(stimuli_loader):
+                logging.info(f"Processing batch {batch_index + 1}")
+
+                # Move the batch to the device once and run it through all models.
+                positions = stimuli_dict['position'].to(device)
+                masks = stimuli_dict['mask'].to(device)
+                for recorder in recorders.values():
+                    recorder(positions, policyMask=masks)
+                metadata.append(collate_metadata(stimuli_dict))
+
+        for model_id, recorder in recorders.items():
+            for layer, X in recorder.activations.items():
+                buffers[model_layer_name(model_id, layer)] = X
+                shapes[model_layer_name(model_id, layer)] = recorder.shapes[layer]
+    else:
+        batches = iter(stimuli_loader)
+        first_batch = next(batches)
+
+        # Determine the output shape of every layer with a single stimulus and allocate all buffers up front,
+        # so that the workers only ever write into existing files or shared tensors.
+        for model_id, model in models.items():
+            with ActivationRecorder(model, layer_names[model_id], flatten=True) as recorder, torch.no_grad():
+                recorder(first_batch['position'][:1].to(device), policyMask=first_batch['mask'][:1].to(device))
+            for layer in recorder.layer_names:
+                name = model_layer_name(model_id, layer)
+                shapes[name] = recorder.shapes[layer]
+                if stores:
+                    target_store, target_name = get_target(model_id, layer)
+                    target_store.allocate(target_name, shapes[name], np.float32)
+                    buffers[name] = (target_store.root, target_name)
+                else:
+                    buffers[name] = torch.empty((n_samples, int(np.prod(shapes[name]))), dtype=torch.float32).share_memory_()
+        # Close the memory maps of the main process; the workers open their own.
+        for target_store in stores:
+            target_store._buffers.clear()
+
+        # Distribute the models (with their weights in shared memory) round-robin over the workers.
+        context = torch.multiprocessing.get_context('spawn')
+        model_ids = list(models)
+        n_workers = min(n_workers, len(model_ids))
+        n_threads = max(1, torch.get_num_threads() // n_workers)
+        workers, queues = [], []
+        for worker_index in range(n_workers):
+            worker_models = OrderedDict((model_id, models[model_id].share_memory()) for model_id in model_ids[worker_index::n_workers])
+            worker_buffers = {
+                name: buffer for name, buffer in buffers.items() if split_model_layer_name(name)[0] in worker_models
+            }
+            queue = context.Queue(maxsize=2)
+            worker = context.Process(
+                target=_probe_models_worker,
+                args=(worker_models, layer_names, worker_buffers, queue, n_samples, n_threads),
+            )
+            worker.start()
+            workers.append(worker)
+            queues.append(queue)
+
+        try:
+            offset = 0
+            for batch_index, stimuli_dict in enumerate(chain([first_batch], batches)):
+                logging.info(f"Processing batch {batch_index + 1}")
+
+                # Move the batch to the device (and into shared memory) once and send it to all workers.
+                positions = stimuli_dict['position'].to(device)
+                masks = stimuli_dict['mask'].to(device)
+                if positions.device.type == 'cpu':
+                    positions, masks = positions.share_memory_(), masks.share_memory_()
+                for queue, worker in zip(queues, workers):
+                    _put_to_worker(queue, worker, (offset, positions, masks))
+                offset += positions.shape[0]
+                metadata.append(collate_metadata(stimuli_dict))
+            for queue, worker in zip(queues, workers):
+                _put_to_worker(queue, worker, None)
+            for worker in workers:
+                worker.join()
+        except BaseException:
+            # Stop all remaining workers and drop what is still queued for them, then re-raise.
+            for queue, worker in zip(queues, workers):
+                queue.cancel_join_thread()
+                if worker.is_alive():
+                    worker.terminate()
+            for worker in workers:
+                worker.join()
+            raise
+        failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"{len(failed)} probing worker(s) failed with exit codes {failed}.")
+
+        if not stores:
+            buffers = OrderedDict((name, buffer.numpy()) for name, buffer in buffers.items())
+
+    metadata = pd.concat(metadata, ignore_index=True)
+
+    if stores:
+        # Write the stimuli table, sort all layer files by stim_id and read them back lazily.
+        for target_store in stores:
+            target_store.write_metadata(metadata)
+            target_store.finalize(sort_by='stim_id')
+        logging.info(f"Processing complete. Activations of {len(models)} models stored in {[s.root for s in stores]}")
+        if not isinstance(store, dict):
+            return store.table()
+        activations = OrderedDict(
+            (model_layer_name(model_id, layer), store[model_id].load(layer)) for model_id in models for layer in layer_names[model_id]
+        )
+        shapes = {model_layer_name(model_id, layer): store[model_id].shape(layer) for model_id in models for layer in layer_names[model_id]}
+        return ActivationTable(stores[0].metadata, activations, shapes)
+
+    logging.info(f"Processing complete for {len(models)} models.")
+    return ActivationTable(metadata, buffers, shapes).sort_by('stim_id')
+
+def plot_activations_from_probe_output(probe_output, stim_id, image_folder='datasets/fmri_dataset/images', layer_name=None):
     """
     Plot the original image and the activations for a specific image given its stim_id.
 
-    :param probe_output: The output from probe_network_with_stimuli function.
+    :param probe_output: The output from probe_network_with_stimuli function (or the activations of a single layer).
                          Expected to contain information about each stimulus and its activations.
-    :type probe_output: dict
+    :type probe_output: ActivationTable or dict
     :param stim_id: The stimulus identifier for which the activations and image will be plotted.
     :type stim_id: int
     :param image_folder: The folder where images are stored. Defaults to 'datasets/fmri_dataset/images'.
     :type image_folder: str, optional
+    :param layer_name: Name of the layer to plot. Can be omitted for tables with a single layer.
+    :type layer_name: str, optional
     """
-    # Function body...
-    if stim_id in probe_output:
-        activations = probe_output[stim_id]['activation']
-        filename = probe_output[stim_id]['filename']
+    table = as_activation_table(probe_output)
+    layer_name = resolve_layer(table, layer_name)
+    rows = np.flatnonzero(table.stim_ids == stim_id)
+    if len(rows) > 0:
+        activations = table.reshaped(layer_name)[rows[0]]
+        filename = table.metadata['filename'].iloc[rows[0]]
 
         # Construct the full path of the image
         image_path = os.path.join(image_folder, filename)
@@ -162,4 +551,3 @@ def plot_activations_from_probe_output(probe_output, stim_id, image_folder='data
         plot_layer_activations(activations, num_cols)
     else:
         print("Specified stim_id not found in the probe output.")
-
@@ -10,6 +10,8 @@ from scipy.spatial.distance import pdist, squareform
 from sklearn.covariance import MinCovDet
 import matplotlib.pyplot as plt
 
+from modules.analysis_funcs.activation_table import as_activation_table, resolve_layer
+
 def safe_normalize_rdm(rdm):
     """
     Safely normalizes the representational dissimilarity matrix (RDM).
@@ -81,8 +83,8 @@ def compute_rdm(probe_output, n_components=None, distance_metric="euclidean", re
     Compute and optionally plot the RDM for each label using the specified distance metric,
     excluding the diagonal when rescaling.
 
-    :param probe_output: Output from the probe_network_with_stimuli function.
-    :type probe_output: dict
+    :param probe_output: Output from the probe_network_with_stimuli function (or a legacy dictionary of a single layer keyed by stim_id).
+    :type probe_output: ActivationTable or dict
     :param n_components: Number of components to retain after dimensionality reduction, or None to use all components.
     :type n_components: int, optional
     :param distance_metric: Distance metric ('euclidean', 'mahalanobis', or 'pearson').
@@ -91,19 +93,16 @@ def compute_rdm(probe_output, n_components=None, distance_metric="euclidean", re
     :type rescale: bool
     :param plot: Plot the RDM if True.
     :type plot: bool
-    :param layer_name: Name of the layer for which the RDM is computed, used in plotting.
+    :param layer_name: Name of the layer for which the RDM is computed (can be omitted for single-layer tables), used in plotting.
     :type layer_name: str
     :returns: Dictionary with labels as keys and corresponding RDMs as values.
     :rtype: dict
     """
-    # Process each activation as an independent observation
-    activations_np = np.array([probe_output[stim_id]['activation'] for stim_id in probe_output.keys()])
-    
-    # Flatten the activations 
-    activations_np = activations_np.reshape(activations_np.shape[0], -1)
-    
-    # stim_ids = tuple(probe_output.keys())
-    strategies = tuple(int(probe_output[stim_id]['strategy']) for stim_id in probe_output.keys())
+    # Each row of the (n_stimuli, n_features) activations of the layer is an independent observation (a view, no copy)
+    table = as_activation_table(probe_output, layer_name or 'activation')
+    activations_np = table[resolve_layer(table, layer_name)]
+
+    strategies = tuple(table.metadata['strategy'].to_numpy().astype(int))
 
     # Compute pairwise distances based on the specified metric
     if activations_np.shape[1] == 1 or distance_metric == "euclidean":
@@ -111,7 +110,8 @@ def compute_rdm(probe_output, n_components=None, distance_metric="euclidean", re
     elif distance_metric == "mahalanobis":
         distances = calculate_mahalanobis_distance(activations_np)
     elif distance_metric == "pearson":
-        distances = pdist(activations_np, metric=lambda u, v: 1 - np.corrcoef(u, v)[0, 1])
+        # Correlation distance (1 - Pearson r) in compiled code instead of a Python callback per pair
+        distances = pdist(activations_np, metric="correlation")
     else:
         raise ValueError("Invalid distance metric specified.")
 
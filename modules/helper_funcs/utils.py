@@ -9,7 +9,6 @@ Created on Fri Nov 24 12:28:17 2023
 import os
 import inspect
 from collections import OrderedDict
-from copy import deepcopy
 from datetime import datetime
 import random
 import sys
@@ -178,7 +177,7 @@ def sort_ordered_dict_by_key(original_dict):
 
     This function takes an OrderedDict and returns a new OrderedDict which is sorted based on the keys.
     The sorting is done in ascending order of the keys. This function does not modify the original
-    OrderedDict but returns a sorted deep copy.
+    OrderedDict but returns a sorted shallow copy.
 
     :param original_dict: The OrderedDict to be sorted.
     :type original_dict: collections.OrderedDict
@@ -186,15 +185,10 @@ def sort_ordered_dict_by_key(original_dict):
     :rtype: collections.OrderedDict
 
     .. note::
-        This function creates a deep copy of the original OrderedDict, so changes to the returned
-        OrderedDict will not affect the original one.
+        Values are shared with the original OrderedDict (no deep copy), so sorting is cheap even for
+        large activation arrays.
     """
-    # Create a deep copy of the original OrderedDict to maintain the integrity of the original data
-    copied_dict = deepcopy(original_dict)
-
-    # Sort the copied OrderedDict by its keys and return the sorted OrderedDict
-    sorted_activations = OrderedDict(sorted(copied_dict.items(), key=lambda x: x[0]))
-    return sorted_activations
+    return OrderedDict(sorted(original_dict.items(), key=lambda x: x[0]))
 
 def print_dict(d, indent=0):
     """
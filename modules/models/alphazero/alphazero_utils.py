@@ -53,5 +53,5 @@ def load_alphazero_models(weights_path="./weights/AlphaZeroNet_20x256.pt", devic
             raise FileNotFoundError(f"Weights file not found at '{weights_path}'. Please check the file path.")
         return untrained_model, trained_model
     else:
-        logging.log("No 'weights_path' passed to load_models. Returning untrained model only.")
+        logging.info("No 'weights_path' passed to load_models. Returning untrained model only.")
         return untrained_model
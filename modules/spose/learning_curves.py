@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__all__ = [
+            'evaluate_checkpoint',
+            'evaluate_checkpoints',
+            'share_array',
+            ]
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import numba
+import torch
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Tuple
+
+import utils as utils
+
+os.environ['PYTHONIOENCODING']='UTF-8'
+
+def parseargs():
+    parser = argparse.ArgumentParser()
+    def aa(*args, **kwargs):
+        parser.add_argument(*args, **kwargs)
+    aa('--results_dir', type=str, default='./results/',
+        help='results directory that contains all (indexed) training runs')
+    aa('--triplets_dir', type=str,
+        help='directory from where to load the held-out test triplets')
+    aa('--out_path', type=str, default='./learning_curves.csv',
+        help='.csv or .parquet file to store the tidy table of metrics per checkpoint')
+    aa('--modality', type=str, default=None,
+        help='only evaluate runs of this modality')
+    aa('--dim', type=int, default=None,
+        help='only evaluate runs with this (initial) dimensionality')
+    aa('--lmbda', type=float, default=None,
+        help='only evaluate runs with this lambda value')
+    aa('--rnd_seed', type=int, default=None,
+        help='only evaluate runs with this random seed')
+    aa('--version', type=str, default='deterministic',
+        choices=['deterministic', 'variational'],
+        help='whether checkpoints belong to the deterministic or variational version of SPoSE')
+    aa('--human_choices', type=str, default=None,
+        help='optional .csv file with human odd-one-out choices (trip.1, trip.2, trip.3, choice) to compute KL divergences')
+    aa('--reference_rsm', type=str, default=None,
+        help='optional .npy file with a reference RSM to which the predicted RSMs are correlated')
+    aa('--temperature', type=float, default=1.,
+        help='softmax temperature (beta param) for choice randomness')
+    aa('--batch_size', type=int, default=8192,
+        help='number of test triplets that are evaluated at once')
+    aa('--n_workers', type=int, default=1,
+        help='number of processes that evaluate checkpoints in parallel')
+    args = parser.parse_args()
+    return args
+
+def initialize_args():
+    """
+    Initialize arguments based on the mode of execution (Command Line vs IDE).
+
+    When executed via command line, it parses the provided command-line arguments.
+    If executed from an IDE, it sets default values for the arguments.
+
+    Returns:
+        argparse.Namespace or IDEArgs: Argument object based on the mode of execution.
+    """
+
+    class IDEArgs:
+        def __init__(self):
+            self.results_dir = './test/test_results/triplets/results'
+            self.triplets_dir = './test/test_results/triplets'
+            self.out_path = './test/test_results/learning_curves.csv'
+            self.modality = None
+            self.dim = None
+            self.lmbda = None
+            self.rnd_seed = None
+            self.version = 'deterministic'
+            self.human_choices = None
+            self.reference_rsm = None
+            self.temperature = 1.
+            self.batch_size = 8192
+            self.n_workers = 1
+
+    # Check if the script is executed via command line
+    if len(sys.argv) > 1:
+        # Parse command-line arguments using previously defined parseargs() function
+        args = parseargs()
+        logging.log(logging.INFO, "Parsed command-line arguments.")
+    else:
+        # Use IDEArgs class for default configurations when executing in IDE
+        args = IDEArgs()
+
+    return args
+
+################################################
+######### shared memory for workers ############
+################################################
+
+def share_array(X:np.ndarray) -> Tuple[shared_memory.SharedMemory, dict]:
+    """copy an array into shared memory and return the block together with a spec to attach to it"""
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+    return shm, {'name': shm.name, 'shape': X.shape, 'dtype': X.dtype.str}
+
+_WORKER = {}
+
+def _init_worker(triplets_spec:dict, human:tuple, reference_rsm:np.ndarray, config:dict) -> None:
+    #one thread per worker, also for numba kernels such as utils.rsm_pred
+    torch.set_num_threads(1)
+    numba.set_num_threads(1)
+    shm = shared_memory.SharedMemory(name=triplets_spec['name'])
+    _WORKER['shm'] = shm #keep a reference such that the buffer stays valid
+    _WORKER['triplets'] = np.ndarray(triplets_spec['shape'], dtype=np.dtype(triplets_spec['dtype']), buffer=shm.buf)
+    _WORKER['human'] = human
+    _WORKER['reference_rsm'] = reference_rsm
+    _WORKER['config'] = config
+
+################################################
+############ metrics per checkpoint ############
+################################################
+
+def triplet_probas(W:np.ndarray, triplets:np.ndarray, temperature:float, batch_size:int) -> np.ndarray:
+    """(n_triplets, 3) softmax over the similarities (s_ij, s_ik, s_jk) of index triplets"""
+    probas = np.empty((len(triplets), 3), dtype=np.float32)
+    for start in range(0, len(triplets), batch_size):
+        E = W[triplets[start:start+batch_size]]
+        sims = np.stack([
+                        np.einsum('nd,nd->n', E[:, 0], E[:, 1]),
+                        np.einsum('nd,nd->n', E[:, 0], E[:, 2]),
+                        np.einsum('nd,nd->n', E[:, 1], E[:, 2]),
+                        ], axis=1) / temperature
+        sims -= sims.max(axis=1, keepdims=True)
+        np.exp(sims, out=sims)
+        probas[start:start+batch_size] = sims / sims.sum(axis=1, keepdims=True)
+    return probas
+
+def evaluate_checkpoint(
+                        checkpoint:dict,
+                        triplets:np.ndarray=None,
+                        human:tuple=None,
+                        reference_rsm:np.ndarray=None,
+                        config:dict=None,
+) -> dict:
+    """evaluate the metric suite for a single checkpoint (falls back to the data of the current worker)"""
+    triplets = _WORKER['triplets'] if triplets is None else triplets
+    human = _WORKER.get('human') if human is None else human
+    reference_rsm = _WORKER.get('reference_rsm') if reference_rsm is None else reference_rsm
+    config = _WORKER['config'] if config is None else config
+
+    state_dict = utils.load_state_dict_(checkpoint['path'])
+    W = utils.embedding_from_state_dict(state_dict, config['version']).numpy().astype(np.float32)
+    probas = triplet_probas(W, triplets, config['temperature'], config['batch_size'])
+    confidences, avg_probas = utils.compute_pm(probas)
+    metrics = dict(checkpoint)
+    metrics.update({
+                    'n_dims': utils.get_nneg_dims(torch.from_numpy(W.T)),
+                    'accuracy': utils.accuracy_(probas),
+                    'loglikelihood': float(np.mean(np.log(np.maximum(probas[:, 0], np.finfo(np.float32).tiny)))),
+                    'calibration_mse': float(utils.mse(avg_probas, confidences)),
+                    })
+    if human is not None:
+        keys, human_pmfs = human
+        #probabilities of the items of every sorted triplet being the odd-one-out
+        model_pmfs = triplet_probas(W, utils.decode_triplets(keys, config['n_items']), config['temperature'], config['batch_size'])[:, ::-1]
+        metrics['human_kld'] = float(np.mean(utils.compute_divergences(human_pmfs, model_pmfs, metric='kld')))
+        metrics['human_cross_entropy'] = float(np.mean(utils.compute_divergences(human_pmfs, model_pmfs, metric='cross-entropy')))
+    if reference_rsm is not None:
+        if W.shape[0] != reference_rsm.shape[0]:
+            raise ValueError(f'\nEmbedding of {checkpoint["path"]} has {W.shape[0]} items, but the reference RSM has {reference_rsm.shape[0]}.\n')
+        rsm = utils.rsm_pred(W)
+        metrics['rsm_corr'] = float(utils.pearsonr(utils.tril_(rsm), utils.tril_(reference_rsm)))
+    return metrics
+
+def evaluate_checkpoints(
+                         checkpoints:pd.DataFrame,
+                         test_triplets:np.ndarray,
+                         version:str='deterministic',
+                         human_choices:pd.DataFrame=None,
+                         reference_rsm:np.ndarray=None,
+                         temperature:float=1.,
+                         batch_size:int=8192,
+                         n_workers:int=1,
+) -> pd.DataFrame:
+    """evaluate a metric suite over every checkpoint (rows of CheckpointRegistry.find/checkpoints) in a process pool
+
+    Test triplets are placed in shared memory once, such that workers never copy them. Workers are spawned
+    rather than forked, since forking after numba's threading layer has started (e.g., rsm_pred for the
+    reference RSM in the parent) deadlocks. Returns a tidy table with one row per checkpoint.
+    """
+    test_triplets = np.ascontiguousarray(test_triplets, dtype=np.int64)
+    n_items = int(test_triplets.max()) + 1
+    human = None
+    if human_choices is not None:
+        n_items = max(n_items, int(human_choices[['trip.1', 'trip.2', 'trip.3']].to_numpy().max()))
+        human = utils.get_choice_distributions(human_choices, n_items)
+    config = {'version': version, 'temperature': temperature, 'batch_size': batch_size, 'n_items': n_items}
+    rows = checkpoints.to_dict('records')
+    shm, spec = share_array(test_triplets)
+    try:
+        with ProcessPoolExecutor(
+                                max_workers=max(1, n_workers),
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker,
+                                initargs=(spec, human, reference_rsm, config),
+                                ) as pool:
+            results = list(pool.map(evaluate_checkpoint, rows))
+    finally:
+        shm.close()
+        shm.unlink()
+    return pd.DataFrame(results).sort_values(['modality', 'dim', 'lmbda', 'rnd_seed', 'epoch']).reset_index(drop=True)
+
+if __name__ == "__main__":
+    #parse all arguments
+    args = initialize_args()
+    registry = utils.CheckpointRegistry(args.results_dir, refresh=True)
+    checkpoints = registry.checkpoints
+    for column in ('modality', 'dim', 'lmbda', 'rnd_seed'):
+        value = getattr(args, column)
+        if value is not None:
+            checkpoints = checkpoints[checkpoints[column] == (utils.normalize_modality_(value) if column == 'modality' else value)]
+    logging.info(f'Evaluating {len(checkpoints)} checkpoints')
+    test_triplets = utils.load_data(device='cpu', triplets_dir=args.triplets_dir, inference=True).numpy()
+    human_choices = pd.read_csv(args.human_choices) if args.human_choices else None
+    reference_rsm = np.load(args.reference_rsm) if args.reference_rsm else None
+    learning_curves = evaluate_checkpoints(
+                                          checkpoints=checkpoints,
+                                          test_triplets=test_triplets,
+                                          version=args.version,
+                                          human_choices=human_choices,
+                                          reference_rsm=reference_rsm,
+                                          temperature=args.temperature,
+                                          batch_size=args.batch_size,
+                                          n_workers=args.n_workers,
+    )
+    out_dir = os.path.dirname(args.out_path)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if args.out_path.endswith('.parquet'):
+        learning_curves.to_parquet(args.out_path, index=False)
+    else:
+        learning_curves.to_csv(args.out_path, index=False)
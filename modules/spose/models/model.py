@@ -3,6 +3,7 @@
 
 __all__ = [
             'SPoSE',
+            'VSPoSE',
             'l1_regularization',
             ]
 
@@ -36,6 +37,52 @@ class SPoSE(nn.Module):
             if isinstance(m, nn.Linear):
                 m.weight.data.normal_(mean, std)
 
+class VSPoSE(nn.Module):
+
+    def __init__(
+                self,
+                in_size:int,
+                out_size:int,
+                init_weights:bool=True,
+                ):
+        super(VSPoSE, self).__init__()
+        self.in_size = in_size
+        self.out_size = out_size
+        self.encoder_mu = nn.Sequential(
+                                        nn.Linear(self.in_size, self.out_size, bias=True),
+                                        nn.ReLU(),
+                                        )
+        self.encoder_b = nn.Sequential(
+                                        nn.Linear(self.in_size, self.out_size, bias=True),
+                                        nn.Softplus(),
+                                        )
+
+        if init_weights:
+            self._initialize_weights()
+
+    def reparameterize(self, mu:torch.Tensor, b:torch.Tensor) -> torch.Tensor:
+        """draw a sample from a Laplace distribution with location mu and scale b (inverse cdf of uniform noise)"""
+        U = torch.rand_like(b) - .5
+        return mu - b * U.sign() * torch.log1p(-2 * U.abs())
+
+    def forward(self, x:torch.Tensor) -> tuple:
+        mu = self.encoder_mu(x)
+        b = self.encoder_b(x)
+        l = b.pow(-1)
+        z = self.reparameterize(mu, b)
+        return z, mu, b, l
+
+    def _initialize_weights(self) -> None:
+        mean, std = .1, .01
+        for m in self.encoder_mu.modules():
+            if isinstance(m, nn.Linear):
+                m.weight.data.normal_(mean, std)
+                m.bias.data.zero_()
+        for m in self.encoder_b.modules():
+            if isinstance(m, nn.Linear):
+                m.weight.data.normal_(0., std)
+                m.bias.data.fill_(-3.)
+
 def l1_regularization(model) -> torch.Tensor:
     l1_reg = torch.tensor(0., requires_grad=True)
     for n, p in model.named_parameters():
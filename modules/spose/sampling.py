@@ -19,6 +19,8 @@ def parseargs():
         parser.add_argument(*args, **kwargs)
     aa('--n_samples', type=int, default=1,
         help='define how many different synthetic triplet datasets you would like to sample')
+    aa('--n_mc_samples', type=int, default=20,
+        help='number of Monte-Carlo samples to estimate choice probabilities of the variational version')
     aa('--version', type=str, default='deterministic',
         choices=['deterministic', 'variational'],
         help='whether to apply a deterministic or variational version of SPoSE')
@@ -48,6 +50,7 @@ def parseargs():
 
 def run(
         n_samples:int,
+        n_mc_samples:int,
         version:str,
         task:str,
         modality:str,
@@ -80,6 +83,7 @@ def run(
                            results_dir=results_dir,
                            modality=modality,
                            version=version,
+                           data=None,
                            dim=embed_dim,
                            lmbda=lmbda,
                            rnd_seed=rnd_seed,
@@ -92,9 +96,9 @@ def run(
                                     model=model,
                                     val_batches=train_batches,
                                     version=version,
+                                    n_samples=n_mc_samples if version == 'variational' else None,
                                     task=task,
                                     device=device,
-                                    embed_dim=embed_dim,
                                     sampling=True,
                                     batch_size=batch_size,
                                     distance_metric=distance_metric
@@ -119,6 +123,7 @@ def initialize_args():
     class IDEArgs:
         def __init__(self):
             self.n_samples = 1
+            self.n_mc_samples = 20
             self.version = 'deterministic'
             self.task = 'odd_one_out'
             self.modality = 'behavioral/'
@@ -168,6 +173,7 @@ if __name__ == '__main__':
 
     run(
         n_samples=args.n_samples,
+        n_mc_samples=args.n_mc_samples,
         version=args.version,
         task=args.task,
         modality=args.modality,
@@ -203,6 +203,8 @@ def run(
 
     print(f'...Creating PATHs')
     print()
+    #root of the results index
+    results_root = results_dir
     if results_dir == './results/':
         results_dir = os.path.join(results_dir, modality, f'{embed_dim}d', str(lmbda), f'seed{rnd_seed:02d}')
     if not os.path.exists(results_dir):
@@ -307,7 +309,7 @@ def run(
         ################ validation ####################
         ################################################
 
-        avg_val_loss, avg_val_acc = utils.validation(model=model, val_batches=val_batches, task=task, device=device, distance_metric=distance_metric)
+        avg_val_loss, avg_val_acc = utils.validation(model=model, val_batches=val_batches, task=task, device=device, distance_metric=distance_metric, temperature=temperature)
 
         val_losses.append(avg_val_loss)
         val_accs.append(avg_val_acc)
@@ -375,6 +377,15 @@ def run(
     PATH = os.path.join(results_dir, 'results.json')
     with open(PATH, 'w') as results_file:
         json.dump(results, results_file)
+    #register finished run in the results index
+    utils.update_results_index(
+                               results_dir=results_root,
+                               run_dir=results_dir,
+                               modality=modality,
+                               dim=embed_dim,
+                               lmbda=lmbda,
+                               rnd_seed=rnd_seed,
+                               )
 
 if __name__ == "__main__":
     #parse all arguments and set random seeds
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__all__ = [
+            'get_offsets',
+            'n_triplets',
+            'rank_triplets',
+            'triplet_probas_',
+            'unrank_triplets',
+            ]
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from numba import njit, prange
+
+import utils as utils
+
+os.environ['PYTHONIOENCODING']='UTF-8'
+
+def parseargs():
+    parser = argparse.ArgumentParser()
+    def aa(*args, **kwargs):
+        parser.add_argument(*args, **kwargs)
+    aa('--in_path', type=str,
+        help='results folder of a trained SPoSE model (sparse_embed_epoch*.txt files) or .npy file with an items x dims embedding')
+    aa('--out_path', type=str,
+        help='folder where to store the triplet probability table')
+    aa('--temperature', type=float, default=1.,
+        help='softmax temperature (beta param) for choice randomness')
+    aa('--chunk_size', type=int, default=int(5e7),
+        help='approximate number of triplets per chunk')
+    aa('--num_threads', type=int, default=None,
+        help='number of threads used by numba to process a chunk in parallel')
+    args = parser.parse_args()
+    return args
+
+def initialize_args():
+    """
+    Initialize arguments based on the mode of execution (Command Line vs IDE).
+
+    When executed via command line, it parses the provided command-line arguments.
+    If executed from an IDE, it sets default values for the arguments.
+
+    Returns:
+        argparse.Namespace or IDEArgs: Argument object based on the mode of execution.
+    """
+
+    class IDEArgs:
+        def __init__(self):
+            self.in_path = './test/test_results/triplets/results'
+            self.out_path = './test/test_results/triplets/probas'
+            self.temperature = 1.
+            self.chunk_size = int(5e7)
+            self.num_threads = None
+
+    # Check if the script is executed via command line
+    if len(sys.argv) > 1:
+        # Parse command-line arguments using previously defined parseargs() function
+        args = parseargs()
+        logging.log(logging.INFO, "Parsed command-line arguments.")
+    else:
+        # Use IDEArgs class for default configurations when executing in IDE
+        args = IDEArgs()
+
+    return args
+
+def load_embedding(in_path:str) -> np.ndarray:
+    """load an items x dims embedding matrix"""
+    if os.path.isdir(in_path):
+        W, _ = utils.load_sparse_codes(in_path)
+    else:
+        with open(in_path, 'rb') as f:
+            W = np.load(f)
+    return np.ascontiguousarray(W, dtype=np.float32)
+
+################################################
+######### (un)ranking of triplets ##############
+################################################
+
+def n_triplets(n_items:int) -> int:
+    return n_items * (n_items - 1) * (n_items - 2) // 6
+
+def get_offsets(n_items:int) -> np.ndarray:
+    """row offset of the first triplet (i, i+1, i+2) for every i in the lexicographic enumeration of all triplets i < j < k"""
+    m = np.arange(n_items - 1, -1, -1, dtype=np.int64) #number of items after i
+    counts = m * (m - 1) // 2
+    return np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+
+def _pair_offsets(j_rel:np.ndarray, m:np.ndarray) -> np.ndarray:
+    """number of pairs (j', k) with j' < j_rel when choosing 2 out of m items in lexicographic order"""
+    return j_rel * (2 * m - j_rel - 1) // 2
+
+def unrank_triplets(ranks:np.ndarray, n_items:int) -> np.ndarray:
+    """map row indices of the triplet table to triplets (i, j, k) with i < j < k"""
+    ranks = np.asarray(ranks, dtype=np.int64)
+    offsets = get_offsets(n_items)
+    i = np.searchsorted(offsets, ranks, side='right') - 1
+    r = ranks - offsets[i]
+    m = n_items - 1 - i
+    #closed-form inverse of the pair offsets followed by a correction step for floating point errors
+    j_rel = np.floor(((2 * m - 1) - np.sqrt(np.maximum((2 * m - 1) ** 2 - 8 * r, 0))) / 2).astype(np.int64)
+    j_rel = np.clip(j_rel, 0, np.maximum(m - 2, 0))
+    j_rel += (_pair_offsets(j_rel + 1, m) <= r) & (j_rel + 1 <= m - 2)
+    j_rel -= _pair_offsets(j_rel, m) > r
+    k_rel = r - _pair_offsets(j_rel, m) + j_rel + 1
+    return np.stack([i, i + 1 + j_rel, i + 1 + k_rel], axis=1)
+
+def rank_triplets(triplets:np.ndarray, n_items:int) -> np.ndarray:
+    """map triplets (in any order of their items) to row indices of the triplet table"""
+    i, j, k = np.sort(np.asarray(triplets, dtype=np.int64), axis=1).T
+    m = n_items - 1 - i
+    return get_offsets(n_items)[i] + _pair_offsets(j - i - 1, m) + (k - j - 1)
+
+################################################
+######### triplet probability table ############
+################################################
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _triplet_probas_kernel(
+                            S:np.ndarray,
+                            offsets:np.ndarray,
+                            i_start:int,
+                            i_stop:int,
+                            row_start:int,
+                            temperature:float,
+                            out:np.ndarray,
+) -> None:
+    N = S.shape[0]
+    for i in prange(i_start, i_stop):
+        row = offsets[i] - row_start
+        for j in range(i + 1, N):
+            s_ij = S[i, j] / temperature
+            for k in range(j + 1, N):
+                s_jk = S[j, k] / temperature
+                s_ik = S[i, k] / temperature
+                s_max = max(s_ij, max(s_ik, s_jk))
+                e_i = np.exp(s_jk - s_max)
+                e_j = np.exp(s_ik - s_max)
+                e_k = np.exp(s_ij - s_max)
+                z = e_i + e_j + e_k
+                out[row, 0] = e_i / z
+                out[row, 1] = e_j / z
+                out[row, 2] = e_k / z
+                row += 1
+
+def get_chunks(n_items:int, chunk_size:int) -> list:
+    """split the range of first items i into chunks of approximately <chunk_size> triplets"""
+    offsets = get_offsets(n_items)
+    boundaries = np.searchsorted(offsets, np.arange(0, n_triplets(n_items), max(int(chunk_size), 1)), side='left')
+    boundaries = np.unique(np.concatenate((boundaries, [n_items])))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def triplet_probas_(
+                    W:np.ndarray,
+                    out_path:str,
+                    temperature:float=1.,
+                    chunk_size:int=int(5e7),
+) -> np.memmap:
+    """compute the odd-one-out probabilities for every triplet i < j < k of an items x dims embedding
+
+    Triplets are enumerated in lexicographic order, such that row r of the (C(N,3), 3) table belongs to
+    unrank_triplets(r, N). Columns hold the probabilities of i, j and k being the odd-one-out respectively.
+    """
+    N = W.shape[0]
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    #similarity matrix via BLAS (float32)
+    S = W @ W.T
+    offsets = get_offsets(N)
+    probas = np.lib.format.open_memmap(
+                                        os.path.join(out_path, 'triplet_probas.npy'),
+                                        mode='w+',
+                                        dtype=np.float32,
+                                        shape=(n_triplets(N), 3),
+                                        )
+    for i_start, i_stop in get_chunks(N, chunk_size):
+        row_start = offsets[i_start]
+        row_stop = offsets[i_stop] if i_stop < N else n_triplets(N)
+        _triplet_probas_kernel(S, offsets, i_start, i_stop, row_start, float(temperature), probas[row_start:row_stop])
+        probas.flush()
+        logging.info(f'Computed probabilities for triplets with first item {i_start}-{i_stop-1} of {N}')
+
+    with open(os.path.join(out_path, 'triplet_probas.json'), 'w') as f:
+        json.dump({
+                    'n_items': N,
+                    'n_triplets': n_triplets(N),
+                    'temperature': temperature,
+                    'order': 'lexicographic (i < j < k)',
+                    'columns': ['p_odd_i', 'p_odd_j', 'p_odd_k'],
+                    }, f, indent=2)
+    return probas
+
+if __name__ == "__main__":
+    #parse all arguments
+    args = initialize_args()
+    if args.num_threads:
+        import numba
+        numba.set_num_threads(args.num_threads)
+    W = load_embedding(args.in_path)
+    triplet_probas_(
+                    W=W,
+                    out_path=args.out_path,
+                    temperature=args.temperature,
+                    chunk_size=args.chunk_size,
+    )
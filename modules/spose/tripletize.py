@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
+import importlib.util
+import json
 import os
 import sys
 import logging
@@ -10,6 +13,9 @@ import re
 import torch
 import scipy.io
 import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
 
 os.environ['PYTHONIOENCODING']='UTF-8'
 
@@ -30,6 +36,12 @@ def parseargs():
         help='number of triplet samples')
     aa('--rnd_seed', type=int, default=42,
         help='random seed for reproducibility')
+    aa('--cache_dir', type=str, default=None,
+        help='folder where to cache converted input data (if not provided will resort to .tripletize_cache/ next to the input file)')
+    aa('--shard_size', type=int, default=None,
+        help='if set, stream triplets into shards of this many triplets instead of holding all of them in memory')
+    aa('--n_workers', type=int, default=1,
+        help='number of worker processes used in streaming (sharded) mode')
     args = parser.parse_args()
     return args
 
@@ -52,6 +64,9 @@ def initialize_args():
             self.temperature = None # Only when using probabilistic method
             self.n_samples = 1000
             self.rnd_seed = 42
+            self.cache_dir = None
+            self.shard_size = None # Only when streaming triplets into shards
+            self.n_workers = 1
 
     # Check if the script is executed via command line
     if len(sys.argv) > 1:
@@ -64,22 +79,52 @@ def initialize_args():
 
     return args
 
-def load_data(in_path:str) -> np.ndarray:
+def read_matrix_(in_path:str, sep:str) -> np.ndarray:
+    """parse a delimited text file of floats (uses the multi-threaded pyarrow CSV reader if it is installed)"""
+    engine = 'pyarrow' if (sep == ',' and importlib.util.find_spec('pyarrow') is not None) else 'c'
+    return pd.read_csv(in_path, sep=sep, header=None, engine=engine, dtype=np.float32).to_numpy()
+
+def parse_data_(in_path:str) -> np.ndarray:
+    if re.search(r'mat$', in_path):
+        X = np.vstack([v for v in scipy.io.loadmat(in_path).values() if isinstance(v, np.ndarray) and np.issubdtype(v.dtype, np.floating)])
+    elif re.search(r'txt$', in_path):
+        X = read_matrix_(in_path, sep=r'\s+')
+    elif re.search(r'csv$', in_path):
+        X = read_matrix_(in_path, sep=',')
+    else:
+        with open(in_path, 'rb') as f:
+            X = np.load(f)
+    return remove_nans_(X).astype(np.float32)
+
+def get_cache_path(in_path:str, cache_dir:str=None) -> str:
+    """path of the converted input in the cache (keyed by absolute path, mtime and size of the input file)"""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(in_path)), '.tripletize_cache')
+    stat = os.stat(in_path)
+    key = hashlib.sha1(f'{os.path.abspath(in_path)}:{stat.st_mtime_ns}:{stat.st_size}'.encode('utf-8')).hexdigest()[:16]
+    file_name = os.path.splitext(os.path.basename(in_path))[0]
+    return os.path.join(cache_dir, f'{file_name}_{key}.npy')
+
+def load_data(in_path:str, cache_dir:str=None, use_cache:bool=True) -> np.ndarray:
+    """load input data as float32 matrix; parsed inputs are cached as .npy files and memory-mapped on later calls"""
     if re.search(r'(mat|txt|csv|npy)$', in_path):
+        cache_path = get_cache_path(in_path, cache_dir) if use_cache else None
+        if cache_path is not None and os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode='r')
         try:
-            if re.search(r'mat$', in_path):
-                X = np.vstack([v for v in scipy.io.loadmat(in_path).values() if isinstance(v, np.ndarray) and v.dtype == np.float])
-            elif re.search(r'txt$', in_path):
-                X = np.loadtxt(in_path)
-            elif re.search(r'csv$', in_path):
-                X = np.loadtxt(in_path, delimiter=',')
-            else:
-                with open(in_path, 'rb') as f:
-                    X = np.load(f)
-            X = remove_nans_(X)
-            return X
-        except:
+            X = parse_data_(in_path)
+        except Exception:
             raise Exception('\nInput data is not in the correct format\n')
+        if cache_path is None:
+            return X
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        #write to a temporary file first such that concurrent calls never read a partially written cache entry
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, X)
+        os.replace(tmp_path, cache_path)
+        return np.load(cache_path, mmap_mode='r')
     else:
         raise Exception('\nCannot tripletize input data other than .mat, .txt, .csv, .npy\n')
 
@@ -101,11 +146,12 @@ def tripletize_(
                 method:str,
                 temperature:float,
                 n_samples:float,
+                cache_dir:str=None,
 ) -> None:
     """create triplets of object embedding similarities, and for each triplet find the odd-one-out"""
     sampling_constant = n_samples / 10
     #load input data (e.g., word embeddings, image features)
-    X = load_data(in_path)
+    X = load_data(in_path, cache_dir)
     #create similarity matrix
     #TODO: figure out whether an affinity matrix might be more reasonable (i.e., informative) than a simple similarity matrix
     S = X @ X.T
@@ -153,16 +199,191 @@ def tripletize_(
     with open(os.path.join(out_path, 'test_10.npy'), 'wb') as test_file:
         np.save(test_file, test_triplets)
 
+################################################
+######### streaming (sharded) tripletizing #####
+################################################
+
+#embedding matrix of the current worker process (set once by the pool initializer)
+_X = None
+
+def _init_worker(X:np.ndarray) -> None:
+    global _X
+    _X = X
+
+def hash_split_(triplets:np.ndarray, n_items:int, test_fraction:float=.1) -> np.ndarray:
+    """assign triplets to the test split by hashing their item set (independent of the order of the items)"""
+    canonical = np.sort(triplets, axis=1).astype(np.uint64)
+    n_items = np.uint64(n_items)
+    keys = (canonical[:, 0] * n_items + canonical[:, 1]) * n_items + canonical[:, 2]
+    #splitmix64 finalizer to decorrelate neighbouring keys
+    keys ^= keys >> np.uint64(30)
+    keys *= np.uint64(0xbf58476d1ce4e5b9)
+    keys ^= keys >> np.uint64(27)
+    keys *= np.uint64(0x94d049bb133111eb)
+    keys ^= keys >> np.uint64(31)
+    return (keys % np.uint64(10000)) < np.uint64(round(test_fraction * 10000))
+
+def choose_odd_one_outs(
+                        X:np.ndarray,
+                        rnd_samples:np.ndarray,
+                        method:str,
+                        temperature:float,
+                        rng:np.random.Generator,
+) -> np.ndarray:
+    """vectorized version of the choice loop in tripletize_ (odd-one-out choice is placed in the last column)"""
+    i, j, k = rnd_samples.T
+    sims = np.stack([
+                    np.einsum('nd,nd->n', X[i], X[j]),
+                    np.einsum('nd,nd->n', X[i], X[k]),
+                    np.einsum('nd,nd->n', X[j], X[k]),
+                    ], axis=1)
+    odd_one_outs = np.stack([k, j, i], axis=1)
+    if method == 'probabilistic':
+        assert isinstance(temperature, float), '\nFloat for softmax temperature is required in probabilistic approach\n'
+        #Gumbel-max trick: sorting perturbed logits draws choices without replacement conditioned on the softmax PMF
+        sims = temperature * sims + rng.gumbel(size=sims.shape)
+    return np.take_along_axis(odd_one_outs, np.argsort(sims, axis=1), axis=1)
+
+def _save_shard(out_path:str, split:str, worker_id:int, shard_id:int, triplets:np.ndarray) -> dict:
+    file_name = f'{split}_w{worker_id:03d}_{shard_id:05d}.npy'
+    with open(os.path.join(out_path, file_name), 'wb') as f:
+        np.save(f, triplets)
+    return {'file': file_name, 'split': split, 'n_triplets': len(triplets)}
+
+def _tripletize_worker(
+                        worker_id:int,
+                        seed_seq:np.random.SeedSequence,
+                        n_samples:int,
+                        out_path:str,
+                        method:str,
+                        temperature:float,
+                        shard_size:int,
+                        test_fraction:float,
+) -> list:
+    """sample <n_samples> triplets with an independent RNG stream and write them into fixed-size shards"""
+    rng = np.random.default_rng(seed_seq)
+    N = _X.shape[0]
+    buffers = {'train': [], 'test': []}
+    n_buffered = {'train': 0, 'test': 0}
+    n_shards = {'train': 0, 'test': 0}
+    shards = []
+
+    def flush(split:str, final:bool=False) -> None:
+        if n_buffered[split] == 0:
+            return
+        triplets = np.concatenate(buffers[split])
+        while len(triplets) >= shard_size or (final and len(triplets) > 0):
+            shards.append(_save_shard(out_path, split, worker_id, n_shards[split], triplets[:shard_size]))
+            n_shards[split] += 1
+            triplets = triplets[shard_size:]
+        buffers[split] = [triplets]
+        n_buffered[split] = len(triplets)
+
+    n_left = n_samples
+    while n_left > 0:
+        n_draw = min(n_left, shard_size)
+        rnd_samples = rng.integers(N, size=(int(n_draw * 1.1) + 10, 3))
+        #filter for unique triplets (i, j, k have to be different indices); duplicates are only removed within a chunk
+        is_set = (rnd_samples[:, 0] != rnd_samples[:, 1]) & (rnd_samples[:, 0] != rnd_samples[:, 2]) & (rnd_samples[:, 1] != rnd_samples[:, 2])
+        rnd_samples = np.unique(rnd_samples[is_set], axis=0)[:n_draw]
+        rng.shuffle(rnd_samples)
+        triplets = choose_odd_one_outs(_X, rnd_samples, method, temperature, rng)
+        is_test = hash_split_(triplets, N, test_fraction)
+        for split, mask in (('train', ~is_test), ('test', is_test)):
+            buffers[split].append(triplets[mask])
+            n_buffered[split] += int(mask.sum())
+            flush(split)
+        n_left -= len(triplets)
+
+    for split in buffers:
+        flush(split, final=True)
+    return shards
+
+def tripletize_sharded_(
+                        in_path:str,
+                        out_path:str,
+                        method:str,
+                        temperature:float,
+                        n_samples:float,
+                        shard_size:int,
+                        n_workers:int=1,
+                        rnd_seed:int=42,
+                        test_fraction:float=.1,
+                        cache_dir:str=None,
+) -> dict:
+    """streaming version of tripletize_ that splits the sampling across a process pool and writes triplets into shards
+
+    Every worker draws from its own RNG stream (spawned from a single SeedSequence) and assigns triplets to the
+    train or test split by hashing the triplet, so that no global shuffle is needed. A manifest.json file in
+    <out_path> lists all shards and is used by utils.load_data to load the triplets.
+    """
+    X = load_data(in_path, cache_dir)
+    N = X.shape[0]
+    assert N >= 3, '\nAt least three objects are required to sample triplets\n'
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    n_samples = int(n_samples)
+    n_workers = max(1, min(int(n_workers), n_samples))
+    seed_seqs = np.random.SeedSequence(rnd_seed).spawn(n_workers)
+    samples_per_worker = [len(chunk) for chunk in np.array_split(np.arange(n_samples), n_workers)]
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(X,)) as pool:
+        futures = [
+                    pool.submit(
+                                _tripletize_worker,
+                                worker_id,
+                                seed_seq,
+                                n,
+                                out_path,
+                                method,
+                                temperature,
+                                shard_size,
+                                test_fraction,
+                    )
+                    for worker_id, (seed_seq, n) in enumerate(zip(seed_seqs, samples_per_worker))
+                    ]
+        shards = [shard for future in futures for shard in future.result()]
+
+    manifest = {
+                'n_items': N,
+                'method': method,
+                'temperature': temperature,
+                'rnd_seed': rnd_seed,
+                'test_fraction': test_fraction,
+                'shard_size': shard_size,
+                'n_train': sum(s['n_triplets'] for s in shards if s['split'] == 'train'),
+                'n_test': sum(s['n_triplets'] for s in shards if s['split'] == 'test'),
+                'shards': shards,
+                }
+    with open(os.path.join(out_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
 if __name__ == "__main__":
     #parse all arguments
     args = initialize_args()
     np.random.seed(args.rnd_seed)
     random.seed(args.rnd_seed)
     #tripletize data
-    tripletize_(
-                in_path=args.in_path,
-                out_path=args.out_path,
-                method=args.method,
-                temperature=args.temperature,
-                n_samples=args.n_samples,
-    )
+    if args.shard_size:
+        tripletize_sharded_(
+                            in_path=args.in_path,
+                            out_path=args.out_path,
+                            method=args.method,
+                            temperature=args.temperature,
+                            n_samples=args.n_samples,
+                            shard_size=args.shard_size,
+                            n_workers=args.n_workers,
+                            rnd_seed=args.rnd_seed,
+                            cache_dir=args.cache_dir,
+        )
+    else:
+        tripletize_(
+                    in_path=args.in_path,
+                    out_path=args.out_path,
+                    method=args.method,
+                    temperature=args.temperature,
+                    n_samples=args.n_samples,
+                    cache_dir=args.cache_dir,
+        )
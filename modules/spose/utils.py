@@ -3,6 +3,7 @@
 
 __all__ = [
             'BatchGenerator',
+            'CheckpointRegistry',
             'TripletDataset',
             'choice_accuracy',
             'cross_entropy_loss',
@@ -12,6 +13,7 @@ __all__ = [
             'compute_trils',
             'cos_mat',
             'cross_correlate_latent_dims',
+            'cross_correlate_seeds',
             'encode_as_onehot',
             'get_cut_off',
             'get_digits',
@@ -28,34 +30,54 @@ __all__ = [
             'load_model',
             'load_sparse_codes',
             'load_ref_images',
+            'load_shards',
             'load_targets',
             'load_weights',
+            'align_pmfs',
+            'embed_triplets',
+            'merge_counts',
+            'compute_divergences',
+            'compute_pmfs',
+            'decode_triplets',
+            'encode_triplets',
+            'get_choice_distributions',
             'l2_reg_',
             'matmul',
+            'mc_sampling',
             'merge_dicts',
             'pickle_file',
+            'query_results',
+            'refresh_results_index',
+            'update_results_index',
             'unpickle_file',
             'pearsonr',
             'prune_weights',
+            'pruning_curve',
             'rsm',
+            'rsm_condensed',
             'rsm_pred',
+            'rsm_pred_mc',
             'save_weights_',
             'sparsity',
             'spose2rsm_odd_one_out',
             'avg_sparsity',
             'softmax',
             'sort_weights',
+            'temperature_profile',
+            'test',
             'trinomial_loss',
             'trinomial_probs',
             'validation',
         ]
 
+import hashlib
 import json
 import logging
 import math
 import os
 import pickle
 import re
+import sqlite3
 import torch
 import warnings
 
@@ -64,10 +86,12 @@ import pandas as pd
 import skimage.io as io
 import torch.nn.functional as F
 
-from collections import defaultdict, Counter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import combinations, permutations
 from numba import njit, jit, prange
 from os.path import join as pjoin
+from scipy.optimize import linear_sum_assignment
 from skimage.transform import resize
 from torch.optim import Adam, AdamW
 from torch.utils.data.distributed import DistributedSampler
@@ -149,16 +173,90 @@ def load_inds_and_item_names(folder:str='./data') -> Tuple[np.ndarray]:
     sortindex = pd.read_table(pjoin(folder, 'sortindex'), header=None)[0].values
     return item_names, sortindex
 
-def load_ref_images(img_folder:str, item_names:np.ndarray) -> np.ndarray:
-    ref_images = np.array([resize(io.imread(pjoin('./reference_images', name + '.jpg')), (400, 400), anti_aliasing=True) for name in item_names])
-    return ref_images
+def get_thumbnail_cache_path(img_paths:List[str], size:Tuple[int, int], cache_dir:str) -> str:
+    """path of the cached thumbnails (keyed by path, mtime and size of every image file and the thumbnail size)"""
+    digest = hashlib.sha1(f'{size[0]}x{size[1]}'.encode('utf-8'))
+    for img_path in img_paths:
+        stat = os.stat(img_path)
+        digest.update(f'{os.path.abspath(img_path)}:{stat.st_mtime_ns}:{stat.st_size}'.encode('utf-8'))
+    return pjoin(cache_dir, f'ref_images_{digest.hexdigest()[:16]}.npy')
+
+def load_thumbnail_(img_path:str, size:Tuple[int, int]) -> np.ndarray:
+    """decode an image and resize it to an RGB uint8 thumbnail"""
+    img = io.imread(img_path)
+    if img.ndim == 2:
+        img = np.stack([img] * 3, axis=-1)
+    img = resize(img[..., :3], size, anti_aliasing=True)
+    return np.round(img * 255).astype(np.uint8)
+
+def load_ref_images(
+                    img_folder:str,
+                    item_names:np.ndarray,
+                    size:Tuple[int, int]=(400, 400),
+                    n_threads:int=None,
+                    cache_dir:str=None,
+                    use_cache:bool=True,
+) -> np.ndarray:
+    """load (n_items, height, width, 3) uint8 reference images
+
+    Images are decoded and resized in a thread pool and stored as a single memory-mapped block in a
+    cache next to the images, such that repeated calls only map the cached block.
+    """
+    img_paths = [pjoin(img_folder, name + '.jpg') for name in item_names]
+    cache_path = None
+    if use_cache:
+        cache_path = get_thumbnail_cache_path(img_paths, size, cache_dir or pjoin(img_folder, '.thumbnail_cache'))
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode='r')
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        #write into a temporary file that atomically replaces the cache once all images are decoded
+        tmp_path = f'{cache_path[:-len(".npy")]}_{os.getpid()}.tmp.npy'
+        ref_images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(img_paths), *size, 3))
+    else:
+        ref_images = np.empty((len(img_paths), *size, 3), dtype=np.uint8)
+
+    def load_(i:int) -> None:
+        ref_images[i] = load_thumbnail_(img_paths[i], size)
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(load_, range(len(img_paths))))
+    except BaseException:
+        #do not leave a partially filled block behind in the cache
+        if cache_path is not None:
+            del ref_images
+            os.remove(tmp_path)
+        raise
+
+    if cache_path is None:
+        return ref_images
+    ref_images.flush()
+    del ref_images
+    os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
 
 def load_concepts(folder:str='./data') -> pd.DataFrame:
     concepts = pd.read_csv(pjoin(folder, 'category_mat_manual.tsv'), encoding='utf-8', sep='\t')
     return concepts
 
+def load_shards(triplets_dir:str, split:str) -> np.ndarray:
+    """concatenate all shards of a split listed in the manifest written by tripletize.tripletize_sharded_"""
+    with open(pjoin(triplets_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    shards = [np.load(pjoin(triplets_dir, s['file']), mmap_mode='r') for s in manifest['shards'] if s['split'] == split]
+    if len(shards) == 0:
+        return np.zeros((0, 3), dtype=int)
+    return np.concatenate(shards)
+
 def load_data(device:torch.device, triplets_dir:str, inference:bool=False) -> Tuple[torch.Tensor]:
     """load train and test triplet datasets into memory"""
+    if os.path.exists(pjoin(triplets_dir, 'manifest.json')):
+        #triplets were streamed into shards
+        test_triplets = torch.from_numpy(load_shards(triplets_dir, 'test')).to(device).type(torch.LongTensor)
+        if inference:
+            return test_triplets
+        train_triplets = torch.from_numpy(load_shards(triplets_dir, 'train')).to(device).type(torch.LongTensor)
+        return train_triplets, test_triplets
     if inference:
         with open(pjoin(triplets_dir, 'test_triplets.npy'), 'rb') as test_triplets:
             test_triplets = torch.from_numpy(np.load(test_triplets)).to(device).type(torch.LongTensor)
@@ -219,7 +317,7 @@ def load_batches(
 
 def l2_reg_(model, weight_decay:float=1e-5) -> torch.Tensor:
     loc_norms_squared = .5 * (model.encoder_mu[0].weight.pow(2).sum() + model.encoder_mu[0].bias.pow(2).sum())
-    scale_norms_squared = (model.encoder_b[0].weight.pow(2).sum() +  model.encoder_mu[0].bias.pow(2).sum())
+    scale_norms_squared = (model.encoder_b[0].weight.pow(2).sum() + model.encoder_b[0].bias.pow(2).sum())
     l2_reg = weight_decay * (loc_norms_squared + scale_norms_squared)
     return l2_reg
 
@@ -235,19 +333,19 @@ def cross_entropy_loss(sims:tuple, t:torch.Tensor) -> torch.Tensor:
 
 def compute_similarities(anchor:torch.Tensor, positive:torch.Tensor, negative:torch.Tensor, method:str, distance_metric:str = 'dot') -> Tuple:
     if distance_metric == 'dot':
-        pos_sim = torch.sum(anchor * positive, dim=1)
-        neg_sim = torch.sum(anchor * negative, dim=1)
+        pos_sim = torch.sum(anchor * positive, dim=-1)
+        neg_sim = torch.sum(anchor * negative, dim=-1)
         if method == 'odd_one_out':
-            neg_sim_2 = torch.sum(positive * negative, dim=1)
+            neg_sim_2 = torch.sum(positive * negative, dim=-1)
             return pos_sim, neg_sim, neg_sim_2
         else:
             return pos_sim, neg_sim
     elif distance_metric == 'euclidean':
-        pos_sim = -1*torch.sqrt(torch.sum(torch.square(torch.sub(anchor,positive)), dim=1))
-        neg_sim = -1*torch.sqrt(torch.sum(torch.square(torch.sub(anchor,negative)), dim=1))
+        pos_sim = -1*torch.sqrt(torch.sum(torch.square(torch.sub(anchor,positive)), dim=-1))
+        neg_sim = -1*torch.sqrt(torch.sum(torch.square(torch.sub(anchor,negative)), dim=-1))
         
         if method == 'odd_one_out':
-            neg_sim_2 = -1*torch.sqrt(torch.sum(torch.square(torch.sub(positive,negative)), dim=1))
+            neg_sim_2 = -1*torch.sqrt(torch.sum(torch.square(torch.sub(positive,negative)), dim=-1))
             return pos_sim, neg_sim, neg_sim_2
         else:
             return pos_sim, neg_sim
@@ -293,121 +391,216 @@ def remove_zeros(W:np.ndarray, eps:float=.1) -> np.ndarray:
 def get_seeds(PATH:str) -> List[str]:
     return [dir.name for dir in os.scandir(PATH) if dir.is_dir() and dir.name.startswith('seed')]
 
-def seed_sampling(PATH:str) -> np.ndarray:
-    seed = np.random.choice(get_seeds(PATH))
-    with open(os.path.join(PATH, seed, 'test_probas.npy'), 'rb') as f:
-        probas = np.load(f)
-    return probas
-
-def instance_sampling(probas:np.ndarray) -> np.ndarray:
-    rnd_sample = np.random.choice(np.arange(len(probas)), size=len(probas), replace=True)
-    probas_draw = probas[rnd_sample]
-    return probas_draw
-
-def get_global_averages(avg_probas:dict) -> np.ndarray:
-    sorted_bins = dict(sorted(avg_probas.items()))
-    return np.array([np.mean(p) for p in sorted_bins.values()])
-
-def compute_pm(probas:np.ndarray) -> Tuple[np.ndarray, dict]:
-    """compute probability mass for every choice"""
-    avg_probas = defaultdict(list)
-    count_vector = np.zeros((2, 11))
-    for pmf in probas:
-        indices = np.round(pmf*10).astype(int)
-        count_vector[0, indices[0]] += 1
-        count_vector[1, indices] += 1
-        for k, p in enumerate(pmf):
-            avg_probas[int(indices[k])].append(p)
-    model_confidences = count_vector[0]/count_vector[1]
-    avg_probas = get_global_averages(avg_probas)
+def load_seed_probas(PATH:str) -> List[np.ndarray]:
+    """load the test set probabilities of every seed once"""
+    seed_probas = []
+    for seed in get_seeds(PATH):
+        with open(os.path.join(PATH, seed, 'test_probas.npy'), 'rb') as f:
+            seed_probas.append(np.load(f))
+    return seed_probas
+
+def compute_pm(probas:np.ndarray, n_bins:int=11) -> Tuple[np.ndarray, np.ndarray]:
+    """compute probability mass for every choice (bins without any probabilities are NaN)"""
+    indices = np.round(probas*(n_bins-1)).astype(int)
+    first_counts = np.bincount(indices[:, 0], minlength=n_bins)
+    counts = np.bincount(indices.ravel(), minlength=n_bins)
+    sums = np.bincount(indices.ravel(), weights=probas.ravel(), minlength=n_bins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        model_confidences = first_counts/counts
+        avg_probas = sums/counts
     return model_confidences, avg_probas
 
 def mse(avg_p:np.ndarray, confidences:np.ndarray) -> float:
-    return np.mean((avg_p - confidences)**2)
-
-def bootstrap_calibrations(PATH:str, alpha:float, n_bootstraps:int=1000) -> np.ndarray:
+    return np.nanmean((avg_p - confidences)**2, axis=-1)
+
+def _bootstrap_mses(
+                    seed_probas:List[np.ndarray],
+                    n_bootstraps:int,
+                    seed_seq:np.random.SeedSequence,
+                    n_bins:int=11,
+                    max_elements:int=int(2e7),
+) -> np.ndarray:
+    """draw bootstrap samples (random seed + resampled instances) as index matrices and compute their MSEs at once"""
+    rng = np.random.default_rng(seed_seq)
+    seeds = rng.integers(len(seed_probas), size=n_bootstraps)
     mses = np.zeros(n_bootstraps)
-    for i in range(n_bootstraps):
-        probas = seed_sampling(PATH)
-        probas_draw = instance_sampling(probas)
-        confidences, avg_p = compute_pm(probas_draw, alpha)
-        mses[i] += mse(avg_p, confidences)
+    for s in np.unique(seeds):
+        probas = seed_probas[s]
+        indices = np.round(probas*(n_bins-1)).astype(int)
+        n = len(probas)
+        bootstraps = np.where(seeds == s)[0]
+        #number of bootstraps that are processed at once is bounded by memory
+        chunk_size = max(1, max_elements // (3 * n))
+        for start in range(0, len(bootstraps), chunk_size):
+            chunk = bootstraps[start:start+chunk_size]
+            rnd_samples = rng.integers(n, size=(len(chunk), n))
+            #offset bins of every bootstrap such that a single bincount yields all histograms
+            offsets = (np.arange(len(chunk)) * n_bins)[:, None]
+            first_counts = np.bincount((indices[rnd_samples, 0] + offsets).ravel(), minlength=len(chunk)*n_bins)
+            sampled = indices[rnd_samples] + offsets[..., None]
+            counts = np.bincount(sampled.ravel(), minlength=len(chunk)*n_bins)
+            sums = np.bincount(sampled.ravel(), weights=probas[rnd_samples].ravel(), minlength=len(chunk)*n_bins)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                confidences = (first_counts/counts).reshape(len(chunk), n_bins)
+                avg_p = (sums/counts).reshape(len(chunk), n_bins)
+            mses[chunk] = mse(avg_p, confidences)
     return mses
 
+def bootstrap_calibrations(
+                           PATH:str,
+                           alpha:float=None,
+                           n_bootstraps:int=1000,
+                           n_jobs:int=1,
+                           rnd_seed:int=None,
+) -> np.ndarray:
+    """bootstrap the calibration MSE over seeds and test instances (alpha is unused and only kept for backward compatibility)
+
+    Without rnd_seed, the seed is drawn from the global numpy RNG, such that np.random.seed makes bootstraps reproducible.
+    """
+    if rnd_seed is None:
+        rnd_seed = np.random.randint(2**32, dtype=np.int64)
+    seed_probas = load_seed_probas(PATH)
+    n_jobs = max(1, min(n_jobs, n_bootstraps))
+    seed_seqs = np.random.SeedSequence(rnd_seed).spawn(n_jobs)
+    n_per_job = [len(chunk) for chunk in np.array_split(np.arange(n_bootstraps), n_jobs)]
+    if n_jobs == 1:
+        return _bootstrap_mses(seed_probas, n_bootstraps, seed_seqs[0])
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        mses = pool.map(_bootstrap_mses, [seed_probas] * n_jobs, n_per_job, seed_seqs)
+    return np.concatenate(list(mses))
+
 def get_model_confidence_(PATH:str) -> Tuple[np.ndarray, np.ndarray]:
-    seeds = get_seeds(PATH)
-    confidence_scores = np.zeros((len(seeds), 11))
-    avg_probas = np.zeros((len(seeds), 11))
-    for i, seed in enumerate(seeds):
-        with open(os.path.join(PATH, seed, 'test_probas.npy'), 'rb') as f:
-            confidence, avg_p = compute_pm(np.load(f))
-            confidence_scores[i] += confidence
-            avg_probas[i] += avg_p
+    seed_probas = load_seed_probas(PATH)
+    confidence_scores = np.zeros((len(seed_probas), 11))
+    avg_probas = np.zeros((len(seed_probas), 11))
+    for i, probas in enumerate(seed_probas):
+        confidence, avg_p = compute_pm(probas)
+        confidence_scores[i] += confidence
+        avg_probas[i] += avg_p
     return confidence_scores, avg_probas
 
 def smoothing_(p:np.ndarray, alpha:float=.1) -> np.ndarray:
-    return (p + alpha) / np.sum(p + alpha)
+    return (p + alpha) / np.sum(p + alpha, axis=-1, keepdims=True)
 
 def entropy_(p:np.ndarray) -> np.ndarray:
-    return np.sum(np.where(p == 0, 0, p*np.log(p)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(np.where(p == 0, 0, p*np.log(p)), axis=-1)
 
-def cross_entropy_(p:np.ndarray, q:np.ndarray, alpha:float) -> float:
-    return -np.sum(p*np.log(smoothing_(q, alpha)))
+def cross_entropy_(p:np.ndarray, q:np.ndarray, alpha:float=.1) -> np.ndarray:
+    return -np.sum(p*np.log(smoothing_(q, alpha)), axis=-1)
 
-def kld_(p:np.ndarray, q:np.ndarray, alpha:float) -> float:
+def kld_(p:np.ndarray, q:np.ndarray, alpha:float=.1) -> np.ndarray:
     return entropy_(p) + cross_entropy_(p, q, alpha)
 
-def compute_divergences(human_pmfs:dict, model_pmfs:dict, metric:str='kld') -> np.ndarray:
-    assert len(human_pmfs) == len(model_pmfs), '\nNumber of triplets in human and model distributions must correspond.\n'
-    divergences = np.zeros(len(human_pmfs))
-    for i, (triplet, p) in enumerate(human_pmfs.items()):
-        q = model_pmfs[triplet]
-        div = kld_(p, q) if metric  == 'kld' else cross_entropy_(p, q)
-        divergences[i] += div
-    return divergences
-
-def mat2py(triplet:tuple) -> tuple:
-    return tuple(np.asarray(triplet)-1)
-
-def pmf(hist:dict) -> np.ndarray:
-    values = np.array(list(hist.values()))
-    return values/np.sum(values)
-
-def histogram(choices:list, behavior:bool=False) -> dict:
-    hist = {i+1 if behavior else i: 0 for i in range(3)}
-    for choice in choices:
-        hist[choice if behavior else choice.item()] += 1
-    return hist
-
-def compute_pmfs(choices:dict, behavior:bool) -> dict:
-    pmfs = {mat2py(t) if behavior else t: pmf(histogram(c, behavior)) for t, c in choices.items()}
-    return pmfs
-
-def get_choice_distributions(test_set:pd.DataFrame) -> dict:
-    """function to compute human choice distributions and corresponding pmfs"""
-    triplets = test_set[['trip.1', 'trip.2', 'trip.3']]
-    test_set['triplets'] = list(map(tuple, triplets.to_numpy()))
-    unique_triplets = test_set.triplets.unique()
-    choice_distribution = defaultdict(list)
-    for triplet in unique_triplets:
-        choices = list(test_set[test_set['triplets']==triplet].choice.values)
-        sorted_choices = [np.where(np.argsort(triplet)+1==c)[0][0]+1 for c in choices]
-        sorted_triplet = tuple(sorted(triplet))
-        choice_distribution[sorted_triplet].extend(sorted_choices)
-    choice_pmfs = compute_pmfs(choice_distribution, behavior=True)
-    return choice_pmfs
-
-def collect_choices(probas:np.ndarray, human_choices:np.ndarray, model_choices:dict) -> dict:
-    """collect model choices at inference time"""
-    probas = probas.flip(dims=[1])
-    for pmf, choices in zip(probas, human_choices):
-        sorted_choices = tuple(np.sort(choices))
-        model_choices[sorted_choices].append(np.argmax(pmf[np.argsort(choices)]))
-    return model_choices
+def compute_divergences(human_pmfs:np.ndarray, model_pmfs:np.ndarray, metric:str='kld', alpha:float=.1) -> np.ndarray:
+    """divergences between aligned (n_triplets, 3) human and model pmfs (see align_pmfs)"""
+    assert human_pmfs.shape == model_pmfs.shape, '\nNumber of triplets in human and model distributions must correspond.\n'
+    if metric == 'kld':
+        return kld_(human_pmfs, model_pmfs, alpha)
+    return cross_entropy_(human_pmfs, model_pmfs, alpha)
+
+def encode_triplets(triplets:np.ndarray, n_items:int) -> np.ndarray:
+    """encode canonical (sorted) triplets as single int64 keys i*N^2 + j*N + k"""
+    i, j, k = np.sort(np.asarray(triplets, dtype=np.int64), axis=1).T
+    return (i * n_items + j) * n_items + k
+
+def decode_triplets(keys:np.ndarray, n_items:int) -> np.ndarray:
+    """decode int64 keys into sorted triplets"""
+    keys = np.asarray(keys, dtype=np.int64)
+    return np.stack([keys // n_items**2, (keys // n_items) % n_items, keys % n_items], axis=1)
+
+def count_choices(keys:np.ndarray, choices:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """count how often each item of every unique triplet (key) was chosen as the odd-one-out"""
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse.ravel() * 3 + choices, minlength=len(unique_keys) * 3).reshape(-1, 3)
+    return unique_keys, counts
+
+def compute_pmfs(keys:np.ndarray, choices:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    unique_keys, counts = count_choices(keys, choices)
+    return unique_keys, counts / counts.sum(axis=1, keepdims=True)
+
+def align_pmfs(
+                human_keys:np.ndarray,
+                human_pmfs:np.ndarray,
+                model_keys:np.ndarray,
+                model_pmfs:np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """restrict human and model pmfs to their common triplets (in the same order)"""
+    keys, human_inds, model_inds = np.intersect1d(human_keys, model_keys, assume_unique=True, return_indices=True)
+    return keys, human_pmfs[human_inds], model_pmfs[model_inds]
+
+def get_choice_distributions(test_set:pd.DataFrame, n_items:int) -> Tuple[np.ndarray, np.ndarray]:
+    """function to compute human choice distributions and corresponding pmfs
+
+    Returns the unique triplet keys (see encode_triplets, zero-based items) and a (n_triplets, 3) array
+    of pmfs over the items of every sorted triplet being chosen as the odd-one-out.
+    """
+    triplets = test_set[['trip.1', 'trip.2', 'trip.3']].to_numpy().astype(np.int64) - 1
+    choices = test_set['choice'].to_numpy().astype(np.int64) - 1
+    #position of every item of a triplet after sorting the triplet
+    ranks = np.argsort(np.argsort(triplets, axis=1), axis=1)
+    sorted_choices = ranks[np.arange(len(ranks)), choices]
+    return compute_pmfs(encode_triplets(triplets, n_items), sorted_choices)
+
+def collect_choices(probas:np.ndarray, triplets:np.ndarray, n_items:int) -> Tuple[np.ndarray, np.ndarray]:
+    """collect model choices at inference time (keys of sorted triplets and position of the odd-one-out therein)"""
+    #probas are ordered as (s_ij, s_ik, s_jk) -> probability of i, j, k being the odd-one-out
+    choices = np.argmax(np.asarray(probas)[:, ::-1], axis=1)
+    ranks = np.argsort(np.argsort(triplets, axis=1), axis=1)
+    return encode_triplets(triplets, n_items), ranks[np.arange(len(ranks)), choices]
 
 def logsumexp_(logits:torch.Tensor) -> torch.Tensor:
     return torch.exp(logits - torch.logsumexp(logits, dim=1)[..., None])
 
+def mc_probas_(
+               mu:torch.Tensor,
+               b:torch.Tensor,
+               temperature:torch.Tensor,
+               task:str,
+               n_samples:int,
+               distance_metric:str='dot',
+) -> torch.Tensor:
+    """average choice probabilities over n_samples Laplace samples of (batch, 3, dims) locations and scales, drawn as one (S, batch, 3, dims) tensor"""
+    U = torch.rand((n_samples, *mu.shape), device=mu.device) - .5
+    z = mu - b * U.sign() * torch.log1p(-2 * U.abs())
+    anchor, positive, negative = torch.unbind(z, dim=2)
+    similarities = compute_similarities(anchor, positive, negative, task, distance_metric)
+    return F.softmax(torch.stack(similarities, dim=-1) / temperature, dim=-1).mean(dim=0)
+
+def mc_sampling(
+                model,
+                batch:torch.Tensor,
+                temperature:torch.Tensor,
+                task:str,
+                n_samples:int,
+                device:torch.device,
+                distance_metric:str='dot',
+) -> torch.Tensor:
+    """Monte-Carlo estimate of the choice probabilities of a VSPoSE model for (batch, 3) index triplets"""
+    W_mu, W_b = load_weights(model, version='variational')
+    batch = batch.to(W_mu.device)
+    probas = mc_probas_(W_mu[batch], W_b[batch], temperature, task, n_samples, distance_metric)
+    return probas.to(device)
+
+def merge_counts(
+                 keys_1:np.ndarray,
+                 counts_1:np.ndarray,
+                 keys_2:np.ndarray,
+                 counts_2:np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """merge two sets of per-triplet choice counts"""
+    keys, inverse = np.unique(np.concatenate((keys_1, keys_2)), return_inverse=True)
+    counts = np.zeros((len(keys), 3), dtype=np.int64)
+    np.add.at(counts, inverse.ravel(), np.concatenate((counts_1, counts_2)))
+    return keys, counts
+
+def embed_triplets(model, triplets:torch.Tensor) -> torch.Tensor:
+    """look up the (n_triplets, 3, n_dims) embeddings of index triplets without one-hot-encoding them"""
+    if hasattr(model, 'fc'):
+        return model.fc.weight.T[triplets]
+    logits = model(F.one_hot(triplets.flatten(), model.in_size).float())
+    return logits.view(len(triplets), 3, -1)
+
 def test(
         model,
         test_batches,
@@ -417,37 +610,67 @@ def test(
         batch_size=None,
         n_samples=None,
         distance_metric: str = 'dot',
-        temperature:float=1.
+        temperature:float=1.,
+        out_path:str=None,
+        max_buffer:int=int(1e7),
 ) -> Tuple:
-    probas = torch.zeros(int(len(test_batches) * batch_size), 3)
-    temperature = torch.tensor(temperature).to(device)
-    model_choices = defaultdict(list)
-    model.eval()
+    """stream over index triplets and evaluate a model (or an ensemble of models) on a held-out set
+
+    test_batches is either a BatchGenerator or an (n_triplets, 3) array of item indices (odd-one-out last).
+    For a list of models, probabilities are averaged over the ensemble. If out_path is given, probabilities
+    are written to a memory-mapped .npy file instead of being held in memory. Returns the test accuracy,
+    the (n_triplets, 3) probabilities, and the model pmfs as (triplet keys, pmfs) (see compute_pmfs).
+    """
+    if isinstance(test_batches, BatchGenerator):
+        batch_size = batch_size or test_batches.batch_size
+        test_batches = test_batches.dataset
+    triplets = torch.as_tensor(np.asarray(test_batches), dtype=torch.long)
+    n_triplets = len(triplets)
+    models = model if isinstance(model, (list, tuple)) else [model]
+    n_items = models[0].in_size
+    batch_size = batch_size or 4096
+
+    if out_path:
+        probas = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(n_triplets, 3))
+    else:
+        probas = np.empty((n_triplets, 3), dtype=np.float32)
+
+    temperature = torch.as_tensor(temperature, dtype=torch.float32).to(device)
+    n_correct = 0
+    count_keys, counts = np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.int64)
+    buffered_keys, buffered_choices, n_buffered = [], [], 0
+    for m in models:
+        m.eval()
     with torch.no_grad():
-        batch_accs = torch.zeros(len(test_batches))
-        for j, batch in enumerate(test_batches):
-            batch = batch.to(device)
-            if version == 'variational':
-                assert isinstance(n_samples, int), '\nOutput logits of variational neural networks have to be averaged over different samples through mc sampling.\n'
-                test_acc, _, batch_probas = mc_sampling(model=model, batch=batch, temperature=temperature, task=task, n_samples=n_samples, device=device)
-            else:
-                logits = model(batch)
-                anchor, positive, negative = torch.unbind(torch.reshape(logits, (-1, 3, logits.shape[-1])), dim=1)
-                similarities = compute_similarities(anchor, positive, negative, task, distance_metric)
-                #stacked_sims = torch.stack(similarities, dim=-1)
-                #batch_probas = F.softmax(logsumexp_(stacked_sims), dim=1)
-                batch_probas = F.softmax(torch.stack(similarities, dim=-1), dim=1)
-                test_acc = choice_accuracy(anchor, positive, negative, task)
-
-            probas[j*batch_size:(j+1)*batch_size] += batch_probas
-            batch_accs[j] += test_acc
-            human_choices = batch.nonzero(as_tuple=True)[-1].view(batch_size, -1).numpy()
-            model_choices = collect_choices(batch_probas, human_choices, model_choices)
-
-    probas = probas.cpu().numpy()
-    probas = probas[np.where(probas.sum(axis=1) != 0.)]
-    model_pmfs = compute_pmfs(model_choices, behavior=False)
-    test_acc = batch_accs.mean().item()
+        for start in range(0, n_triplets, batch_size):
+            batch = triplets[start:start+batch_size].to(device)
+            batch_probas = torch.zeros(len(batch), 3, device=device)
+            for m in models:
+                if version == 'variational':
+                    assert isinstance(n_samples, int), '\nOutput logits of variational neural networks have to be averaged over different samples through mc sampling.\n'
+                    batch_probas += mc_sampling(model=m, batch=batch, temperature=temperature, task=task, n_samples=n_samples, device=device, distance_metric=distance_metric)
+                else:
+                    anchor, positive, negative = torch.unbind(embed_triplets(m, batch), dim=1)
+                    similarities = compute_similarities(anchor, positive, negative, task, distance_metric)
+                    batch_probas += F.softmax(torch.stack(similarities, dim=-1) / temperature, dim=1)
+            batch_probas = (batch_probas / len(models)).cpu().numpy()
+            probas[start:start+len(batch)] = batch_probas
+            n_correct += accuracy_(batch_probas) * len(batch)
+
+            keys, choices = collect_choices(batch_probas, batch.cpu().numpy(), n_items)
+            buffered_keys.append(keys)
+            buffered_choices.append(choices)
+            n_buffered += len(keys)
+            #compact buffered choices into per-triplet counts to keep memory bounded
+            if n_buffered >= max_buffer or start + batch_size >= n_triplets:
+                batch_keys, batch_counts = count_choices(np.concatenate(buffered_keys), np.concatenate(buffered_choices))
+                count_keys, counts = merge_counts(count_keys, counts, batch_keys, batch_counts)
+                buffered_keys, buffered_choices, n_buffered = [], [], 0
+
+    if out_path:
+        probas.flush()
+    model_pmfs = (count_keys, counts / counts.sum(axis=1, keepdims=True))
+    test_acc = n_correct / max(n_triplets, 1)
     return test_acc, probas, model_pmfs
 
 def validation(
@@ -457,32 +680,47 @@ def validation(
                 device:torch.device,
                 sampling:bool=False,
                 batch_size=None,
-                distance_metric: str = 'dot'
+                distance_metric: str = 'dot',
+                temperature:float=1.,
+                version:str='deterministic',
+                n_samples:int=None,
                 ):
     if sampling:
         assert isinstance(batch_size, int), 'batch size must be defined'
         sampled_choices = np.zeros((int(len(val_batches) * batch_size), 3), dtype=int)
+    if version == 'variational':
+        assert isinstance(n_samples, int), '\nOutput logits of variational neural networks have to be averaged over different samples through mc sampling.\n'
 
-    temperature = torch.tensor(1.).to(device)
+    temperature = torch.as_tensor(temperature, dtype=torch.float32).to(device)
     model.eval()
     with torch.no_grad():
         batch_losses_val = torch.zeros(len(val_batches))
         batch_accs_val = torch.zeros(len(val_batches))
         for j, batch in enumerate(val_batches):
             batch = batch.to(device)
-            logits = model(batch)
-            anchor, positive, negative = torch.unbind(torch.reshape(logits, (-1, 3, logits.shape[-1])), dim=1)
+            if version == 'variational':
+                _, mu, b, _ = model(batch)
+                probas = mc_probas_(mu.view(-1, 3, mu.shape[-1]), b.view(-1, 3, b.shape[-1]), temperature, task, n_samples, distance_metric)
+            else:
+                logits = model(batch)
+                anchor, positive, negative = torch.unbind(torch.reshape(logits, (-1, 3, logits.shape[-1])), dim=1)
 
             if sampling:
-                similarities = compute_similarities(anchor, positive, negative, task, distance_metric)
-                probas = F.softmax(torch.stack(similarities, dim=-1), dim=1).numpy()
-                probas = probas[:, ::-1]
-                human_choices = batch.nonzero(as_tuple=True)[-1].view(batch_size, -1).numpy()
+                if version != 'variational':
+                    similarities = compute_similarities(anchor, positive, negative, task, distance_metric)
+                    probas = F.softmax(torch.stack(similarities, dim=-1), dim=1)
+                probas = probas.cpu().numpy()[:, ::-1]
+                human_choices = batch.nonzero(as_tuple=True)[-1].view(batch_size, -1).cpu().numpy()
                 model_choices = np.array([np.random.choice(h_choice, size=len(p), replace=False, p=p)[::-1] for h_choice, p in zip(human_choices, probas)])
                 sampled_choices[j*batch_size:(j+1)*batch_size] += model_choices
+                continue
+
+            if version == 'variational':
+                val_loss = torch.mean(-torch.log(probas[:, 0]))
+                val_acc = accuracy_(probas.cpu().numpy())
             else:
-                val_loss = trinomial_loss(anchor, positive, negative, task, temperature)
-                val_acc = choice_accuracy(anchor, positive, negative, task)
+                val_loss = trinomial_loss(anchor, positive, negative, task, temperature, distance_metric)
+                val_acc = choice_accuracy(anchor, positive, negative, task, distance_metric)
 
             batch_losses_val[j] += val_loss.item()
             batch_accs_val[j] += val_acc
@@ -494,6 +732,65 @@ def validation(
     avg_val_acc = torch.mean(batch_accs_val).item()
     return avg_val_loss, avg_val_acc
 
+def temperature_profile(
+                        model,
+                        test_batches,
+                        task:str,
+                        device:torch.device,
+                        temperatures:np.ndarray,
+                        distance_metric:str='dot',
+                        n_bins:int=10,
+) -> Dict[str, np.ndarray]:
+    """evaluate log-likelihood, accuracy and calibration (ECE) of a trained model for a whole vector of softmax temperatures
+
+    Similarities are computed once per mini-batch and evaluated for all temperatures by broadcasting,
+    such that a single pass over the test triplets yields the entire temperature curve.
+    """
+    temperatures = torch.as_tensor(np.asarray(temperatures), dtype=torch.float32).to(device)
+    n_temps = len(temperatures)
+    llikelihoods = torch.zeros(n_temps, dtype=torch.float64)
+    n_correct = torch.zeros(n_temps, dtype=torch.float64)
+    bin_counts = torch.zeros(n_temps * n_bins, dtype=torch.float64)
+    bin_confidences = torch.zeros(n_temps * n_bins, dtype=torch.float64)
+    bin_corrects = torch.zeros(n_temps * n_bins, dtype=torch.float64)
+    n_triplets = 0
+    model.eval()
+    with torch.no_grad():
+        for batch in test_batches:
+            batch = batch.to(device)
+            logits = model(batch)
+            anchor, positive, negative = torch.unbind(torch.reshape(logits, (-1, 3, logits.shape[-1])), dim=1)
+            sims = torch.stack(compute_similarities(anchor, positive, negative, task, distance_metric), dim=-1)
+            #(n_temperatures, batch_size, 3)
+            log_probas = F.log_softmax(sims[None, ...] / temperatures[:, None, None], dim=-1)
+            llikelihoods += log_probas[..., 0].sum(dim=1).double().cpu()
+            confidences = log_probas.exp().max(dim=-1)[0]
+            #choices do not depend on the temperature; as in accuracy_, only all-equal similarities are a tie (incorrect)
+            is_tie = sims.min(dim=1)[0] == sims.max(dim=1)[0]
+            correct = ((sims.argmax(dim=1) == 0) & ~is_tie).double().expand(n_temps, -1)
+            n_correct += correct.sum(dim=1).cpu()
+            bins = torch.clamp((confidences * n_bins).long(), max=n_bins - 1)
+            bins = (bins + torch.arange(n_temps, device=bins.device)[:, None] * n_bins).flatten().cpu()
+            bin_counts.index_add_(0, bins, torch.ones_like(bins, dtype=torch.float64))
+            bin_confidences.index_add_(0, bins, confidences.flatten().double().cpu())
+            bin_corrects.index_add_(0, bins, correct.flatten().cpu())
+            n_triplets += sims.shape[0]
+
+    bin_counts = bin_counts.view(n_temps, n_bins)
+    bin_gaps = (bin_corrects.view(n_temps, n_bins) - bin_confidences.view(n_temps, n_bins)).abs()
+    eces = (bin_gaps.sum(dim=1) / n_triplets).numpy()
+    llikelihoods = (llikelihoods / n_triplets).numpy()
+    temperatures = temperatures.cpu().numpy()
+    best = int(np.argmax(llikelihoods))
+    return {
+            'temperatures': temperatures,
+            'loglikelihood': llikelihoods,
+            'accuracy': (n_correct / n_triplets).numpy(),
+            'ece': eces,
+            'best_temperature': float(temperatures[best]),
+            'best_loglikelihood': float(llikelihoods[best]),
+            }
+
 def get_digits(string:str) -> int:
     c = ""
     nonzero = False
@@ -506,21 +803,169 @@ def get_digits(string:str) -> int:
                 nonzero = True
     return int(c)
 
+################################################
+############### results index ##################
+################################################
+
+RESULTS_INDEX = 'results_index.sqlite'
+
+def normalize_modality_(modality:str) -> str:
+    return '/'.join(p for p in os.path.normpath(modality).split(os.sep) if p not in ('', '.'))
+
+def connect_results_index(results_dir:str) -> sqlite3.Connection:
+    """open (and if necessary create) the SQLite index of all training runs under results_dir"""
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    conn = sqlite3.connect(pjoin(results_dir, RESULTS_INDEX), timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                    run_dir TEXT PRIMARY KEY,
+                    modality TEXT,
+                    dim INTEGER,
+                    lmbda REAL,
+                    rnd_seed INTEGER,
+                    epoch INTEGER,
+                    train_acc REAL,
+                    val_acc REAL,
+                    val_loss REAL,
+                    last_checkpoint TEXT,
+                    results_mtime REAL,
+                    results TEXT
+                    )""")
+    conn.execute('CREATE INDEX IF NOT EXISTS runs_grid ON runs (modality, dim, lmbda, rnd_seed)')
+    return conn
+
+def _index_row(results_dir:str, run_dir:str, modality:str, dim:int, lmbda:float, rnd_seed:int) -> tuple:
+    results_path = pjoin(run_dir, 'results.json')
+    with open(results_path, 'r') as f:
+        results = json.load(f)
+    model_dir = pjoin(run_dir, 'model')
+    checkpoints = sorted(m.name for m in os.scandir(model_dir) if m.name.endswith('.tar')) if os.path.isdir(model_dir) else []
+    return (
+            os.path.relpath(run_dir, results_dir),
+            normalize_modality_(modality),
+            int(dim),
+            float(lmbda),
+            int(rnd_seed),
+            results.get('epoch'),
+            results.get('train_acc'),
+            results.get('val_acc'),
+            results.get('val_loss'),
+            checkpoints[-1] if checkpoints else None,
+            os.stat(results_path).st_mtime,
+            json.dumps(results),
+    )
+
+def update_results_index(
+                         results_dir:str,
+                         run_dir:str,
+                         modality:str,
+                         dim:int,
+                         lmbda:float,
+                         rnd_seed:int,
+) -> None:
+    """add (or replace) a single finished run in the results index within one transaction"""
+    row = _index_row(results_dir, run_dir, modality, dim, lmbda, rnd_seed)
+    conn = connect_results_index(results_dir)
+    try:
+        with conn:
+            conn.execute(f'INSERT OR REPLACE INTO runs VALUES ({", ".join(["?"] * len(row))})', row)
+    finally:
+        conn.close()
+
+def refresh_results_index(results_dir:str) -> int:
+    """incrementally (re-)index all runs under results_dir (<modality>/<dim>d/<lmbda>/seed<rnd_seed>/results.json)
+
+    Only runs whose results.json is new or changed are re-read, and runs whose results.json was deleted are
+    dropped. Runs that were registered by train under a directory that does not follow this layout (e.g., a
+    custom --results_dir) are kept and re-read with the hyperparameters they were registered with.
+    Returns the number of (re-)indexed runs.
+    """
+    pattern = re.compile(r'^(?P<modality>.+)/(?P<dim>\d+)d/(?P<lmbda>[^/]+)/seed(?P<seed>\d+)$')
+    conn = connect_results_index(results_dir)
+    try:
+        indexed = {
+                   run_dir: (mtime, (modality, dim, lmbda, rnd_seed))
+                   for run_dir, mtime, modality, dim, lmbda, rnd_seed in conn.execute(
+                        'SELECT run_dir, results_mtime, modality, dim, lmbda, rnd_seed FROM runs'
+                        ).fetchall()
+                   }
+        found, rows = set(), []
+        for root, _, files in os.walk(results_dir):
+            if 'results.json' not in files:
+                continue
+            run_dir = os.path.relpath(root, results_dir)
+            match = pattern.match(run_dir.replace(os.sep, '/'))
+            if match:
+                try:
+                    params = (match['modality'], int(match['dim']), float(match['lmbda']), int(match['seed']))
+                except ValueError:
+                    continue
+            elif run_dir in indexed:
+                #registered by train, but not stored in the default layout
+                params = indexed[run_dir][1]
+            else:
+                continue
+            found.add(run_dir)
+            if run_dir in indexed and indexed[run_dir][0] == os.stat(pjoin(root, 'results.json')).st_mtime:
+                continue
+            rows.append(_index_row(results_dir, root, *params))
+        #runs outside of results_dir are only dropped once their results.json is gone
+        found.update(run_dir for run_dir in indexed if os.path.isfile(pjoin(results_dir, run_dir, 'results.json')))
+        with conn:
+            conn.executemany(f'INSERT OR REPLACE INTO runs VALUES ({", ".join(["?"] * 12)})', rows)
+            conn.executemany('DELETE FROM runs WHERE run_dir = ?', [(run_dir,) for run_dir in set(indexed) - found])
+    finally:
+        conn.close()
+    return len(rows)
+
+def query_results(
+                  results_dir:str,
+                  modality:str=None,
+                  dim:int=None,
+                  lmbda:float=None,
+                  rnd_seed:int=None,
+                  refresh:bool=True,
+) -> pd.DataFrame:
+    """query indexed runs by modality, dimensionality, lambda and random seed (None matches everything)
+
+    By default the index is refreshed incrementally first (see refresh_results_index), such that runs which were
+    copied into results_dir or written before the index existed are found as well. Without a refresh, the index
+    is only built if it does not exist yet.
+    """
+    if refresh or not os.path.exists(pjoin(results_dir, RESULTS_INDEX)):
+        refresh_results_index(results_dir)
+    conditions, params = [], []
+    for column, value in (('modality', modality), ('dim', dim), ('lmbda', lmbda), ('rnd_seed', rnd_seed)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            params.append(normalize_modality_(value) if column == 'modality' else value)
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    conn = connect_results_index(results_dir)
+    try:
+        results = pd.read_sql_query(f'SELECT * FROM runs{where} ORDER BY modality, dim, lmbda, rnd_seed', conn, params=params)
+    finally:
+        conn.close()
+    results['run_dir'] = [os.path.normpath(pjoin(results_dir, run_dir)) for run_dir in results.run_dir]
+    return results
+
 def get_results_files(
                       results_dir:str,
                       modality:str,
                       version:str,
-                      subfolder:str,
+                      subfolder:str=None,
                       vision_model=None,
                       layer=None,
+                      dim:int=None,
+                      lmbda:float=None,
+                      refresh:bool=True,
 ) -> list:
     if modality == 'visual':
         assert isinstance(vision_model, str) and isinstance(layer, str), 'name of vision model and layer are required'
-        PATH = pjoin(results_dir, modality, vision_model, layer, version, f'{dim}d', f'{lmbda}')
+        modality = pjoin(modality, vision_model, layer, version)
     else:
-        PATH = pjoin(results_dir, modality, version, f'{dim}d', f'{lmbda}')
-    files = [pjoin(PATH, seed, f) for seed in os.listdir(PATH) for f in os.listdir(pjoin(PATH, seed)) if f.endswith('.json')]
-    return files
+        modality = pjoin(modality, version)
+    results = query_results(results_dir, modality=modality, dim=dim, lmbda=lmbda, refresh=refresh)
+    return [pjoin(run_dir, 'results.json') for run_dir in results.run_dir]
 
 def sort_results(results:dict) -> dict:
     return dict(sorted(results.items(), key=lambda kv:kv[0], reverse=False))
@@ -534,25 +979,133 @@ def merge_dicts(files:list) -> dict:
     results = sort_results(results)
     return results
 
+def get_checkpoints(model_dir:str) -> List[Tuple[int, str]]:
+    """(epoch, path) of all checkpoints in a model directory, sorted by epoch"""
+    if not os.path.isdir(model_dir):
+        return []
+    checkpoints = []
+    for entry in os.scandir(model_dir):
+        match = re.search(r'epoch(\d+)\.tar$', entry.name)
+        if match:
+            checkpoints.append((int(match.group(1)), entry.path))
+    return sorted(checkpoints)
+
+def load_state_dict_(PATH:str, device:torch.device='cpu') -> dict:
+    """load only the model parameters of a checkpoint (memory-mapped, such that the optimizer state is never read)"""
+    checkpoint = torch.load(PATH, map_location=device, mmap=True)
+    return {k: v.clone() for k, v in checkpoint['model_state_dict'].items()}
+
+def embedding_from_state_dict(state_dict:dict, version:str='deterministic') -> torch.Tensor:
+    """items x dims embedding (locations for the variational version) of a model state dict"""
+    if version == 'variational':
+        return F.relu(state_dict['encoder_mu.0.weight'].T + state_dict['encoder_mu.0.bias'])
+    return state_dict['fc.weight'].T
+
+class CheckpointRegistry(object):
+    """index of all model checkpoints under a results directory with an LRU cache of their parameters
+
+    Runs are taken from the results index (see query_results) and every model directory is scanned once.
+    State dicts are cached by (path, mtime), such that checkpoints which are overwritten are reloaded.
+    """
+
+    def __init__(
+                self,
+                results_dir:str,
+                subfolder:str='model',
+                cache_size:int=32,
+                device:torch.device='cpu',
+                refresh:bool=True,
+):
+        self.results_dir = results_dir
+        self.subfolder = subfolder
+        self.cache_size = cache_size
+        self.device = device
+        self.cache = OrderedDict()
+        self.index(refresh=refresh)
+
+    def __len__(self) -> int:
+        return len(self.checkpoints)
+
+    def index(self, refresh:bool=True) -> pd.DataFrame:
+        runs = query_results(self.results_dir, refresh=refresh)
+        rows = []
+        for run in runs.itertuples():
+            for epoch, path in get_checkpoints(pjoin(run.run_dir, self.subfolder)):
+                rows.append((run.modality, run.dim, run.lmbda, run.rnd_seed, epoch, path))
+        self.checkpoints = pd.DataFrame(rows, columns=['modality', 'dim', 'lmbda', 'rnd_seed', 'epoch', 'path'])
+        return self.checkpoints
+
+    def find(
+            self,
+            modality:str=None,
+            dim:int=None,
+            lmbda:float=None,
+            rnd_seed:int=None,
+            epoch:int=None,
+) -> pd.DataFrame:
+        """checkpoints matching a query (None matches everything); without an epoch, the last checkpoint of every run"""
+        mask = np.ones(len(self.checkpoints), dtype=bool)
+        if modality is not None:
+            mask &= (self.checkpoints.modality == normalize_modality_(modality)).to_numpy()
+        for column, value in (('dim', dim), ('lmbda', lmbda), ('rnd_seed', rnd_seed), ('epoch', epoch)):
+            if value is not None:
+                mask &= (self.checkpoints[column] == value).to_numpy()
+        matches = self.checkpoints[mask]
+        if epoch is None:
+            matches = matches.sort_values('epoch').groupby(['modality', 'dim', 'lmbda', 'rnd_seed'], sort=True).tail(1)
+        return matches.sort_values(['modality', 'dim', 'lmbda', 'rnd_seed', 'epoch']).reset_index(drop=True)
+
+    def state_dict(self, PATH:str) -> dict:
+        key = (PATH, os.stat(PATH).st_mtime_ns)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        state_dict = load_state_dict_(PATH, self.device)
+        self.cache[key] = state_dict
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return state_dict
+
+    def load_model(self, model, **query):
+        """load the parameters of the (single) checkpoint matching a query into a model"""
+        matches = self.find(**query)
+        assert len(matches) == 1, f'\nQuery must match exactly one checkpoint, but matched {len(matches)}.\n'
+        model.load_state_dict(self.state_dict(matches.path[0]))
+        return model
+
+    def stack(self, version:str='deterministic', **query) -> Tuple[torch.Tensor, pd.DataFrame]:
+        """stack the embeddings of all checkpoints matching a query into one (n_models, n_items, max_dim) tensor
+
+        Embeddings with fewer dimensions are zero-padded, which leaves dot product similarities unchanged.
+        """
+        matches = self.find(**query)
+        embeddings = [embedding_from_state_dict(self.state_dict(PATH), version) for PATH in matches.path]
+        assert len(embeddings) > 0, '\nNo checkpoints match the query.\n'
+        n_items = embeddings[0].shape[0]
+        assert all(W.shape[0] == n_items for W in embeddings), '\nAll embeddings must share the same set of items.\n'
+        W_stack = torch.zeros(len(embeddings), n_items, max(W.shape[1] for W in embeddings), device=self.device)
+        for i, W in enumerate(embeddings):
+            W_stack[i, :, :W.shape[1]] = W
+        return W_stack, matches
+
 def load_model(
                 model,
                 results_dir:str,
                 modality:str,
                 version:str,
-                data:str,
                 dim:int,
                 lmbda:float,
                 rnd_seed:int,
                 device:torch.device,
                 subfolder:str='model',
+                data:str=None,
+                registry:CheckpointRegistry=None,
 ):
-    model_path = pjoin(results_dir, modality, version, data, f'{dim}d', f'{lmbda}', f'seed{rnd_seed:02d}', subfolder)
-    models = os.listdir(model_path)
-    checkpoints = list(map(get_digits, models))
-    last_checkpoint = np.argmax(checkpoints)
-    PATH = pjoin(model_path, models[last_checkpoint])
-    checkpoint = torch.load(PATH, map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    #data subfolder is optional
+    model_path = pjoin(results_dir, modality, version, *([data] if data else []), f'{dim}d', f'{lmbda}', f'seed{rnd_seed:02d}', subfolder)
+    _, PATH = get_checkpoints(model_path)[-1]
+    state_dict = registry.state_dict(PATH) if registry is not None else load_state_dict_(PATH, device)
+    model.load_state_dict(state_dict)
     return model
 
 def save_weights_(out_path:str, W_mu:torch.tensor) -> None:
@@ -564,10 +1117,11 @@ def save_weights_(out_path:str, W_mu:torch.tensor) -> None:
 
 def load_weights(model, version:str) -> Tuple[torch.Tensor]:
     if version == 'variational':
-        W_mu = model.encoder_mu[0].weight.data.T.detach()
+        #clone such that adding biases does not modify the model parameters in place
+        W_mu = model.encoder_mu[0].weight.data.T.detach().clone()
         if hasattr(model.encoder_mu[0].bias, 'data'):
             W_mu += model.encoder_mu[0].bias.data.detach()
-        W_b = model.encoder_b[0].weight.data.T.detach()
+        W_b = model.encoder_b[0].weight.data.T.detach().clone()
         if hasattr(model.encoder_b[0].bias, 'data'):
             W_b += model.encoder_b[0].bias.data.detach()
         W_mu = F.relu(W_mu)
@@ -592,6 +1146,56 @@ def prune_weights(model, version:str, indices:torch.Tensor, fraction:float):
             m.data = m.data[indices]
     return model
 
+def pruning_curve(
+                  model,
+                  test_triplets,
+                  version:str,
+                  task:str,
+                  fractions:np.ndarray=np.arange(.1, 1.01, .1),
+                  distance_metric:str='dot',
+                  lmbda:float=None,
+                  reduction:str='max',
+                  batch_size:int=4096,
+) -> list:
+    """evaluate accuracies for all pruning fractions in a single pass over the test triplets
+
+    Latent dimensions are sorted by importance (l1-norm or KLD), such that cumulative sums of per-dimension
+    similarity contributions yield the similarities of every pruned model at once. Fractions denote the
+    fraction of dimensions that are kept (cf. prune_weights). Returns a list of (% of dimensions pruned,
+    accuracy in %) tuples that can be passed to plotting.plot_pruning_results.
+    """
+    if isinstance(test_triplets, BatchGenerator):
+        test_triplets = test_triplets.dataset
+    triplets = np.asarray(test_triplets, dtype=np.int64)
+    if version == 'variational':
+        assert isinstance(lmbda, float), '\nlambda is required to sort dimensions of a variational model by their KLD\n'
+        sorted_dims, _ = compute_kld(model, lmbda=lmbda, aggregate=True, reduction=reduction)
+        W = load_weights(model, version)[0]
+    else:
+        sorted_dims, _ = sort_weights(model, aggregate=True)
+        W = load_weights(model, version)
+    W = W.cpu().numpy()[:, sorted_dims.cpu().numpy()].astype(np.float32)
+    #number of kept dimensions for every fraction (index of the cumulative sum)
+    n_dims = np.array([int(W.shape[1] * frac) for frac in fractions])
+    pairs = [(0, 1), (0, 2), (1, 2)] if task == 'odd_one_out' else [(0, 1), (0, 2)]
+    n_correct = np.zeros(len(fractions))
+    for start in range(0, len(triplets), batch_size):
+        embeddings = W[triplets[start:start+batch_size]]
+        sims = []
+        for a, b in pairs:
+            if distance_metric == 'dot':
+                contributions = embeddings[:, a] * embeddings[:, b]
+            else:
+                contributions = (embeddings[:, a] - embeddings[:, b]) ** 2
+            cumulative = np.concatenate((np.zeros((len(embeddings), 1), dtype=np.float32), np.cumsum(contributions, axis=1)), axis=1)[:, n_dims]
+            sims.append(cumulative if distance_metric == 'dot' else -np.sqrt(cumulative))
+        #(batch, fractions, pairs)
+        sims = np.stack(sims, axis=-1)
+        choices = np.where(sims.min(axis=-1) == sims.max(axis=-1), -1, np.argmax(sims, axis=-1))
+        n_correct += (choices == 0).sum(axis=0)
+    accuracies = 100 * n_correct / len(triplets)
+    return [(int(round(100 * (1 - frac))), float(acc)) for frac, acc in zip(fractions, accuracies)]
+
 def sort_weights(model, aggregate:bool) -> np.ndarray:
     """sort latent dimensions according to their l1-norm in descending order"""
     W = load_weights(model, version='deterministic').cpu()
@@ -670,21 +1274,69 @@ def pearsonr(u:np.ndarray, v:np.ndarray, a_min:float=-1., a_max:float=1.) -> np.
     rho = (num / denom).clip(min=a_min, max=a_max)
     return rho
 
+def normalize_rows_(W:np.ndarray, center:bool=False, dtype=np.float32) -> np.ndarray:
+    """(center and) scale rows of a copy of W to unit l2-norm in place"""
+    W = np.array(W, dtype=dtype)
+    if center:
+        W -= W.mean(axis=1, keepdims=True)
+    l2_norms = np.linalg.norm(W, axis=1, keepdims=True) #compute l2-norm across rows
+    l2_norms[l2_norms == 0] = 1
+    W /= l2_norms
+    return W
+
 def cos_mat(W:np.ndarray, a_min:float=-1., a_max:float=1.) -> np.ndarray:
-    num = matmul(W, W.T)
-    l2_norms = np.linalg.norm(W, axis=1) #compute l2-norm across rows
-    denom = np.outer(l2_norms, l2_norms)
-    cos_mat = (num / denom).clip(min=a_min, max=a_max)
+    W_n = normalize_rows_(W)
+    cos_mat = W_n @ W_n.T
+    np.clip(cos_mat, a_min, a_max, out=cos_mat)
     return cos_mat
 
 def corr_mat(W:np.ndarray, a_min:float=-1., a_max:float=1.) -> np.ndarray:
-    W_c = W - W.mean(axis=1)[:, np.newaxis]
-    cov = matmul(W_c, W_c.T)
-    l2_norms = np.linalg.norm(W_c, axis=1) #compute l2-norm across rows
-    denom = np.outer(l2_norms, l2_norms)
-    corr_mat = (cov / denom).clip(min=a_min, max=a_max) #counteract potential rounding errors
+    W_n = normalize_rows_(W, center=True)
+    corr_mat = W_n @ W_n.T
+    np.clip(corr_mat, a_min, a_max, out=corr_mat) #counteract potential rounding errors
     return corr_mat
 
+def tril_offset(i:int) -> int:
+    """position of entry (i, 0) in the condensed lower triangle (i.e., in the order of np.tril_indices(N, k=-1))"""
+    return i * (i - 1) // 2
+
+def rsm_condensed(
+                  W:np.ndarray,
+                  metric:str,
+                  out_path:str=None,
+                  block_size:int=1024,
+                  a_min:float=-1.,
+                  a_max:float=1.,
+) -> np.ndarray:
+    """stream the lower triangle (without main diagonal) of a cosine or correlation RSM into a condensed vector
+
+    Blocks of rows are multiplied with all preceding rows, such that at most block_size x N similarities are held in
+    memory at once. If <out_path> is provided, the condensed vector is written to a memory-mapped .npy file.
+    """
+    assert metric in ['cos', 'rho'], '\nMetric must be one of [cos, rho].\n'
+    W_n = normalize_rows_(W, center=metric == 'rho')
+    N = W_n.shape[0]
+    n_pairs = tril_offset(N)
+    if out_path:
+        tril = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(n_pairs,))
+    else:
+        tril = np.empty(n_pairs, dtype=np.float32)
+    for start in range(1, N, block_size):
+        stop = min(start + block_size, N)
+        sims = W_n[start:stop] @ W_n[:stop].T
+        np.clip(sims, a_min, a_max, out=sims)
+        #row i contributes its first i entries
+        mask = np.arange(stop)[None, :] < np.arange(start, stop)[:, None]
+        tril[tril_offset(start):tril_offset(stop)] = sims[mask]
+    if out_path:
+        tril.flush()
+    return tril
+
+def tril_(rsm:np.ndarray) -> np.ndarray:
+    """condensed lower triangle (without main diagonal) of a square matrix"""
+    N = rsm.shape[0]
+    return rsm[np.arange(N)[:, None] > np.arange(N)[None, :]]
+
 @njit(parallel=False, fastmath=False)
 def matmul(A: np.ndarray, B: np.ndarray) -> np.ndarray:
     I, K = A.shape
@@ -696,25 +1348,107 @@ def matmul(A: np.ndarray, B: np.ndarray) -> np.ndarray:
                 C[i, j] += A[i, k] * B[k, j]
     return C
 
-@njit(parallel=False, fastmath=False)
-def rsm_pred(W: np.ndarray) -> np.ndarray:
+@njit(inline='always')
+def _odd_one_out_proba(s_ij:float, s_ik:float, s_jk:float) -> float:
+    """exp(s_ij) / (exp(s_ij) + exp(s_ik) + exp(s_jk)) in a shift-free form that cannot divide 0 by 0"""
+    return 1. / (1. + np.exp(s_ik - s_ij) + np.exp(s_jk - s_ij))
+
+@njit(parallel=True, fastmath=False, cache=True)
+def _rsm_pred_kernel(S:np.ndarray, block_size:int) -> np.ndarray:
+    """tiled k-sum of the odd-one-out probabilities (only the upper triangle is filled)"""
+    N = S.shape[0]
+    rsm = np.zeros((N, N), dtype=np.float64)
+    #pair row i with row N-1-i such that every thread gets the same amount of work
+    for p in prange((N + 1) // 2):
+        for t in range(2):
+            i = p + t * (N - 1 - 2 * p)
+            if t == 1 and i == p:
+                continue
+            for k_start in range(0, N, block_size):
+                k_stop = min(k_start + block_size, N)
+                for j in range(i + 1, N):
+                    s_ij = S[i, j]
+                    acc = 0.
+                    for k in range(k_start, k_stop):
+                        if k != i and k != j:
+                            acc += _odd_one_out_proba(s_ij, S[i, k], S[j, k])
+                    rsm[i, j] += acc
+    return rsm
+
+@njit(parallel=True, fastmath=False, cache=True)
+def _rsm_pred_mc_kernel(S:np.ndarray, ks:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """average the odd-one-out probabilities over a random subset of objects k (only the upper triangle is filled)"""
+    N = S.shape[0]
+    rsm = np.zeros((N, N), dtype=np.float64)
+    max_se = np.zeros(N)
+    for i in prange(N):
+        for j in range(i + 1, N):
+            s_ij = S[i, j]
+            acc = 0.
+            acc_sq = 0.
+            n = 0
+            for k in ks:
+                if k != i and k != j:
+                    p = _odd_one_out_proba(s_ij, S[i, k], S[j, k])
+                    acc += p
+                    acc_sq += p * p
+                    n += 1
+            if n == 0:
+                continue
+            mean = acc / n
+            rsm[i, j] = mean
+            if n > 1:
+                #standard error of the mean with finite population correction
+                var = max(acc_sq - n * mean * mean, 0.) / (n - 1)
+                se = np.sqrt(var / n * (1. - n / (N - 2)))
+                if se > max_se[i]:
+                    max_se[i] = se
+    return rsm, max_se
+
+def _similarities(W:np.ndarray) -> np.ndarray:
+    """inner product matrix (computed with BLAS in float64)"""
+    W = np.ascontiguousarray(W, dtype=np.float64)
+    return W @ W.T
+
+def rsm_pred(W:np.ndarray, block_size:int=256) -> np.ndarray:
     """convert weight matrix corresponding to the mean of each dim distribution for an object into a RSM"""
     N = W.shape[0]
-    S = matmul(W, W.T)
-    S_e = np.exp(S)  # exponentiate all elements in the inner product matrix S
-    rsm = np.zeros((N, N))
-    for i in prange(N):
-        for j in prange(i+1, N):
-            for k in prange(N):
-                if (k != i and k != j):
-                    rsm[i, j] += S_e[i, j] / (S_e[i, j] + S_e[i, k] + S_e[j, k])
+    rsm = _rsm_pred_kernel(_similarities(W), block_size)
     rsm /= N - 2
     rsm += rsm.T  # make similarity matrix symmetric
     np.fill_diagonal(rsm, 1)
     return rsm
 
-def spose2rsm_odd_one_out(W: np.ndarray) -> np.ndarray:
-    rsm = rsm_pred(W)
+def rsm_pred_mc(W:np.ndarray, n_samples:int, delta:float=.05, rnd_seed:int=None) -> Tuple[np.ndarray, dict]:
+    """unbiased Monte-Carlo approximation of rsm_pred that averages over <n_samples> randomly drawn objects k
+
+    Next to the RSM, the function returns the largest standard error across all pairs and a Hoeffding bound
+    that holds for every single entry with probability 1 - delta (odd-one-out probabilities lie in [0, 1]).
+    """
+    N = W.shape[0]
+    n_samples = min(int(n_samples), N)
+    if n_samples < 3:
+        raise ValueError(f'Monte-Carlo approximation requires at least 3 sampled objects (got {n_samples})')
+    rng = np.random.default_rng(rnd_seed)
+    ks = np.sort(rng.choice(N, size=n_samples, replace=False))
+    rsm, max_se = _rsm_pred_mc_kernel(_similarities(W), ks)
+    rsm += rsm.T  # make similarity matrix symmetric
+    np.fill_diagonal(rsm, 1)
+    n_min = max(n_samples - 2, 1)
+    errors = {
+            'n_samples': n_samples,
+            'max_se': float(max_se.max()),
+            'hoeffding_bound': float(np.sqrt(np.log(2 / delta) / (2 * n_min))),
+            'delta': delta,
+            }
+    return rsm, errors
+
+def spose2rsm_odd_one_out(W:np.ndarray, approximate:bool=False, n_samples:int=500, rnd_seed:int=None) -> np.ndarray:
+    if approximate:
+        rsm, errors = rsm_pred_mc(W, n_samples=n_samples, rnd_seed=rnd_seed)
+        logging.info(f'Approximated RSM with {errors["n_samples"]} samples (max SE: {errors["max_se"]:.5f}, error bound: {errors["hoeffding_bound"]:.5f} with p={1-errors["delta"]:.2f})')
+    else:
+        rsm = rsm_pred(W)
     rsm[rsm > 1] = 1
     assert np.allclose(rsm, rsm.T), '\nRSM is required to be a symmetric matrix\n'
     return rsm
@@ -723,39 +1457,72 @@ def rsm(W:np.ndarray, metric:str) -> np.ndarray:
     rsm = corr_mat(W) if metric == 'rho' else cos_mat(W)
     return rsm
 
-def compute_trils(W_mod1:np.ndarray, W_mod2:np.ndarray, metric:str) -> float:
+def compute_trils(
+                  W_mod1:np.ndarray,
+                  W_mod2:np.ndarray,
+                  metric:str,
+                  out_dir:str=None,
+                  return_inds:bool=True,
+) -> Tuple[np.ndarray]:
     metrics = ['cos', 'pred', 'rho']
     assert metric in metrics, f'\nMetric must be one of {metrics}.\n'
+    assert W_mod1.shape[0] == W_mod2.shape[0], '\nRSMs must be of equal size.\n'
+    #since RSMs are symmetric matrices, we only need to compare their lower triangular parts (main diagonal can be omitted)
     if metric == 'pred':
-        rsm_1 = spose_rsm(W_mod1)
-        rsm_2 = spose_rsm(W_mod2)
+        tril_1 = tril_(spose2rsm_odd_one_out(W_mod1))
+        tril_2 = tril_(spose2rsm_odd_one_out(W_mod2))
     else:
-        rsm_1 = rsm(W_mod1, metric) #RSM wrt first modality (e.g., DNN)
-        rsm_2 = rsm(W_mod2, metric) #RSM wrt second modality (e.g., behavior)
-    assert rsm_1.shape == rsm_2.shape, '\nRSMs must be of equal size.\n'
-    #since RSMs are symmetric matrices, we only need to compare their lower triangular parts (main diagonal can be omitted)
-    tril_inds = np.tril_indices(len(rsm_1), k=-1)
-    tril_1 = rsm_1[tril_inds]
-    tril_2 = rsm_2[tril_inds]
-    return tril_1, tril_2, tril_inds
-
-def compare_modalities(W_mod1:np.ndarray, W_mod2:np.ndarray, duplicates:bool=False) -> Tuple[np.ndarray]:
+        #RSMs wrt first (e.g., DNN) and second modality (e.g., behavior) are streamed into condensed vectors
+        tril_1 = rsm_condensed(W_mod1, metric, out_path=pjoin(out_dir, 'tril_1.npy') if out_dir else None)
+        tril_2 = rsm_condensed(W_mod2, metric, out_path=pjoin(out_dir, 'tril_2.npy') if out_dir else None)
+    if return_inds:
+        tril_inds = np.tril_indices(W_mod1.shape[0], k=-1)
+        return tril_1, tril_2, tril_inds
+    return tril_1, tril_2
+
+def cross_corr_(X:np.ndarray, Y:np.ndarray, a_min:float=-1., a_max:float=1.) -> np.ndarray:
+    """Pearson correlations between all rows of X and all rows of Y (computed as a single standardized matmul)"""
+    X_n = normalize_rows_(X, center=True, dtype=np.float64)
+    Y_n = normalize_rows_(Y, center=True, dtype=np.float64)
+    corrs = X_n @ Y_n.T
+    np.clip(corrs, a_min, a_max, out=corrs)
+    return corrs
+
+def compare_modalities(
+                       W_mod1:np.ndarray,
+                       W_mod2:np.ndarray,
+                       duplicates:bool=False,
+                       assignment:str='optimal',
+) -> Tuple[np.ndarray]:
+    """match latent dimensions of two modalities according to their correlations across items
+
+    Without duplicates, every dimension of the second modality is used at most once. Dimensions are matched either
+    through an optimal linear sum assignment (maximizing the sum of correlations) or greedily in the order of
+    the dimensions of the first modality.
+    """
     assert W_mod1.shape[0] == W_mod2.shape[0], '\nNumber of items in weight matrices must align.\n'
-    mod1_mod2_corrs = np.zeros(W_mod1.shape[1])
-    mod2_dims = []
-    for d_mod1, w_mod1 in enumerate(W_mod1.T):
-        corrs = np.array([pearsonr(w_mod1, w_mod2) for w_mod2 in W_mod2.T])
-        if duplicates:
-            mod2_dims.append(np.argmax(corrs))
-        else:
-            for d_mod2 in np.argsort(-corrs):
-                if d_mod2 not in mod2_dims:
-                    mod2_dims.append(d_mod2)
-                    break
-        mod1_mod2_corrs[d_mod1] = corrs[mod2_dims[-1]]
-    mod1_dims_sorted = np.argsort(-mod1_mod2_corrs)
-    mod2_dims_sorted = np.asarray(mod2_dims)[mod1_dims_sorted]
-    corrs = mod1_mod2_corrs[mod1_dims_sorted]
+    assert assignment in ['optimal', 'greedy'], '\nAssignment must be one of [optimal, greedy].\n'
+    #(D1, D2) correlation matrix
+    corrs = cross_corr_(W_mod1.T, W_mod2.T)
+    if duplicates:
+        mod1_dims = np.arange(corrs.shape[0])
+        mod2_dims = np.argmax(corrs, axis=1)
+    elif assignment == 'optimal':
+        mod1_dims, mod2_dims = linear_sum_assignment(corrs, maximize=True)
+    else:
+        n_matches = min(corrs.shape)
+        mod1_dims = np.arange(n_matches)
+        mod2_dims = np.zeros(n_matches, dtype=int)
+        taken = np.zeros(corrs.shape[1], dtype=bool)
+        for d_mod1 in mod1_dims:
+            d_mod2 = np.argmax(np.where(taken, -np.inf, corrs[d_mod1]))
+            mod2_dims[d_mod1] = d_mod2
+            taken[d_mod2] = True
+    mod1_mod2_corrs = corrs[mod1_dims, mod2_dims]
+    sorted_matches = np.argsort(-mod1_mod2_corrs)
+    mod1_dims_sorted = mod1_dims[sorted_matches]
+    mod2_dims_sorted = mod2_dims[sorted_matches]
+    corrs = mod1_mod2_corrs[sorted_matches]
     return mod1_dims_sorted, mod2_dims_sorted, corrs
 
 def sparsity(A:np.ndarray) -> float:
@@ -768,17 +1535,34 @@ def robustness(corrs:np.ndarray, thresh:float) -> float:
     return len(corrs[corrs>thresh])/len(corrs)
 
 def cross_correlate_latent_dims(X, thresh:float=None) -> float:
+    """average (or fraction above <thresh>) of the maximum correlation of every row of W_mu_i with the rows of W_mu_j"""
     if isinstance(X, np.ndarray):
-        W_mu_i = np.copy(X)
-        W_mu_j = np.copy(X)
+        W_mu_i = W_mu_j = X
+        is_self = True
     else:
         W_mu_i, W_mu_j = X
-    corrs = np.zeros(min(W_mu_i.shape))
-    for i, w_i in enumerate(W_mu_i):
-        if np.all(W_mu_i == W_mu_j):
-            corrs[i] = np.max([pearsonr(w_i, w_j) for j, w_j in enumerate(W_mu_j) if j != i])
-        else:
-            corrs[i] = np.max([pearsonr(w_i, w_j) for w_j in W_mu_j])
+        is_self = np.array_equal(W_mu_i, W_mu_j)
+    corrs = cross_corr_(W_mu_i, W_mu_j)
+    if is_self:
+        #a latent dimension must not be matched with itself
+        np.fill_diagonal(corrs, -np.inf)
+    corrs = corrs.max(axis=1)
     if thresh:
         return robustness(corrs, thresh)
     return np.mean(corrs)
+
+def cross_correlate_seeds(Ws:list, thresh:float=None) -> np.ndarray:
+    """all-pairs (n_seeds x n_seeds) version of cross_correlate_latent_dims for a stack of weight matrices
+
+    Entry (s, t) corresponds to cross_correlate_latent_dims((Ws[s], Ws[t]), thresh). Matrices may differ in their
+    number of rows (i.e., latent dimensions) but must share the same number of columns (i.e., objects).
+    """
+    sizes = np.array([len(W) for W in Ws])
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    corrs = cross_corr_(np.concatenate(list(Ws)), np.concatenate(list(Ws)))
+    np.fill_diagonal(corrs, -np.inf)
+    #maximum correlation of every row with the rows of each seed: (n_rows, n_seeds)
+    max_corrs = np.maximum.reduceat(corrs, offsets, axis=1)
+    if thresh:
+        max_corrs = (max_corrs > thresh).astype(float)
+    return np.add.reduceat(max_corrs, offsets, axis=0) / sizes[:, None]
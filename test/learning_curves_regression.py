@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Regression check of learning_curves.evaluate_checkpoints on the checkpoints of the test results:
+every metric, in particular the RSM correlation, has to be finite for every checkpoint.
+
+Run from the repository root: python test/learning_curves_regression.py
+'''
+
+# Standard imports
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules', 'spose'))
+import utils
+from learning_curves import evaluate_checkpoints
+
+########### PARAMETERS ###########
+results_dir = os.path.join('test', 'test_results', 'triplets', 'results')
+triplets_path = os.path.join('test', 'test_results', 'triplets', 'dataset', 'test_10.npy')
+reference_path = os.path.join(results_dir, 'sparse_embed_epoch0500.txt')
+n_workers = 2
+
+########### Main Code ###########
+if __name__ == '__main__':
+    checkpoints = pd.DataFrame(
+        [('test', 0, 0., 0, epoch, path) for epoch, path in utils.get_checkpoints(os.path.join(results_dir, 'model'))],
+        columns=['modality', 'dim', 'lmbda', 'rnd_seed', 'epoch', 'path'],
+    )
+    test_triplets = np.load(triplets_path)
+    #embeddings are stored as dims x items
+    reference_rsm = utils.rsm_pred(np.loadtxt(reference_path).T)
+
+    learning_curves = evaluate_checkpoints(
+                                          checkpoints=checkpoints,
+                                          test_triplets=test_triplets,
+                                          reference_rsm=reference_rsm,
+                                          n_workers=n_workers,
+    )
+    metrics = ['accuracy', 'loglikelihood', 'rsm_corr']
+    print(learning_curves[['epoch'] + metrics].iloc[::len(learning_curves) // 10].to_string(index=False))
+    for metric in metrics:
+        n_invalid = int((~np.isfinite(learning_curves[metric].to_numpy(dtype=float))).sum())
+        assert n_invalid == 0, f'{metric} is not finite for {n_invalid} of {len(learning_curves)} checkpoints'
+    print(f'All metrics are finite for {len(learning_curves)} checkpoints')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Regression check of the odd-one-out RSM (utils.rsm_pred and utils.rsm_pred_mc) against the original
+triple loop in float64, on an embedding of the test results.
+
+Run from the repository root: python test/rsm_pred_regression.py
+'''
+
+# Standard imports
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules', 'spose'))
+import utils
+
+########### PARAMETERS ###########
+embedding_path = os.path.join('test', 'test_results', 'triplets', 'results', 'sparse_embed_epoch0500.txt')
+tolerance = 1e-10
+
+########### Main Code ###########
+def rsm_pred_baseline(W):
+    """original rsm_pred: exponentiated similarities in float64 and a plain triple loop"""
+    N = W.shape[0]
+    S_e = np.exp(W.astype(np.float64) @ W.astype(np.float64).T)
+    rsm = np.zeros((N, N))
+    for i in range(N):
+        for j in range(i + 1, N):
+            for k in range(N):
+                if k != i and k != j:
+                    rsm[i, j] += S_e[i, j] / (S_e[i, j] + S_e[i, k] + S_e[j, k])
+    rsm /= N - 2
+    rsm += rsm.T
+    np.fill_diagonal(rsm, 1)
+    return rsm
+
+if __name__ == '__main__':
+    W = np.loadtxt(embedding_path)
+    print(f'Embedding {W.shape}, max similarity {np.max(W @ W.T):.1f}')
+
+    baseline = rsm_pred_baseline(W)
+    rsm = utils.rsm_pred(W)
+    assert np.isfinite(baseline).all(), 'baseline RSM contains non-finite values'
+    assert np.isfinite(rsm).all(), f'rsm_pred returned {np.sum(~np.isfinite(rsm))} non-finite entries'
+    max_dev = np.abs(rsm - baseline).max()
+    assert max_dev < tolerance, f'rsm_pred deviates from the baseline by {max_dev}'
+    print(f'rsm_pred: max deviation from baseline {max_dev:.2e}')
+
+    # Sampling every object k reproduces the exact RSM
+    rsm_mc, errors = utils.rsm_pred_mc(W, n_samples=W.shape[0], rnd_seed=0)
+    max_dev = np.abs(rsm_mc - baseline).max()
+    assert max_dev < tolerance, f'rsm_pred_mc (all objects) deviates from the baseline by {max_dev}'
+    rsm_mc, errors = utils.rsm_pred_mc(W, n_samples=3, rnd_seed=0)
+    assert np.isfinite(rsm_mc).all(), 'rsm_pred_mc returned non-finite entries for 3 samples'
+    print(f'rsm_pred_mc: max deviation from baseline {max_dev:.2e} with all objects')
+
+    utils.spose2rsm_odd_one_out(W)
+    print('spose2rsm_odd_one_out: symmetric RSM')